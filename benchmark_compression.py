@@ -0,0 +1,134 @@
+# * Copyright (C) 2017 J.Mittaz University of Reading
+# * This code was developed for the EC project Fidelity and Uncertainty in
+# * Climate Data Records from Earth Observations (FIDUCEO).
+# * Grant Agreement: 638822
+# *
+# * This program is free software; you can redistribute it and/or modify it
+# * under the terms of the GNU General Public License as published by the Free
+# * Software Foundation; either version 3 of the License, or (at your option)
+# * any later version.
+# * This program is distributed in the hope that it will be useful, but WITHOUT
+# * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# * FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# * more details.
+# *
+# * A copy of the GNU General Public License should have been supplied along
+# * with this program; if not, see http://www.gnu.org/licenses/
+# * ------------------------------------------------------------------------
+#
+# Benchmark of the output compression profiles on a sample temporary
+# netCDF file.  For each profile the Monte Carlo ensemble (if present) and
+# the (line,element) FCDR variables are written and the write time and
+# file size reported
+#
+from __future__ import print_function
+import numpy as np
+import netCDF4
+import argparse
+import os
+import time
+import shutil
+import tempfile
+import write_easy_fcdr_from_netcdf as w
+
+#
+# Write all (line,element) variables as float32 - stands in for the FCDR
+# file (FCDRWriter only supports zlib levels)
+#
+def write_image_variables(filename,data,compression):
+
+    ncid = netCDF4.Dataset(filename,'w')
+    try:
+        ncid.createDimension('y',size=data.ny)
+        ncid.createDimension('x',size=data.nx)
+        for name in sorted(w.netcdf_variables):
+            if w.netcdf_variables[name][1] != ('y','x'):
+                continue
+            try:
+                values = getattr(data,name)
+            except AttributeError:
+                continue
+            if values.shape != (data.ny,data.nx):
+                continue
+            var = ncid.createVariable(name,'f4',('y','x'),\
+                                          fill_value=-32768.,**compression)
+            values = np.array(np.ma.getdata(values),dtype=np.float32)
+            values[~np.isfinite(values)] = -32768.
+            var[:,:] = values
+    finally:
+        ncid.close()
+
+#
+# Time a write and return (time,size)
+#
+def time_write(function,filename,*args,**kwargs):
+
+    start = time.time()
+    function(*args,**kwargs)
+    runtime = time.time()-start
+
+    return runtime,os.path.getsize(filename)
+
+def main(filename,profiles,write_threads=1):
+
+    data = w.read_netcdf(filename)
+    data.load_all()
+    data.close()
+
+    outdir = tempfile.mkdtemp()
+    try:
+        print('profile        image(s)   image(MB)  ensemble(s) ensemble(MB)')
+        for profile in profiles:
+            try:
+                compression = w.get_compression(profile)
+            except Exception as e:
+                print('{0:12s} {1}'.format(profile,e))
+                continue
+
+            #
+            # Filters can fail on some data (e.g. blosc on uncompressible
+            # chunks) so report this rather than stop
+            #
+            try:
+                imagefile = os.path.join(outdir,profile+'_image.nc')
+                image_time,image_size = time_write(write_image_variables,\
+                                                       imagefile,imagefile,\
+                                                       data,compression)
+                if data.montecarlo:
+                    file_out = os.path.join(outdir,profile+'.nc')
+                    ensfile = os.path.splitext(file_out)[0]+'_Ensemble.nc'
+                    ens_time,ens_size = time_write(w.write_ensemble,ensfile,\
+                                                       file_out,'benchmark',\
+                                                       data,compression=profile,\
+                                                       write_threads=write_threads)
+                else:
+                    ens_time,ens_size = float('nan'),float('nan')
+            except RuntimeError as e:
+                print('{0:12s} write failed: {1}'.format(profile,e))
+                continue
+
+            print('{0:12s} {1:10.2f} {2:11.2f} {3:12.2f} {4:12.2f}'.\
+                      format(profile,image_time,image_size/1024.**2,\
+                                 ens_time,ens_size/1024.**2))
+    finally:
+        shutil.rmtree(outdir)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark output '\
+                                         'compression profiles')
+
+    parser.add_argument('input_file',\
+                            help='Sample temporary netCDF file')
+
+    parser.add_argument('--profiles',nargs='+',\
+                            default=sorted(w.compression_profiles),\
+                            help='Compression profiles to test')
+
+    parser.add_argument('--write-threads',type=int,default=1,\
+                            help='Threads compressing the ensemble (zlib '\
+                            'profiles, needs h5py)')
+
+    args = parser.parse_args()
+
+    main(args.input_file,args.profiles,write_threads=args.write_threads)
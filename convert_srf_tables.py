@@ -0,0 +1,48 @@
+# * Copyright (C) 2017 J.Mittaz University of Reading
+# * This code was developed for the EC project Fidelity and Uncertainty in
+# * Climate Data Records from Earth Observations (FIDUCEO).
+# * Grant Agreement: 638822
+# *
+# * This program is free software; you can redistribute it and/or modify it
+# * under the terms of the GNU General Public License as published by the Free
+# * Software Foundation; either version 3 of the License, or (at your option)
+# * any later version.
+# * This program is distributed in the hope that it will be useful, but WITHOUT
+# * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# * FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# * more details.
+# *
+# * A copy of the GNU General Public License should have been supplied along
+# * with this program; if not, see http://www.gnu.org/licenses/
+# * ------------------------------------------------------------------------
+#
+# One off conversion of the SRF/lookup table text files to .npy files
+# which write_easy_fcdr_from_netcdf.py memory maps instead of parsing the
+# text files for every output file
+#
+from __future__ import print_function
+import argparse
+import write_easy_fcdr_from_netcdf as w
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Convert SRF/lookup table '\
+                                         'text files to .npy files')
+
+    parser.add_argument('--srf-dir',nargs=1,\
+                            help='Directory of SRF/lookup table text files')
+
+    parser.add_argument('--output',nargs=1,\
+                            help='Directory to write .npy files to '\
+                            '(default --srf-dir)')
+
+    args = parser.parse_args()
+
+    if args.srf_dir is None:
+        srf_dir = w.srf_directory
+    else:
+        srf_dir = args.srf_dir[0]
+    if args.output is None:
+        w.convert_srf_tables(srf_dir)
+    else:
+        w.convert_srf_tables(srf_dir,out_dir=args.output[0])
@@ -0,0 +1,120 @@
+# * Copyright (C) 2017 J.Mittaz University of Reading
+# * This code was developed for the EC project Fidelity and Uncertainty in
+# * Climate Data Records from Earth Observations (FIDUCEO).
+# * Grant Agreement: 638822
+# *
+# * This program is free software; you can redistribute it and/or modify it
+# * under the terms of the GNU General Public License as published by the Free
+# * Software Foundation; either version 3 of the License, or (at your option)
+# * any later version.
+# * This program is distributed in the hope that it will be useful, but WITHOUT
+# * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# * FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# * more details.
+# *
+# * A copy of the GNU General Public License should have been supplied along
+# * with this program; if not, see http://www.gnu.org/licenses/
+# * ------------------------------------------------------------------------
+#
+# Convergence check of the CURUC sub-sampling (line_skip/elem_skip) on a
+# sample of temporary netCDF files.  For each candidate sub-sampling the
+# CURUC passes are timed and compared to the finest (reference) one, and
+# the coarsest sub-sampling within tolerance for all orbits is chosen and
+# optionally written out for write_easy_fcdr_from_netcdf.py
+# (--curuc-skip-file)
+#
+from __future__ import print_function
+import numpy as np
+import argparse
+import write_easy_fcdr_from_netcdf as w
+
+#
+# Run convergence check on a single orbit (both halves if split)
+#
+def check_orbit(filename,candidates):
+
+    data = w.read_netcdf(filename)
+
+    reports = []
+    if data.ch3a_there:
+        for ch3a_version in [True,False]:
+            newdata = w.get_split_data(data,ch3a=ch3a_version)
+            if newdata.ny >= 1280:
+                chans = w.get_curuc_chans(data.noaa_string,ch3a_version)
+                reports.append(w.curuc_convergence(newdata,chans,\
+                                                       ch3a_version=ch3a_version,\
+                                                       candidates=candidates))
+    else:
+        chans = w.get_curuc_chans(data.noaa_string,False)
+        reports.append(w.curuc_convergence(data,chans,candidates=candidates))
+
+    data.close()
+
+    return reports
+
+#
+# Combine reports from all orbits - total time and worst deviation
+#
+def combine_reports(reports):
+
+    combined = []
+    for i in range(len(reports[0])):
+        line_skip,elem_skip = reports[0][i][0:2]
+        runtime = np.sum([report[i][2] for report in reports])
+        length_dev = np.max([report[i][3] for report in reports])
+        corr_dev = np.max([report[i][4] for report in reports])
+        combined.append((line_skip,elem_skip,runtime,length_dev,corr_dev))
+
+    return combined
+
+def main(filenames,tolerance,skip_file=None):
+
+    candidates = w.curuc_skip_candidates
+
+    reports = []
+    for filename in filenames:
+        print('Checking {0}'.format(filename))
+        reports.extend(check_orbit(filename,candidates))
+    if 0 == len(reports):
+        raise Exception('No orbits long enough for CURUC')
+
+    report = combine_reports(reports)
+    reftime = report[0][2]
+
+    print('')
+    print('line_skip elem_skip   time(s)  saved(%)  length_dev    corr_dev')
+    for line_skip,elem_skip,runtime,length_dev,corr_dev in report:
+        print('{0:9d} {1:9d} {2:9.2f} {3:9.1f} {4:11.3e} {5:11.3e}'.\
+                  format(line_skip,elem_skip,runtime,\
+                             100.*(1.-runtime/reftime),length_dev,corr_dev))
+
+    line_skip,elem_skip = w.choose_curuc_skip(report,tolerance)
+    print('')
+    print('Chosen line_skip={0} elem_skip={1} (tolerance {2})'.\
+              format(line_skip,elem_skip,tolerance))
+
+    if skip_file is not None:
+        w.write_curuc_skip(skip_file,line_skip,elem_skip)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Check convergence of CURUC '\
+                                         'sub-sampling on sample orbits')
+
+    parser.add_argument('input_files', nargs='+',\
+                            help='Input temporary netCDF files')
+
+    parser.add_argument('--tolerance',type=float,default=0.05,\
+                            help='Maximum relative length and absolute '\
+                            'correlation deviation from the reference')
+
+    parser.add_argument('--output',nargs=1,\
+                            help='File to write the chosen line_skip '\
+                            'elem_skip to')
+
+    args = parser.parse_args()
+
+    if args.output is None:
+        main(args.input_files,args.tolerance)
+    else:
+        main(args.input_files,args.tolerance,skip_file=args.output[0])
@@ -0,0 +1,254 @@
+# * Copyright (C) 2017 J.Mittaz University of Reading
+# * This code was developed for the EC project Fidelity and Uncertainty in
+# * Climate Data Records from Earth Observations (FIDUCEO).
+# * Grant Agreement: 638822
+# *
+# * This program is free software; you can redistribute it and/or modify it
+# * under the terms of the GNU General Public License as published by the Free
+# * Software Foundation; either version 3 of the License, or (at your option)
+# * any later version.
+# * This program is distributed in the hope that it will be useful, but WITHOUT
+# * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# * FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# * more details.
+# *
+# * A copy of the GNU General Public License should have been supplied along
+# * with this program; if not, see http://www.gnu.org/licenses/
+# * ------------------------------------------------------------------------
+#
+# Read Monte Carlo ensemble files written by write_easy_fcdr_from_netcdf.py.
+# Ocean only ensembles written with a land mask only store the ocean pixels
+# (nMC,npix) plus their index in the flattened (y,x) grid (ocean_index) and
+# are scattered back to the full grid (NaN over land) on request.
+#
+# ensemble_reader gives random access to windows of members, scanlines and
+# elements, decoding the scaled integers on the fly and keeping recently
+# used (decompressed) chunks in a small LRU cache
+#
+import numpy as np
+import netCDF4
+import collections
+import itertools
+
+#
+# Scatter (nMC,npix) ocean pixel values back to (nMC,ny,nx) with NaN for
+# pixels not stored
+#
+def scatter_ocean(values,ocean_index,ny,nx):
+
+    out = np.zeros((values.shape[0],ny*nx),dtype=values.dtype)+float('nan')
+    out[:,ocean_index] = values
+
+    return out.reshape(values.shape[0],ny,nx)
+
+#
+# Read (scaled) ensemble deltas of a variable (e.g. Ch4_MC) for a set of
+# members as float32 with NaN for fill values.  Sparse (ocean pixel) files
+# are returned on the full (nMC,y,x) grid unless full_grid is False
+#
+def read_ensemble(filename,name,members=slice(None),full_grid=True):
+
+    ncid = netCDF4.Dataset(filename,'r')
+    try:
+        var = ncid.variables[name]
+        values = var[members,...].astype(np.float32)
+        values = np.ma.filled(values,float('nan'))
+        if values.ndim == 1:
+            values = values[np.newaxis,:]
+        if 'ocean_index' in ncid.variables and full_grid:
+            values = scatter_ocean(values,ncid.variables['ocean_index'][:],\
+                                       len(ncid.dimensions['y']),\
+                                       len(ncid.dimensions['x']))
+    finally:
+        ncid.close()
+
+    return values
+
+#
+# Size (bytes) of the decompressed chunk cache of ensemble_reader
+#
+reader_cache_bytes = 64*1024**2
+
+#
+# (start,stop) of a slice (step 1) or integer on a dimension of size n
+#
+def window_range(index,n):
+
+    if isinstance(index,slice):
+        start,stop,step = index.indices(n)
+        if step != 1:
+            raise Exception('Only contiguous windows can be read')
+        return start,max(start,stop)
+    index = int(index)
+    if index < 0:
+        index += n
+    if index < 0 or index >= n:
+        raise Exception('Index {0} out of range ({1})'.format(index,n))
+
+    return index,index+1
+
+class ensemble_reader(object):
+
+    #
+    # Chunk shape of a variable (contiguous variables are a single chunk)
+    #
+    def chunk_shape(self,name):
+
+        var = self.ncid.variables[name]
+        chunks = var.chunking()
+        if chunks == 'contiguous' or chunks is None:
+            return var.shape
+
+        return tuple(chunks)
+
+    #
+    # Raw (scaled integer) chunk - from the cache if there
+    #
+    def get_chunk(self,name,offset):
+
+        key = (name,offset)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+        self.misses += 1
+        var = self.ncid.variables[name]
+        chunks = self.chunk_shape(name)
+        values = var[tuple([slice(offset[k],min(offset[k]+chunks[k],\
+                                                    var.shape[k])) \
+                                for k in range(len(chunks))])]
+        values = np.ascontiguousarray(np.ma.getdata(values))
+        self.cache[key] = values
+        self.cache_used += values.nbytes
+        while self.cache_used > self.cache_bytes and len(self.cache) > 1:
+            old_key,old_values = self.cache.popitem(last=False)
+            self.cache_used -= old_values.nbytes
+
+        return values
+
+    #
+    # Raw values of a window ((start,stop) per dimension) assembled from
+    # the chunks it touches
+    #
+    def read_raw(self,name,window):
+
+        var = self.ncid.variables[name]
+        chunks = self.chunk_shape(name)
+        out = np.empty([stop-start for start,stop in window],dtype=var.dtype)
+        if out.size == 0:
+            return out
+        ranges = [range((window[k][0]//chunks[k])*chunks[k],window[k][1],\
+                            chunks[k]) for k in range(len(chunks))]
+        for offset in itertools.product(*ranges):
+            values = self.get_chunk(name,offset)
+            src = []
+            dst = []
+            for k in range(len(chunks)):
+                start = max(window[k][0],offset[k])
+                stop = min(window[k][1],offset[k]+values.shape[k])
+                src.append(slice(start-offset[k],stop-offset[k]))
+                dst.append(slice(start-window[k][0],stop-window[k][0]))
+            out[tuple(dst)] = values[tuple(src)]
+
+        return out
+
+    #
+    # Decode raw values to float32 with NaN for fill (as netCDF4 would)
+    #
+    def decode(self,name,values):
+
+        var = self.ncid.variables[name]
+        out = values.astype(np.float64)
+        if '_FillValue' in var.ncattrs():
+            out[values == var.getncattr('_FillValue')] = float('nan')
+        if 'scale_factor' in var.ncattrs():
+            out *= var.scale_factor
+        if 'add_offset' in var.ncattrs():
+            out += var.add_offset
+
+        return out.astype(np.float32)
+
+    #
+    # Deltas of an ensemble variable (e.g. Ch4_MC) for a window of members,
+    # scanlines and elements (slices with step 1 or integers) as float32
+    # (members,lines,elements) with NaN for fill (and land in ocean pixel
+    # files)
+    #
+    def read(self,name,members=slice(None),lines=slice(None),\
+                 elems=slice(None)):
+
+        if name not in self.names:
+            raise Exception('Not an ensemble variable: {0}'.format(name))
+        members = window_range(members,self.nmc)
+        lines = window_range(lines,self.ny)
+        elems = window_range(elems,self.nx)
+        if self.ocean_index is None:
+            return self.decode(name,self.read_raw(name,[members,lines,elems]))
+
+        #
+        # Ocean pixels are in flattened (y,x) order so the lines of the
+        # window are a contiguous run of pixels
+        #
+        first,last = np.searchsorted(self.ocean_index,\
+                                         [lines[0]*self.nx,lines[1]*self.nx])
+        index = self.ocean_index[first:last]
+        line = index//self.nx-lines[0]
+        elem = index%self.nx-elems[0]
+        gd = (elem >= 0) & (elem < elems[1]-elems[0])
+        values = self.decode(name,self.read_raw(name,[members,(first,last)]))
+        nl = lines[1]-lines[0]
+        ne = elems[1]-elems[0]
+        out = np.zeros((members[1]-members[0],nl*ne),dtype=np.float32)+\
+            float('nan')
+        out[:,line[gd]*ne+elem[gd]] = values[:,gd]
+
+        return out.reshape(members[1]-members[0],nl,ne)
+
+    #
+    # All members of a single pixel (nMC,)
+    #
+    def read_pixel(self,name,line,elem,members=slice(None)):
+
+        return self.read(name,members=members,lines=line,elems=elem)[:,0,0]
+
+    def close(self):
+
+        if self.ncid is not None:
+            self.ncid.close()
+            self.ncid = None
+        self.cache.clear()
+        self.cache_used = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self,*args):
+
+        self.close()
+
+    def __init__(self,filename,cache_bytes=None):
+
+        if cache_bytes is None:
+            cache_bytes = reader_cache_bytes
+        self.ncid = netCDF4.Dataset(filename,'r')
+        self.cache = collections.OrderedDict()
+        self.cache_bytes = cache_bytes
+        self.cache_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.nmc = len(self.ncid.dimensions['nMC'])
+        self.ny = len(self.ncid.dimensions['y'])
+        self.nx = len(self.ncid.dimensions['x'])
+        self.names = [name for name,var in self.ncid.variables.items() \
+                          if var.dimensions[0:1] == ('nMC',)]
+        #
+        # Raw integers are decoded here (not by netCDF4)
+        #
+        for name in self.names:
+            self.ncid.variables[name].set_auto_maskandscale(False)
+        if 'ocean_index' in self.ncid.variables:
+            self.ocean_index = np.asarray(self.ncid.variables['ocean_index'][:],\
+                                              dtype=np.int64)
+        else:
+            self.ocean_index = None
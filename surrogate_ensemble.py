@@ -0,0 +1,314 @@
+# * Copyright (C) 2017 J.Mittaz University of Reading
+# * This code was developed for the EC project Fidelity and Uncertainty in
+# * Climate Data Records from Earth Observations (FIDUCEO).
+# * Grant Agreement: 638822
+# *
+# * This program is free software; you can redistribute it and/or modify it
+# * under the terms of the GNU General Public License as published by the Free
+# * Software Foundation; either version 3 of the License, or (at your option)
+# * any later version.
+# * This program is distributed in the hope that it will be useful, but WITHOUT
+# * ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# * FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# * more details.
+# *
+# * A copy of the GNU General Public License should have been supplied along
+# * with this program; if not, see http://www.gnu.org/licenses/
+# * ------------------------------------------------------------------------
+#
+# Draw surrogate ensemble members on demand from the uncertainty model of
+# the FCDR: independent, structured and common components each with their
+# FIDUCEO channel correlation matrix.  Independent errors are drawn per
+# pixel, structured errors are the same across a scanline and correlated
+# between lines over a given number of lines (a box car moving average of
+# white noise giving the triangular CURUC cross line correlation) and
+# common errors are drawn once per member.
+#
+# Each member has its own random stream from
+# numpy.random.SeedSequence(seed).spawn(members) and within a member each
+# component (and block of lines) is spawned again, so any subset of
+# members, channels and lines can be drawn independently (and in
+# parallel) and always gives the same values.
+#
+# NOTE: this is a different statistical model to the Fortran Monte Carlo
+# (monte_carlo.f90 perturbs counts with the SFMT generator and
+# recalibrates) so surrogate members are not members of the FCDR
+# ensemble.  They have their own seed (Surrogate_Seed) and never carry the
+# ensemble MC_Seed
+#
+from __future__ import print_function
+import numpy as np
+import netCDF4
+import argparse
+
+#
+# Channels in the order of the FCDR channel correlation matrices
+#
+ensemble_channels = ['Ch1','Ch2','Ch3a','Ch3b','Ch4','Ch5']
+
+#
+# Uncertainty components (FCDR names) - their position is the spawn key
+# of their random stream within a member
+#
+ensemble_components = ['independent','structured','common']
+
+#
+# Lines per random stream of the independent and structured components
+# so a window of lines only draws its own blocks
+#
+surrogate_block_lines = 128
+
+#
+# SeedSequence entropy for a stored seed (has to be non-negative)
+#
+def seed_entropy(seed):
+
+    return int(seed) % 2**64
+
+#
+# Seed sequence of a member (the same as SeedSequence(seed).spawn(nmc)
+# [member]) or, with keys, of a stream spawned from it in the same way
+#
+def member_sequence(seed,member,*keys):
+
+    return np.random.SeedSequence(seed_entropy(seed),\
+                                      spawn_key=(int(member),)+\
+                                      tuple([int(key) for key in keys]))
+
+#
+# Square root L (L L^T = S) of a channel correlation matrix.  Missing
+# channels (zero rows) and negative eigenvalues give zero rows
+#
+def correlation_root(S):
+
+    S = np.nan_to_num(np.asarray(S,dtype=np.float64))
+    S = (S+S.T)/2.
+    eigval,eigvec = np.linalg.eigh(S)
+
+    return eigvec*np.sqrt(np.clip(eigval,0.,None))
+
+#
+# Standard normals (lines,)+shape for lines start to stop of a component
+# of a member, drawn from the line block streams they fall in
+#
+def line_normals(seed,member,component,start,stop,shape):
+
+    nblock = surrogate_block_lines
+    if stop <= start:
+        return np.zeros((0,)+tuple(shape),dtype=np.float32)
+    values = []
+    for block in range(start//nblock,(stop-1)//nblock+1):
+        rng = np.random.default_rng(member_sequence(seed,member,component,\
+                                                        block))
+        normals = rng.standard_normal((nblock,)+tuple(shape),\
+                                          dtype=np.float32)
+        values.append(normals[max(start-block*nblock,0):\
+                                  min(stop-block*nblock,nblock)])
+
+    return np.concatenate(values,axis=0)
+
+#
+# Per orbit inputs from the FCDR: uncertainties (component,channel,line,
+# element) for a window of lines and elements (NaN if a channel is not
+# there) and the square roots of the channel correlation matrices
+#
+def read_inputs(file_fcdr,lines=slice(None),elems=slice(None)):
+
+    ncid = netCDF4.Dataset(file_fcdr,'r')
+    try:
+        shape = ncid.variables['u_independent_Ch4'].shape
+        ny,nx = shape[-2:]
+        line_start,line_stop = lines.indices(ny)[0:2]
+        elem_start,elem_stop = elems.indices(nx)[0:2]
+        lines = slice(line_start,line_stop)
+        elems = slice(elem_start,elem_stop)
+        u = np.zeros((len(ensemble_components),len(ensemble_channels),\
+                          line_stop-line_start,elem_stop-elem_start),\
+                         dtype=np.float32)+float('nan')
+        roots = []
+        for k in range(len(ensemble_components)):
+            component = ensemble_components[k]
+            for c in range(len(ensemble_channels)):
+                name = 'u_{0}_{1}'.format(component,ensemble_channels[c])
+                if name in ncid.variables:
+                    u[k,c] = np.ma.filled(ncid.variables[name][lines,elems].\
+                                              astype(np.float32),float('nan'))
+            roots.append(correlation_root(ncid.variables[\
+                        'channel_correlation_matrix_'+component][:]))
+    finally:
+        ncid.close()
+
+    return u,roots,lines,elems,nx
+
+#
+# Surrogate ensemble deltas (members,lines,elements) of channels (all by
+# default) for a window of lines and elements.  correlation_lines is the
+# cross line correlation length of the structured component.  Returns a
+# dictionary of float32 arrays keyed as the ensemble (e.g. Ch4_MC)
+#
+def surrogate(file_fcdr,seed,members,correlation_lines,channels=None,\
+                  lines=slice(None),elems=slice(None)):
+
+    if channels is None:
+        channels = ensemble_channels
+    index = [ensemble_channels.index(chan) for chan in channels]
+    u,roots,lines,elems,nx = read_inputs(file_fcdr,lines=lines,elems=elems)
+    nchan = len(ensemble_channels)
+    nline = lines.stop-lines.start
+    width = max(1,int(correlation_lines))
+
+    out = {}
+    for chan in channels:
+        out[chan+'_MC'] = np.zeros((len(members),)+u.shape[2:],\
+                                       dtype=np.float32)
+    for m in range(len(members)):
+        member = members[m]
+        #
+        # Independent - per pixel (all elements drawn so a window gives
+        # the same values)
+        #
+        independent = np.dot(line_normals(seed,member,0,lines.start,\
+                                              lines.stop,(nx,nchan)),\
+                                 roots[0].T)[:,elems,:]
+        #
+        # Structured - per line.  White noise shifted by width lines (so
+        # stream keys are never negative) and summed over a centred box
+        # of width lines
+        #
+        start = lines.start+width-width//2
+        noise = np.dot(line_normals(seed,member,1,start,\
+                                        start+nline+width-1,(nchan,)),\
+                           roots[1].T)
+        total = np.concatenate([np.zeros((1,nchan)),\
+                                    np.cumsum(noise,axis=0,dtype=np.float64)])
+        structured = (total[width:]-total[:-width])/np.sqrt(width)
+        #
+        # Common - once per member
+        #
+        rng = np.random.default_rng(member_sequence(seed,member,2))
+        common = np.dot(roots[2],rng.standard_normal(nchan))
+
+        for k in range(len(channels)):
+            c = index[k]
+            out[channels[k]+'_MC'][m] = u[0,c]*independent[:,:,c]+\
+                u[1,c]*structured[:,c][:,np.newaxis]+\
+                u[2,c]*common[c]
+
+    return out
+
+#
+# Cross line correlation length (lines) of the structured component
+# stored with an FCDR ensemble (Spatial_Correlation_Scale)
+#
+def correlation_scale(file_ensemble):
+
+    ncid = netCDF4.Dataset(file_ensemble,'r')
+    try:
+        if 'Spatial_Correlation_Scale' not in ncid.ncattrs():
+            raise Exception('No Spatial_Correlation_Scale in {0}: give the '\
+                                'correlation length in lines'.\
+                                format(file_ensemble))
+        return ncid.Spatial_Correlation_Scale
+    finally:
+        ncid.close()
+
+#
+# New seed for a surrogate ensemble (fits a netCDF int64 attribute)
+#
+def new_seed():
+
+    return int(np.random.SeedSequence().entropy % 2**63)
+
+#
+# Write surrogate members to a netCDF file
+#
+def write_surrogate(filename,values,members,lines,elems,seed,file_fcdr,\
+                        correlation_lines):
+
+    ncid = netCDF4.Dataset(filename,'w')
+    try:
+        shape = list(values.values())[0].shape
+        ncid.createDimension('nMC',size=shape[0])
+        ncid.createDimension('y',size=shape[1])
+        ncid.createDimension('x',size=shape[2])
+        ncid.Ensemble_Type = 'Surrogate'
+        ncid.Surrogate_Seed = np.int64(seed)
+        ncid.origin_FCDR = file_fcdr
+        ncid.Spatial_Correlation_Scale = correlation_lines
+        ncid.first_line = lines.start
+        ncid.first_element = elems.start
+        ncid.comment = 'Surrogate members drawn from the FCDR uncertainty '\
+            'model with surrogate_ensemble.py - not members of the FCDR '\
+            'Monte Carlo ensemble'
+        var = ncid.createVariable('member','i4',('nMC',))
+        var[:] = members
+        for name in values:
+            var = ncid.createVariable(name,'f4',('nMC','y','x'),zlib=True,\
+                                          fill_value=float('nan'))
+            var.long_name = 'Surrogate MonteCarlo delta from FCDR'
+            var[:] = values[name]
+    finally:
+        ncid.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Draw surrogate ensemble '\
+                                         'members from the FCDR '\
+                                         'uncertainties')
+
+    parser.add_argument('fcdr_file',\
+                            help='FCDR file with the uncertainties and '\
+                            'channel correlation matrices')
+
+    parser.add_argument('output_file',\
+                            help='netCDF file for the surrogate members')
+
+    parser.add_argument('--members',nargs=2,type=int,required=True,\
+                            help='First and last+1 member')
+
+    parser.add_argument('--seed',type=int,\
+                            help='Surrogate seed (default a new one, '\
+                            'stored in the output)')
+
+    scale = parser.add_mutually_exclusive_group(required=True)
+
+    scale.add_argument('--correlation-lines',type=float,\
+                           help='Cross line correlation length of the '\
+                           'structured component (lines)')
+
+    scale.add_argument('--ensemble',nargs=1,\
+                           help='FCDR ensemble file to take the correlation '\
+                           'length (Spatial_Correlation_Scale) from')
+
+    parser.add_argument('--lines',nargs=2,type=int,\
+                            help='First and last+1 scanline')
+
+    parser.add_argument('--elems',nargs=2,type=int,\
+                            help='First and last+1 element')
+
+    parser.add_argument('--channels',nargs='+',choices=ensemble_channels,\
+                            help='Channels to draw')
+
+    args = parser.parse_args()
+
+    members = range(args.members[0],args.members[1])
+    if args.correlation_lines is not None:
+        correlation_lines = args.correlation_lines
+    else:
+        correlation_lines = correlation_scale(args.ensemble[0])
+    seed = args.seed
+    if seed is None:
+        seed = new_seed()
+    lines = slice(None)
+    if args.lines is not None:
+        lines = slice(args.lines[0],args.lines[1])
+    elems = slice(None)
+    if args.elems is not None:
+        elems = slice(args.elems[0],args.elems[1])
+
+    values = surrogate(args.fcdr_file,seed,list(members),correlation_lines,\
+                           channels=args.channels,lines=lines,elems=elems)
+    write_surrogate(args.output_file,values,list(members),\
+                        slice(lines.start or 0,None),\
+                        slice(elems.start or 0,None),seed,args.fcdr_file,\
+                        correlation_lines)
@@ -37,15 +37,155 @@ import write_l1c_data as l1c
 import matplotlib.pyplot as plt
 import uuid
 import os
+import time
+import glob
+import hashlib
+import functools
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.pool
+import itertools
+import zlib
+import zipfile
+import warnings
+try:
+    import h5py
+except ImportError:
+    h5py = None
 
 
+#
+# Registry of the variables read from the temporary netCDF file.  Adding
+# a variable (or a new channel set) only needs an entry here
+#
+# attribute, netCDF name, dimensions, only there if, dtype (None keeps the
+# stored type), fill with NaN, set < -1e20 to NaN
+#
+# Line dimension is 'y'.  Variables that are not filled keep the masked
+# array returned by netCDF4 as before
+#
+netcdf_registry = [
+    ('lat','latitude',('y','x'),None,np.float32,True,True),
+    ('lon','longitude',('y','x'),None,np.float32,True,True),
+    ('satza','satza',('y','x'),None,np.float32,True,True),
+    ('solza','solza',('y','x'),None,np.float32,True,False),
+    ('relaz','relaz',('y','x'),None,np.float32,True,True),
+    ('ch1','ch1',('y','x'),None,np.float32,True,True),
+    ('ch2','ch2',('y','x'),None,np.float32,True,True),
+    ('ch3a','ch3a',('y','x'),None,np.float32,True,True),
+    ('ch3b','ch3b',('y','x'),None,np.float32,True,True),
+    ('ch4','ch4',('y','x'),None,np.float32,True,True),
+    ('ch5','ch5',('y','x'),'ch5_there',np.float32,True,True),
+    ('u_random_ch1','ch1_random',('y','x'),None,np.float32,True,True),
+    ('u_random_ch2','ch2_random',('y','x'),None,np.float32,True,True),
+    ('u_random_ch3a','ch3a_random',('y','x'),'ch3a_there',np.float32,True,True),
+    ('u_random_ch3b','ch3b_random',('y','x'),None,np.float32,True,True),
+    ('u_random_ch4','ch4_random',('y','x'),None,np.float32,True,True),
+    ('u_random_ch5','ch5_random',('y','x'),'ch5_there',np.float32,True,True),
+    ('u_non_random_ch1','ch1_non_random',('y','x'),None,np.float32,True,True),
+    ('u_non_random_ch2','ch2_non_random',('y','x'),None,np.float32,True,True),
+    ('u_non_random_ch3a','ch3a_non_random',('y','x'),'ch3a_there',np.float32,True,True),
+    ('u_non_random_ch3b','ch3b_non_random',('y','x'),None,np.float32,True,True),
+    ('u_non_random_ch4','ch4_non_random',('y','x'),None,np.float32,True,True),
+    ('u_non_random_ch5','ch5_non_random',('y','x'),'ch5_there',np.float32,True,True),
+    ('u_common_ch1','ch1_common',('y','x'),None,np.float32,True,True),
+    ('u_common_ch2','ch2_common',('y','x'),None,np.float32,True,True),
+    ('u_common_ch3a','ch3a_common',('y','x'),'ch3a_there',np.float32,True,True),
+    ('u_common_ch3b','ch3b_common',('y','x'),None,np.float32,True,True),
+    ('u_common_ch4','ch4_common',('y','x'),None,np.float32,True,True),
+    ('u_common_ch5','ch5_common',('y','x'),'ch5_there',np.float32,True,True),
+    ('scan_qual','quality_scanline_bitmask',('y',),None,None,False,False),
+    ('chan_qual','quality_channel_bitmask',('y','x'),None,None,False,False),
+    ('dBT3_over_dT','dBT3_over_dT',('y','x'),None,np.float32,True,True),
+    ('dBT4_over_dT','dBT4_over_dT',('y','x'),None,np.float32,True,True),
+    ('dBT5_over_dT','dBT5_over_dT',('y','x'),'ch5_there',np.float32,True,True),
+    ('dRe1_over_dCS','dRe1_over_dCS',('y','x'),None,np.float32,True,True),
+    ('dRe2_over_dCS','dRe2_over_dCS',('y','x'),None,np.float32,True,True),
+    ('dRe3a_over_dCS','dRe3a_over_dCS',('y','x'),'ch3a_there',np.float32,True,True),
+    ('dBT3_over_dCS','dBT3_over_dCS',('y','x'),None,np.float32,True,True),
+    ('dBT4_over_dCS','dBT4_over_dCS',('y','x'),None,np.float32,True,True),
+    ('dBT5_over_dCS','dBT5_over_dCS',('y','x'),'ch5_there',np.float32,True,True),
+    ('dBT3_over_dCICT','dBT3_over_dCICT',('y','x'),None,np.float32,True,True),
+    ('dBT4_over_dCICT','dBT4_over_dCICT',('y','x'),None,np.float32,True,True),
+    ('dBT5_over_dCICT','dBT5_over_dCICT',('y','x'),'ch5_there',np.float32,True,True),
+    ('smoothPRT','dBT5_over_dCICT',('y','x'),None,None,False,False),
+    ('cal_cnts_noise','cal_cnts_noise',('nir',),None,np.float32,True,True),
+    ('cnts_noise','cnts_noise',('nir',),None,np.float32,True,True),
+    ('scanline','scanline',('y',),None,None,False,False),
+    ('orig_scanline','orig_scanline',('y',),None,None,False,False),
+    ('ch3b_harm','ch3b_harm_uncertainty',('y','x'),None,None,False,True),
+    ('ch4_harm','ch4_harm_uncertainty',('y','x'),None,None,False,True),
+    ('ch5_harm','ch5_harm_uncertainty',('y','x'),None,None,False,True),
+    ('badNav','badNavigation',('y',),None,None,False,False),
+    ('badCal','badCalibration',('y',),None,None,False,False),
+    ('badTime','badTime',('y',),None,None,False,False),
+    ('missingLines','missingLines',('y',),None,None,False,False),
+    ('solar3','solar_contam_3b',('y',),None,None,False,False),
+    ('solar4','solar_contam_4',('y',),None,None,False,False),
+    ('solar5','solar_contam_5',('y',),None,None,False,False),
+    ('ch1_MC','ch1_MC',('nMC','y','x'),'montecarlo',np.float32,True,True),
+    ('ch2_MC','ch2_MC',('nMC','y','x'),'montecarlo',np.float32,True,True),
+    ('ch3a_MC','ch3a_MC',('nMC','y','x'),'montecarlo',np.float32,True,True),
+    ('ch3_MC','ch3_MC',('nMC','y','x'),'montecarlo',np.float32,True,True),
+    ('ch4_MC','ch4_MC',('nMC','y','x'),'montecarlo',np.float32,True,True),
+    ('ch5_MC','ch5_MC',('nMC','y','x'),'montecarlo',np.float32,True,True),
+    ]
+netcdf_variables = dict((entry[0],entry[1:]) for entry in netcdf_registry)
+
+#
+# Single pass normalisation of raw (unmasked/unscaled) netCDF values: fill,
+# missing and out of range values (plus anything < -1e20 if nan set) become
+# NaN in place
+#
+def normalise_values(var,values,dtype,nan=True):
+
+    attrs = var.ncattrs()
+    if '_FillValue' in attrs:
+        fill = var._FillValue
+    else:
+        fill = netCDF4.default_fillvals.get(values.dtype.str[1:])
+    with np.errstate(invalid='ignore'):
+        if fill is None or (values.dtype.kind == 'f' and np.isnan(fill)):
+            bad = np.zeros(values.shape,dtype=np.bool)
+        else:
+            bad = (values == fill)
+        if 'missing_value' in attrs:
+            bad |= np.isin(values,np.atleast_1d(var.missing_value))
+        if 'valid_range' in attrs:
+            bad |= (values < var.valid_range[0]) | (values > var.valid_range[1])
+        if 'valid_min' in attrs:
+            bad |= (values < var.valid_min)
+        if 'valid_max' in attrs:
+            bad |= (values > var.valid_max)
+
+    if dtype is None:
+        dtype = values.dtype
+        if dtype.kind != 'f':
+            dtype = np.float64
+    values = values.astype(dtype,copy=False)
+    if 'scale_factor' in attrs:
+        values *= var.scale_factor
+    if 'add_offset' in attrs:
+        values += var.add_offset
+    if nan:
+        with np.errstate(invalid='ignore'):
+            bad |= (values < -1e20)
+    values[bad] = float('nan')
+
+    return values
+
 class read_netcdf(object):
 
+    #
+    # Variables are decoded from the temporary netCDF on first access (see
+    # netcdf_registry) and cached on the instance so that a run only pays
+    # for what it uses
+    #
     def add_nan_values(self,values):
         with np.errstate(invalid='ignore'):
             gd = np.isfinite(values) & (values < -1e20)
         if np.sum(gd) > 0:
-            values[gd] = np.NaN
+            values[gd] = np.nan
         return values
 
     def scale_values(self,values):
@@ -55,9 +195,95 @@ class read_netcdf(object):
             values[gd] = values[gd]*100.
         return values
 
+    #
+    # Decode a single variable, fill/NaN it and only read the good time
+    # lines (and members if given)
+    #
+    def load_variable(self,name,members=None):
+
+        ncname,dims,there,dtype,filled,nan = netcdf_variables[name]
+        var = self.ncid.variables[ncname]
+        index = [slice(None)]*len(dims)
+        if 'y' in dims:
+            index[dims.index('y')] = self.lines
+        if members is not None:
+            index[dims.index('nMC')] = members
+        #
+        # Mode is held on the netCDF variable which can be shared between
+        # entries so always set it
+        #
+        var.set_auto_maskandscale(not filled)
+        if filled:
+            values = normalise_values(var,var[tuple(index)],dtype,nan)
+        else:
+            values = var[tuple(index)]
+            if nan:
+                values = self.add_nan_values(values)
+
+        return values
+
+    def __getattr__(self,name):
+
+        #
+        # Only called if name is not already set on the instance
+        #
+        if name.startswith('__') or 'ncid' not in self.__dict__ or \
+                name not in netcdf_variables:
+            raise AttributeError(name)
+        there = netcdf_variables[name][2]
+        if there is not None and not getattr(self,there):
+            raise AttributeError(name)
+        if self.ncid is None:
+            raise Exception('netcdf closed before {0} was read'.format(name))
+        values = self.load_variable(name)
+        setattr(self,name,values)
+
+        return values
+
+    #
+    # Subset of Monte Carlo members of an ensemble variable - read from the
+    # file without caching unless the whole variable is already loaded
+    #
+    def get_members(self,name,members):
+
+        if name in self.__dict__ or self.ncid is None:
+            return getattr(self,name)[members]
+
+        return self.load_variable(name,members=members)
+
+    #
+    # Force all (available) variables to be read e.g. before the file is
+    # closed
+    #
+    def load_all(self):
+
+        for name in netcdf_variables:
+            try:
+                getattr(self,name)
+            except AttributeError:
+                pass
+
+    def close(self):
+
+        if self.ncid is not None:
+            self.ncid.close()
+            self.ncid = None
+
+    #
+    # netCDF file handles cannot be shared across a fork so the file is
+    # closed before forking and reopened afterwards (in the parent and in
+    # each child) - variables not already read are then read lazily
+    #
+    def reopen(self):
+
+        if self.ncid is None:
+            self.ncid = netCDF4.Dataset(self.filename,'r')
+
     def read_data(self,filename):
 
         ncid = netCDF4.Dataset(filename,'r')
+        self.ncid = ncid
+        self.filename = filename
 
         self.sources = ncid.sources
         self.noaa_string = ncid.noaa_string
@@ -67,390 +293,74 @@ class read_netcdf(object):
         month = ncid.variables['month'][:]
         day = ncid.variables['day'][:]
         hours = ncid.variables['hours'][:]
-        gd = (year > 1900) & (day > 0) & (month > 0) & (hours >= 0)
+        gd = np.ma.filled((year > 1900) & (day > 0) & (month > 0) & \
+                              (hours >= 0),False)
         if 0 == np.sum(gd):
             raise Exception('No good data in netcdf')
-        yr = year[:]
-        mn = month[:]
-        dy = day[:]
-        temp = hours[:]
-        hour = temp.astype(np.int)
+        #
+        # Build the scanline times in one pass as datetime64 (bad lines set
+        # to 0001-01-01 as before)
+        #
+        temp = np.ma.filled(hours,0.)
+        hour = temp.astype(np.int64)
         temp = (temp - hour)*60.
-        minute = temp.astype(np.int)
+        minute = temp.astype(np.int64)
         temp = (temp - minute)*60.
-        second = temp.astype(np.int)
-        microsec = ((temp-second)*1e6).astype(np.int)
-        self.date_time = []
-        for i in range(len(hour)):
-            if gd[i]:
-                self.date_time.append(datetime.datetime(yr[i],mn[i],dy[i],hour[i],minute[i],second[i],microsec[i]))
-            else:
-                self.date_time.append(datetime.datetime(1,1,1,0,0,0,0))
-        self.time = netCDF4.date2num(self.date_time,'seconds since 1970-01-01')
-        self.lat = ncid.variables['latitude'][:,:]
-        self.lon = ncid.variables['longitude'][:,:]
-        self.satza = ncid.variables['satza'][:,:]
-        self.solza = ncid.variables['solza'][:,:]
-        self.relaz = ncid.variables['relaz'][:,:]
-        self.ch1 = ncid.variables['ch1'][:,:]
-        self.ch2 = ncid.variables['ch2'][:,:]
-        self.ch3a = ncid.variables['ch3a'][:,:]
+        second = temp.astype(np.int64)
+        microsec = ((temp-second)*1e6).astype(np.int64)
+        yr = np.where(gd,year,1970).astype(np.int64)
+        mn = np.where(gd,month,1).astype(np.int64)
+        dy = np.where(gd,day,1).astype(np.int64)
+        date = (yr-1970).astype('datetime64[Y]').astype('datetime64[M]') + \
+            (mn-1).astype('timedelta64[M]')
+        date = date.astype('datetime64[D]') + (dy-1).astype('timedelta64[D]')
+        usec = ((hour.astype(np.int64)*60+minute)*60+second)*1000000+microsec
+        self.date_time = date.astype('datetime64[us]') + \
+            usec.astype('timedelta64[us]')
+        self.date_time[~gd] = \
+            np.datetime64('0001-01-01T00:00:00','us')
+        self.time = (self.date_time - np.datetime64('1970-01-01','us'))/\
+            np.timedelta64(1,'s')
         self.ch3a_there_int = ncid.variables['ch3a_there'][:]
         self.ch3a_there = False
         gd = (self.ch3a_there_int == 1)
         if np.sum(gd) > 0:
             self.ch3a_there = True
-        self.ch3b = ncid.variables['ch3b'][:,:]
-        self.ch4 = ncid.variables['ch4'][:,:]
-        try:
-            self.ch5 = ncid.variables['ch5'][:,:]
-            self.ch5_there = True
-        except:
-            self.ch5_there = False
-        self.u_random_ch1 = ncid.variables['ch1_random'][:,:]
-        self.u_random_ch2 = ncid.variables['ch2_random'][:,:]
-        if self.ch3a_there:
-            self.u_random_ch3a = ncid.variables['ch3a_random'][:,:]
-        self.u_random_ch3b = ncid.variables['ch3b_random'][:,:]
-        self.u_random_ch4 = ncid.variables['ch4_random'][:,:]
-        if self.ch5_there:
-            self.u_random_ch5 = ncid.variables['ch5_random'][:,:]
-        self.u_non_random_ch1 = ncid.variables['ch1_non_random'][:,:]
-        self.u_non_random_ch2 = ncid.variables['ch2_non_random'][:,:]
-        if self.ch3a_there:
-            self.u_non_random_ch3a = ncid.variables['ch3a_non_random'][:,:]
-        self.u_non_random_ch3b = ncid.variables['ch3b_non_random'][:,:]
-        self.u_non_random_ch4 = ncid.variables['ch4_non_random'][:,:]
-        if self.ch5_there:
-            self.u_non_random_ch5 = ncid.variables['ch5_non_random'][:,:]
-        self.u_common_ch3b = ncid.variables['ch3b_common'][:,:]
-        self.u_common_ch4 = ncid.variables['ch4_common'][:,:]
-        if self.ch5_there:
-            self.u_common_ch5 = ncid.variables['ch5_common'][:,:]
-        self.u_common_ch1 = ncid.variables['ch1_common'][:,:]
-        self.u_common_ch2 = ncid.variables['ch2_common'][:,:]
-        if self.ch3a_there:
-            self.u_common_ch3a = ncid.variables['ch3a_common'][:,:]
-        self.scan_qual = ncid.variables['quality_scanline_bitmask'][:]
-        self.chan_qual = ncid.variables['quality_channel_bitmask'][:,:]
-        self.dBT3_over_dT = ncid.variables['dBT3_over_dT'][:,:]
-        self.dBT4_over_dT = ncid.variables['dBT4_over_dT'][:,:]
-        if self.ch5_there:
-            self.dBT5_over_dT = ncid.variables['dBT5_over_dT'][:,:]
-        self.dRe1_over_dCS = ncid.variables['dRe1_over_dCS'][:,:]
-        self.dRe2_over_dCS = ncid.variables['dRe2_over_dCS'][:,:]
-        if self.ch3a_there:
-            self.dRe3a_over_dCS = ncid.variables['dRe3a_over_dCS'][:,:]
-        self.dBT3_over_dCS = ncid.variables['dBT3_over_dCS'][:,:]
-        self.dBT4_over_dCS = ncid.variables['dBT4_over_dCS'][:,:]
-        if self.ch5_there:
-            self.dBT5_over_dCS = ncid.variables['dBT5_over_dCS'][:,:]
-        self.dBT3_over_dCICT = ncid.variables['dBT3_over_dCICT'][:,:]
-        self.dBT4_over_dCICT = ncid.variables['dBT4_over_dCICT'][:,:]
-        if self.ch5_there:
-            self.dBT5_over_dCICT = ncid.variables['dBT5_over_dCICT'][:,:]
-        self.smoothPRT = ncid.variables['dBT5_over_dCICT'][:]
-        self.cal_cnts_noise = ncid.variables['cal_cnts_noise'][:]
-        self.cnts_noise = ncid.variables['cnts_noise'][:]
+        self.ch5_there = 'ch5' in ncid.variables
         self.spatial_correlation_scale = ncid.spatial_correlation_scale
         self.ICT_Temperature_Uncertainty = ncid.ICT_Temperature_Uncertainty
         self.PRT_Uncertainty = ncid.PRT_Uncertainty
         self.noaa_string = ncid.noaa_string
         self.orbital_temperature = ncid.orbital_temperature
-        self.scanline = ncid.variables['scanline'][:]
-        self.orig_scanline = ncid.variables['orig_scanline'][:]
-        self.ch3b_harm = ncid.variables['ch3b_harm_uncertainty'][:,:]
-        self.ch4_harm = ncid.variables['ch4_harm_uncertainty'][:,:]
-        self.ch5_harm = ncid.variables['ch5_harm_uncertainty'][:,:]
-
-        self.badNav = ncid.variables['badNavigation'][:]
-        self.badCal = ncid.variables['badCalibration'][:]
-        self.badTime = ncid.variables['badTime'][:]
-        self.missingLines = ncid.variables['missingLines'][:]
-        self.solar3 = ncid.variables['solar_contam_3b'][:]
-        self.solar4 = ncid.variables['solar_contam_4'][:]
-        self.solar5 = ncid.variables['solar_contam_5'][:]
-
-        self.nx = self.lat.shape[1]
-        self.ny = self.lat.shape[0]
 
         try:
             self.montecarlo_seed = ncid.montecarlo_seed
-            self.ch1_MC = ncid.variables['ch1_MC'][:,:,:]
-            self.ch2_MC = ncid.variables['ch2_MC'][:,:,:]
-            self.ch3a_MC = ncid.variables['ch3a_MC'][:,:,:]
-            self.ch3_MC = ncid.variables['ch3_MC'][:,:,:]
-            self.ch4_MC = ncid.variables['ch4_MC'][:,:,:]
-            self.ch5_MC = ncid.variables['ch5_MC'][:,:,:]
-            self.nmc = self.ch1_MC.shape[0]
+            self.nmc = ncid.variables['ch1_MC'].shape[0]
             self.montecarlo = True
         except:
             self.montecarlo = False
 
-        ncid.close()
-
-        if True:
-            self.lat = np.ma.filled(self.lat,np.NaN)
-            self.lon = np.ma.filled(self.lon,np.NaN)
-            self.time = np.ma.filled(self.time,np.NaN)
-            self.satza = np.ma.filled(self.satza,np.NaN)
-            self.solza = np.ma.filled(self.solza,np.NaN)
-            self.relaz = np.ma.filled(self.relaz,np.NaN)
-            self.ch1 = np.ma.filled(self.ch1,np.NaN)
-            self.ch2 = np.ma.filled(self.ch2,np.NaN)
-            if self.ch3a_there:
-                self.ch3a = np.ma.filled(self.ch3a,np.NaN)
-            self.ch3b = np.ma.filled(self.ch3b,np.NaN)
-            self.ch4 = np.ma.filled(self.ch4,np.NaN)
-            if self.ch5_there:
-                self.ch5 = np.ma.filled(self.ch5,np.NaN)
-            self.u_random_ch1 = np.ma.filled(self.u_random_ch1,np.NaN)
-            self.u_random_ch2 = np.ma.filled(self.u_random_ch2,np.NaN)
-            if self.ch3a_there:
-                self.u_random_ch3a = np.ma.filled(self.u_random_ch3a,np.NaN)
-            self.u_random_ch3b = np.ma.filled(self.u_random_ch3b,np.NaN)
-            self.u_random_ch4 = np.ma.filled(self.u_random_ch4,np.NaN)
-            if self.ch5_there:
-                self.u_random_ch5 = np.ma.filled(self.u_random_ch5,np.NaN)
-            self.u_non_random_ch1 = np.ma.filled(self.u_non_random_ch1,np.NaN)
-            self.u_non_random_ch2 = np.ma.filled(self.u_non_random_ch2,np.NaN)
-            if self.ch3a_there:
-                self.u_non_random_ch3a = np.ma.filled(self.u_non_random_ch3a,np.NaN)
-            self.u_non_random_ch3b = np.ma.filled(self.u_non_random_ch3b,np.NaN)
-            self.u_non_random_ch4 = np.ma.filled(self.u_non_random_ch4,np.NaN)
-            if self.ch5_there:
-                self.u_non_random_ch5 = np.ma.filled(self.u_non_random_ch5,np.NaN)
-            self.u_common_ch1 = np.ma.filled(self.u_common_ch1,np.NaN)
-            self.u_common_ch2 = np.ma.filled(self.u_common_ch2,np.NaN)
-            if self.ch3a_there:
-                self.u_common_ch3a = np.ma.filled(self.u_common_ch3a,np.NaN)
-            self.u_common_ch3b = np.ma.filled(self.u_common_ch3b,np.NaN)
-            self.u_common_ch4 = np.ma.filled(self.u_common_ch4,np.NaN)
-            if self.ch5_there:
-                self.u_common_ch5 = np.ma.filled(self.u_common_ch5,np.NaN)
-            self.dBT3_over_dT = np.ma.filled(self.dBT3_over_dT,np.NaN)
-            self.dBT4_over_dT = np.ma.filled(self.dBT4_over_dT,np.NaN)
-            if self.ch5_there:
-                self.dBT5_over_dT = np.ma.filled(self.dBT5_over_dT,np.NaN)
-            self.dRe1_over_dCS = np.ma.filled(self.dRe1_over_dCS,np.NaN)
-            self.dRe2_over_dCS = np.ma.filled(self.dRe2_over_dCS,np.NaN)
-            if self.ch3a_there:
-                self.dRe3a_over_dCS = np.ma.filled(self.dRe3a_over_dCS,np.NaN)
-            self.dBT3_over_dCS = np.ma.filled(self.dBT3_over_dCS,np.NaN)
-            self.dBT4_over_dCS = np.ma.filled(self.dBT4_over_dCS,np.NaN)
-            if self.ch5_there:
-                self.dBT5_over_dCS = np.ma.filled(self.dBT5_over_dCS,np.NaN)
-            self.dBT3_over_dCICT = np.ma.filled(self.dBT3_over_dCICT,np.NaN)
-            self.dBT4_over_dCICT = np.ma.filled(self.dBT4_over_dCICT,np.NaN)
-            if self.ch5_there:
-                self.dBT5_over_dCICT = np.ma.filled(self.dBT5_over_dCICT,np.NaN)
-            self.cal_cnts_noise = np.ma.filled(self.cal_cnts_noise,np.NaN)
-            self.cnts_noise = np.ma.filled(self.cnts_noise,np.NaN)
-
-            if self.montecarlo:
-                self.ch1_MC = np.ma.filled(self.ch1_MC,np.NaN)
-                self.ch2_MC = np.ma.filled(self.ch2_MC,np.NaN)
-                self.ch3a_MC = np.ma.filled(self.ch3a_MC,np.NaN)
-                self.ch3_MC = np.ma.filled(self.ch3_MC,np.NaN)
-                self.ch4_MC = np.ma.filled(self.ch4_MC,np.NaN)
-                self.ch5_MC = np.ma.filled(self.ch5_MC,np.NaN)
-
-        self.lat = self.add_nan_values(self.lat)
-        self.lon = self.add_nan_values(self.lon)
-        self.time = self.add_nan_values(self.time)
-        self.satza = self.add_nan_values(self.satza)
-        self.relaz = self.add_nan_values(self.relaz)
-        self.ch1 = self.add_nan_values(self.ch1)
-        self.ch2 = self.add_nan_values(self.ch2)
-        if self.ch3a_there:
-            self.ch3a = self.add_nan_values(self.ch3a)
-        self.ch3b = self.add_nan_values(self.ch3b)
-        self.ch4 = self.add_nan_values(self.ch4)
-        if self.ch5_there:
-            self.ch5 = self.add_nan_values(self.ch5)
-        self.u_random_ch1 = self.add_nan_values(self.u_random_ch1)
-        self.u_random_ch2 = self.add_nan_values(self.u_random_ch2)
-        if self.ch3a_there:
-            self.u_random_ch3a = self.add_nan_values(self.u_random_ch3a)
-        self.u_random_ch3b = self.add_nan_values(self.u_random_ch3b)
-        self.u_random_ch4 = self.add_nan_values(self.u_random_ch4)
-        if self.ch5_there:
-            self.u_random_ch5 = self.add_nan_values(self.u_random_ch5)
-        self.u_non_random_ch1 = self.add_nan_values(self.u_non_random_ch1)
-        self.u_non_random_ch2 = self.add_nan_values(self.u_non_random_ch2)
-        if self.ch3a_there:
-            self.u_non_random_ch3a = self.add_nan_values(self.u_non_random_ch3a)
-        self.u_non_random_ch3b = self.add_nan_values(self.u_non_random_ch3b)
-        self.u_non_random_ch4 = self.add_nan_values(self.u_non_random_ch4)
-        if self.ch5_there:
-            self.u_non_random_ch5 = self.add_nan_values(self.u_non_random_ch5)
-        self.u_common_ch1 = self.add_nan_values(self.u_common_ch1)
-        self.u_common_ch2 = self.add_nan_values(self.u_common_ch2)
-        if self.ch3a_there:
-            self.u_common_ch3a = self.add_nan_values(self.u_common_ch3a)
-        self.u_common_ch3b = self.add_nan_values(self.u_common_ch3b)
-        self.u_common_ch4 = self.add_nan_values(self.u_common_ch4)
-        if self.ch5_there:
-            self.u_common_ch5 = self.add_nan_values(self.u_common_ch5)
-        self.dBT3_over_dT = self.add_nan_values(self.dBT3_over_dT)
-        self.dBT4_over_dT = self.add_nan_values(self.dBT4_over_dT)
-        if self.ch5_there:
-            self.dBT5_over_dT = self.add_nan_values(self.dBT5_over_dT)
-        self.dRe1_over_dCS = self.add_nan_values(self.dRe1_over_dCS)
-        self.dRe2_over_dCS = self.add_nan_values(self.dRe2_over_dCS)
-        if self.ch3a_there:
-            self.dRe3a_over_dCS = self.add_nan_values(self.dRe3a_over_dCS)
-        self.dBT3_over_dCS = self.add_nan_values(self.dBT3_over_dCS)
-        self.dBT4_over_dCS = self.add_nan_values(self.dBT4_over_dCS)
-        if self.ch5_there:
-            self.dBT5_over_dCS = self.add_nan_values(self.dBT5_over_dCS)
-        self.dBT3_over_dCICT = self.add_nan_values(self.dBT3_over_dCICT)
-        self.dBT4_over_dCICT = self.add_nan_values(self.dBT4_over_dCICT)
-        if self.ch5_there:
-            self.dBT5_over_dCICT = self.add_nan_values(self.dBT5_over_dCICT)
-        self.cal_cnts_noise = self.add_nan_values(self.cal_cnts_noise)
-        self.cnts_noise = self.add_nan_values(self.cnts_noise)
-        self.ch3b_harm = self.add_nan_values(self.ch3b_harm)
-        self.ch4_harm = self.add_nan_values(self.ch4_harm)
-        self.ch5_harm = self.add_nan_values(self.ch5_harm)
-
-        if self.montecarlo:
-            self.ch1_MC = self.add_nan_values(self.ch1_MC)
-            self.ch2_MC = self.add_nan_values(self.ch2_MC)
-            self.ch3a_MC = self.add_nan_values(self.ch3a_MC)
-            self.ch3_MC = self.add_nan_values(self.ch3_MC)
-            self.ch4_MC = self.add_nan_values(self.ch4_MC)
-            self.ch5_MC = self.add_nan_values(self.ch5_MC)
-
-#        self.ch1 = self.scale_values(self.ch1)
-#        self.ch2 = self.scale_values(self.ch2)
-#        if self.ch3a_there:
-#            self.ch3a = self.scale_values(self.ch3a)
-#        self.u_random_ch1 = self.scale_values(self.u_random_ch1)
-#        self.u_random_ch2 = self.scale_values(self.u_random_ch2)
-#        if self.ch3a_there:
-#            self.u_random_ch3a = self.scale_values(self.u_random_ch3a)
-#        self.u_non_random_ch1 = self.scale_values(self.u_non_random_ch1)
-#        self.u_non_random_ch2 = self.scale_values(self.u_non_random_ch2)
-#        if self.ch3a_there:
-#            self.u_non_random_ch3a = self.scale_values(self.u_non_random_ch3a)
-
-        gd = np.zeros(len(self.time),dtype=np.bool)
-        gd[:] = True
-        for i in range(len(self.time)):
-            if self.time[i] < 0:
-                gd[i] = False
-            else:
-                break
-        for i in range(len(self.time)-1,0,-1):
-            if self.time[i] < 0:
-                gd[i] = False
-            else:
-                break
-        if np.sum(gd) == 0:
+        #
+        # Remove bad times from the start and end of the orbit
+        #
+        good = np.where(self.time >= 0)[0]
+        if len(good) == 0:
             raise Exception("cannot find good times")
+        self.lines = slice(good[0],good[-1]+1)
 
-        self.time = self.time[gd]
+        self.time = self.time[self.lines]
         ggd = (self.time < 0)
         if np.sum(ggd) > 0:
             self.time[ggd] = float('nan')
-        date_time=[]
-        for i in range(len(gd)):
-            if gd[i]:
-                date_time.append(self.date_time[i])
-        self.date_time = date_time[:]
-        self.lat = self.lat[gd,:]
-        self.lon = self.lon[gd,:]
-        self.satza = self.satza[gd,:]
-        self.solza = self.solza[gd,:]
-        self.relaz = self.relaz[gd,:]
-        self.ch1 = self.ch1[gd,:]
-        self.ch2 = self.ch2[gd,:]
-        self.ch3a = self.ch3a[gd,:]
-        self.ch3a_there_int = self.ch3a_there_int[gd]
-        self.ch3b = self.ch3b[gd,:]
-        self.ch4 = self.ch4[gd,:]
-        if self.ch5_there:
-            self.ch5 = self.ch5[gd,:]
-
-        self.u_random_ch1 = self.u_random_ch1[gd,:]
-        self.u_random_ch2 = self.u_random_ch2[gd,:]
-        if self.ch3a_there:
-            self.u_random_ch3a = self.u_random_ch3a[gd,:]
-        self.u_random_ch3b = self.u_random_ch3b[gd,:]
-        self.u_random_ch4 = self.u_random_ch4[gd,:]
-        if self.ch5_there:
-            self.u_random_ch5 = self.u_random_ch5[gd,:]
-
-        self.u_non_random_ch1 = self.u_non_random_ch1[gd,:]
-        self.u_non_random_ch2 = self.u_non_random_ch2[gd,:]
-        if self.ch3a_there:
-            self.u_non_random_ch3a = self.u_non_random_ch3a[gd,:]
-        self.u_non_random_ch3b = self.u_non_random_ch3b[gd,:]
-        self.u_non_random_ch4 = self.u_non_random_ch4[gd,:]
-        if self.ch5_there:
-            self.u_non_random_ch5 = self.u_non_random_ch5[gd,:]
-
-        self.u_common_ch1 = self.u_common_ch1[gd,:]
-        self.u_common_ch2 = self.u_common_ch2[gd,:]
-        if self.ch3a_there:
-            self.u_common_ch3a = self.u_common_ch3a[gd,:]
-        self.u_common_ch3b = self.u_common_ch3b[gd,:]
-        self.u_common_ch4 = self.u_common_ch4[gd,:]
-        if self.ch5_there:
-            self.u_common_ch5 = self.u_common_ch5[gd,:]
-
-        self.scan_qual = self.scan_qual[gd]
-        self.chan_qual = self.chan_qual[gd,:]
-
-        self.dBT3_over_dT = self.dBT3_over_dT[gd,:]
-        self.dBT4_over_dT = self.dBT4_over_dT[gd,:]
-        if self.ch5_there:
-            self.dBT5_over_dT = self.dBT5_over_dT[gd,:]
-
-        self.dRe1_over_dCS = self.dRe1_over_dCS[gd,:]
-        self.dRe2_over_dCS = self.dRe2_over_dCS[gd,:]
-        if self.ch3a_there:
-            self.dRe3a_over_dCS = self.dRe3a_over_dCS[gd,:]
-        self.dBT3_over_dCS = self.dBT3_over_dCS[gd,:]
-        self.dBT4_over_dCS = self.dBT4_over_dCS[gd,:]
-        if self.ch5_there:
-            self.dBT5_over_dCS = self.dBT5_over_dCS[gd,:]
-
-        self.dBT3_over_dCICT = self.dBT3_over_dCICT[gd,:]
-        self.dBT4_over_dCICT = self.dBT4_over_dCICT[gd,:]
-        if self.ch5_there:
-            self.dBT5_over_dCICT = self.dBT5_over_dCICT[gd,:]
-
-        self.smoothPRT = self.smoothPRT[gd]
-        self.scanline = self.scanline[gd]
-        self.orig_scanline = self.orig_scanline[gd]
-        self.ch3b_harm = self.ch3b_harm[gd,:]
-        self.ch4_harm = self.ch4_harm[gd,:]
-        self.ch5_harm = self.ch5_harm[gd,:]
-
-        self.badNav = self.badNav[gd]
-        self.badCal = self.badCal[gd]
-        self.badTime = self.badTime[gd]
-        self.missingLines = self.missingLines[gd]
-        self.solar3 = self.solar3[gd]
-        self.solar4 = self.solar4[gd]
-        self.solar5 = self.solar5[gd]
-
-        self.nx = self.lat.shape[1]
-        self.ny = self.lat.shape[0]
-
-        if self.montecarlo:
-            self.ch1_MC = self.ch1_MC[:,gd,:]
-            self.ch2_MC = self.ch2_MC[:,gd,:]
-            self.ch3a_MC = self.ch3a_MC[:,gd,:]
-            self.ch3_MC = self.ch3_MC[:,gd,:]
-            self.ch4_MC = self.ch4_MC[:,gd,:]
-            self.ch5_MC = self.ch5_MC[:,gd,:]
-            self.nmc = self.ch1_MC.shape[0]
+        self.date_time = self.date_time[self.lines]
+        self.ch3a_there_int = self.ch3a_there_int[self.lines]
+
+        self.nx = ncid.variables['latitude'].shape[1]
+        self.ny = len(self.time)
 
     def __init__(self,filename):
 
+        self.ncid = None
         self.read_data(filename)
 #
 # Run Gerrits CURUC routines
@@ -474,271 +384,58 @@ def set_to_nan(TL):
     return TL
 
 #
-# Copy over to sensitivity using the coords (xarray) arrays
+# Transposes from the (channel,line,element) stack to each CURUC layout
 #
-def copy_over_C(inarray,n_l_coord,n_e_coord,inverse=False,string=''):
-
-    nbad = 0
-    nbad_orig = 0
-    if inverse:
-        outarray = np.zeros((len(n_e_coord.values),len(n_l_coord.values)))
-        for i in range(len(n_l_coord.values)):
-            outarray[:,i] = np.copy(inarray[n_l_coord.values[i],n_e_coord.values])
-    else:
-        outarray = np.zeros((len(n_l_coord.values),len(n_e_coord.values)))
-        for i in range(len(n_l_coord.values)):
-            outarray[i,:] = np.copy(inarray[n_l_coord.values[i],n_e_coord.values])
-    return outarray
+#    chan          : n_c, n_l, n_e (C_xelem_s)
+#    chan_inverse  : n_c, n_e, n_l (C_xline_s)
+#    xchan         : n_l, n_e, n_c (C_xchan_s/C_xchan_i)
+#    xchan_inverse : n_e, n_l, n_c
+#
+gather_layouts = {'chan':(0,1,2),'chan_inverse':(0,2,1),\
+                      'xchan':(1,2,0),'xchan_inverse':(2,1,0)}
 
 #
-# Do copy in a block and deal with different channel selection
+# Gather (line,element) arrays onto the CURUC grid for a set of channels.
+# arrays maps channel number to its array and n_l/n_e are the CURUC
+# (xarray) coordinates.  If out is given (e.g. a slice of C_xelem_s.values)
+# the values are written straight into it, otherwise a new array is made
 #
-def copy_C3(dBT3_over_dX,dBT4_over_dX,dBT5_over_dX,\
-                n_l,n_e,chans,inverse=False,xchan=False):
-
-    if xchan:
-        if inverse:
-            output = np.zeros((len(n_e),len(n_l),len(chans)))
-            for i in range(len(chans)):
-                if 3 == chans[i]:
-                    output[:,:,i] = copy_over_C(dBT3_over_dX,n_l,n_e,inverse=True,\
-                                                    string='dBT3_over_dX xchan inverse')
-                elif 4 == chans[i]:
-                    output[:,:,i] = copy_over_C(dBT4_over_dX,n_l,n_e,inverse=True,\
-                                                    string='dBT3_over_dX xchan inverse')
-                elif 5 == chans[i]:
-                    output[:,:,i] = copy_over_C(dBT5_over_dX,n_l,n_e,inverse=True,\
-                                                    string='dBT3_over_dX xchan inverse')
-        else:
-            output = np.zeros((len(n_l),len(n_e),len(chans)))
-            for i in range(len(chans)):
-                if 3 == chans[i]:
-                    output[:,:,i] = copy_over_C(dBT3_over_dX,n_l,n_e,\
-                                                    string='dBT3_over_dX xchan')
-                elif 4 == chans[i]:
-                    output[:,:,i] = copy_over_C(dBT4_over_dX,n_l,n_e,\
-                                                    string='dBT3_over_dX xchan')
-                elif 5 == chans[i]:
-                    output[:,:,i] = copy_over_C(dBT5_over_dX,n_l,n_e,\
-                                                    string='dBT3_over_dX xchan')
-    else:
-        if inverse:
-            output = np.zeros((len(chans),len(n_e),len(n_l)))
-            for i in range(len(chans)):
-                if 3 == chans[i]:
-                    output[i,:,:] = copy_over_C(dBT3_over_dX,n_l,n_e,inverse=True,\
-                                                    string='dBT3_over_dX not xchan inverse')
-                elif 4 == chans[i]:
-                    output[i,:,:] = copy_over_C(dBT4_over_dX,n_l,n_e,inverse=True,\
-                                                    string='dBT3_over_dX not xchan inverse')
-                elif 5 == chans[i]:
-                    output[i,:,:] = copy_over_C(dBT5_over_dX,n_l,n_e,inverse=True,\
-                                                    string='dBT3_over_dX not xchan inverse')
-        else:
-            output = np.zeros((len(chans),len(n_l),len(n_e)))
-            for i in range(len(chans)):
-                if 3 == chans[i]:
-                    output[i,:,:] = copy_over_C(dBT3_over_dX,n_l,n_e,\
-                                                    string='dBT3_over_dX not xchan')
-                elif 4 == chans[i]:
-                    output[i,:,:] = copy_over_C(dBT4_over_dX,n_l,n_e,\
-                                                    string='dBT3_over_dX not xchan')
-                elif 5 == chans[i]:
-                    output[i,:,:] = copy_over_C(dBT5_over_dX,n_l,n_e,\
-                                                    string='dBT3_over_dX not xchan')
-                    
-    return output
-#
-# No 12 micron channel case
-#
-def copy_C2(dBT3_over_dX,dBT4_over_dX,\
-                n_l,n_e,chans,inverse=False,xchan=False,ch3a=False):
-
-    if ch3a:
-        if xchan:
-            if inverse:
-                output = np.zeros((len(n_e),len(n_l),len(chans)))
-                for i in range(len(chans)):
-                    if 4 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT3_over_dX,n_l,n_e,inverse=True)
-                    elif 5 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT4_over_dX,n_l,n_e,inverse=True)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
-            else:
-                output = np.zeros((len(n_l),len(n_e),len(chans)))
-                for i in range(len(chans)):
-                    if 4 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT3_over_dX,n_l,n_e)
-                    elif 5 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT4_over_dX,n_l,n_e)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
-        else:
-            if inverse:
-                output = np.zeros((len(chans),len(n_e),len(n_l)))
-                for i in range(len(chans)):
-                    if 4 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT3_over_dX,n_l,n_e,inverse=True)
-                    elif 5 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT4_over_dX,n_l,n_e,inverse=True)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
-            else:
-                output = np.zeros((len(chans),len(n_l),len(n_e)))
-                for i in range(len(chans)):
-                    if 4 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT3_over_dX,n_l,n_e)
-                    elif 5 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT4_over_dX,n_l,n_e)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
-    else:
-        if xchan:
-            if inverse:
-                output = np.zeros((len(n_e),len(n_l),len(chans)))
-                for i in range(len(chans)):
-                    if 3 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT3_over_dX,n_l,n_e,inverse=True)
-                    elif 4 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT4_over_dX,n_l,n_e,inverse=True)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
-            else:
-                output = np.zeros((len(n_l),len(n_e),len(chans)))
-                for i in range(len(chans)):
-                    if 3 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT3_over_dX,n_l,n_e)
-                    elif 4 == chans[i]:
-                        output[:,:,i] = copy_over_C(dBT4_over_dX,n_l,n_e)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
-        else:
-            if inverse:
-                output = np.zeros((len(chans),len(n_e),len(n_l)))
-                for i in range(len(chans)):
-                    if 3 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT3_over_dX,n_l,n_e,inverse=True)
-                    elif 4 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT4_over_dX,n_l,n_e,inverse=True)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
-            else:
-                output = np.zeros((len(chans),len(n_l),len(n_e)))
-                for i in range(len(chans)):
-                    if 3 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT3_over_dX,n_l,n_e)
-                    elif 4 == chans[i]:
-                        output[i,:,:] = copy_over_C(dBT4_over_dX,n_l,n_e)
-                    else:
-                        print('chans:',chans)
-                        raise Exception('chans out of range in copy_C2')
+def gather_C(arrays,chans,n_l,n_e,layout='chan',out=None):
 
-    return output
+    try:
+        order = gather_layouts[layout]
+    except KeyError:
+        raise Exception('Unknown layout in gather_C: {0}'.format(layout))
+    index = np.ix_(np.asarray(n_l),np.asarray(n_e))
+    shape = (len(chans),len(n_l),len(n_e))
+    if out is None:
+        out = np.zeros([shape[i] for i in order])
+    #
+    # View of out in (channel,line,element) order
+    #
+    stack = out.transpose(np.argsort(order))
+    for i in range(len(chans)):
+        if chans[i] not in arrays:
+            print('chans:',chans)
+            raise Exception('chans out of range in gather_C')
+        stack[i,:,:] = np.ma.getdata(arrays[chans[i]])[index]
 
-#
-# Visible channel case - only from CS data
-#
+    return out
 
 #
-# Do copy in a block and deal with different channel selection
+# Sensitivities for each channel for a given effect (T, CS or CICT).
+# Visible channels only have the CS effect
 #
-def copy_C3_vis(dRe1_over_dCS,dRe2_over_dCS,dRe3a_over_dCS,\
-                n_l,n_e,chans,inverse=False,xchan=False):
+def curuc_sensitivities(data,chans,effect):
 
-    if xchan:
-        if inverse:
-            output = np.zeros((len(n_e),len(n_l),len(chans)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe1_over_dCS,n_l,n_e,inverse=True)
-                elif 1 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe2_over_dCS,n_l,n_e,inverse=True)
-                elif 2 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe3a_over_dCS,n_l,n_e,inverse=True)
-        else:
-            output = np.zeros((len(n_l),len(n_e),len(chans)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe1_over_dCS,n_l,n_e)
-                elif 1 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe2_over_dCS,n_l,n_e)
-                elif 2 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe3a_over_dCS,n_l,n_e)
-    else:
-        if inverse:
-            output = np.zeros((len(chans),len(n_e),len(n_l)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe1_over_dCS,n_l,n_e,inverse=True)
-                elif 1 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe2_over_dCS,n_l,n_e,inverse=True)
-                elif 2 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe3a_over_dCS,n_l,n_e,inverse=True)
-        else:
-            output = np.zeros((len(chans),len(n_l),len(n_e)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe1_over_dCS,n_l,n_e)
-                elif 1 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe2_over_dCS,n_l,n_e)
-                elif 2 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe3a_over_dCS,n_l,n_e)
-                    
-    return output
-#
-# No 1.6 micron channel case
-#
-def copy_C2_vis(dRe1_over_dCS,dRe2_over_dCS,\
-                n_l,n_e,chans,inverse=False,xchan=False):
-
-    if xchan:
-        if inverse:
-            output = np.zeros((len(n_e),len(n_l),len(chans)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe1_over_dCS,n_l,n_e,inverse=True)
-                elif 1 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe2_over_dCS,n_l,n_e,inverse=True)
-                else:
-                    raise Exception('chans out of range in copy_C2_vis')
-        else:
-            output = np.zeros((len(n_l),len(n_e),len(chans)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe1_over_dCS,n_l,n_e)
-                elif 1 == chans[i]:
-                    output[:,:,i] = copy_over_C(dRe2_over_dCS,n_l,n_e)
-                else:
-                    raise Exception('chans out of range in copy_C2_vis')
-    else:
-        if inverse:
-            output = np.zeros((len(chans),len(n_e),len(n_l)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe1_over_dCS,n_l,n_e,inverse=True)
-                elif 1 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe2_over_dCS,n_l,n_e,inverse=True)
-                else:
-                    raise Exception('chans out of range in copy_C2_vis')
-        else:
-            output = np.zeros((len(chans),len(n_l),len(n_e)))
-            for i in range(len(chans)):
-                if 0 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe1_over_dCS,n_l,n_e)
-                elif 1 == chans[i]:
-                    output[i,:,:] = copy_over_C(dRe2_over_dCS,n_l,n_e)
-                else:
-                    raise Exception('chans out of range in copy_C2_vis')
+    names = {0:'dRe1_over_dCS',1:'dRe2_over_dCS',2:'dRe3a_over_dCS',\
+                 3:'dBT3_over_d'+effect,4:'dBT4_over_d'+effect,\
+                 5:'dBT5_over_d'+effect}
+    arrays = {}
+    for chan in chans:
+        arrays[chan] = getattr(data,names[chan])
 
-    return output
+    return arrays
 
 #
 # Check for bad data at the array level
@@ -759,41 +456,48 @@ def check_for_bad_data_TL(array):
         return True
 
 #
-# Check for bad data to mask out in CURUC routines
+# Check for bad data on the sampled (lines,elems) grid for all lines at
+# once.  Same test as check_for_bad_data_TL - a line is bad if it has
+# non-finite values or values < -1e20 or any masked values
+#
+def check_for_bad_lines(lines,elems,array):
+
+    subarray = array[np.ix_(lines,elems)]
+    values = np.ma.getdata(subarray)
+    with np.errstate(invalid='ignore'):
+        bad = ~np.isfinite(values) | (values < -1e20)
+    bad = bad | np.ma.getmaskarray(subarray)
+
+    return np.any(bad,axis=1)
+
+#
+# Check for bad data to mask out in CURUC routines.  Returns the index
+# (into lines) of lines with bad quality or bad data in any of arrays
 #
+def check_bad_data(lines,elems,quality,arrays):
+
+    lines = np.asarray(lines)
+    elems = np.asarray(elems)
+    bad = (np.asarray(quality)[lines] > 0)
+    for array in arrays:
+        bad = bad | check_for_bad_lines(lines,elems,array)
+
+    return np.where(bad)[0].astype(np.int32)
+
 def check_bad_data_5(lines,elems,quality,dBT3_over_dT,dBT4_over_dT,\
                          dBT5_over_dT,dBT3_over_dCS,\
                          dBT4_over_dCS,dBT5_over_dCS,\
                          dBT3_over_dCICT,dBT4_over_dCICT,\
                          dBT5_over_dCICT,single=False):
 
-    index = np.zeros(len(lines),dtype=np.int32)
-    
-    j=0
-    for i in range(len(lines)): 
-        if not single:
-            test = (quality[lines[i]] > 0) or \
-                check_for_bad_data_TL(dBT3_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT5_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT3_over_dCS[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dCS[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT5_over_dCS[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT3_over_dCICT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dCICT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT5_over_dCICT[lines[i],elems])
-        else:
-            test = (quality[lines[i]] > 0) or \
-                check_for_bad_data_TL(dBT3_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT5_over_dT[lines[i],elems])
-        if test:
-            index[j] = i
-            j=j+1
-
-    index = index[0:j]
+    if single:
+        arrays = [dBT3_over_dT,dBT4_over_dT,dBT5_over_dT]
+    else:
+        arrays = [dBT3_over_dT,dBT4_over_dT,dBT5_over_dT,\
+                      dBT3_over_dCS,dBT4_over_dCS,dBT5_over_dCS,\
+                      dBT3_over_dCICT,dBT4_over_dCICT,dBT5_over_dCICT]
 
-    return index
+    return check_bad_data(lines,elems,quality,arrays)
 
 def check_bad_data_no5(lines,elems,quality,dBT3_over_dT,dBT4_over_dT,\
                          dBT3_over_dCS,\
@@ -801,154 +505,101 @@ def check_bad_data_no5(lines,elems,quality,dBT3_over_dT,dBT4_over_dT,\
                          dBT3_over_dCICT,dBT4_over_dCICT,\
                          single=False):
 
-    index = np.zeros(len(lines),dtype=np.int32)
-    
-    j=0
-    for i in range(len(lines)): 
-        if not single:
-            test = (quality[lines[i]] > 0) or \
-                check_for_bad_data_TL(dBT3_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT3_over_dCS[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dCS[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT3_over_dCICT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dCICT[lines[i],elems])
-        else:
-            test = (quality[lines[i]] > 0) or \
-                check_for_bad_data_TL(dBT3_over_dT[lines[i],elems]) or \
-                check_for_bad_data_TL(dBT4_over_dT[lines[i],elems])
-        if test:
-            index[j] = i
-            j=j+1
-
-    index = index[0:j]
+    if single:
+        arrays = [dBT3_over_dT,dBT4_over_dT]
+    else:
+        arrays = [dBT3_over_dT,dBT4_over_dT,dBT3_over_dCS,dBT4_over_dCS,\
+                      dBT3_over_dCICT,dBT4_over_dCICT]
 
-    return index
+    return check_bad_data(lines,elems,quality,arrays)
 
 def check_bad_data_3(lines,elems,quality,\
                          dRe1_over_dCS,\
                          dRe2_over_dCS,\
                          dRe3_over_dCS):
 
-    index = np.zeros(len(lines),dtype=np.int32)
-    
-    j=0
-    for i in range(len(lines)): 
-        test = (quality[lines[i]] > 0) or \
-            check_for_bad_data_TL(dRe1_over_dCS[lines[i],elems]) or \
-            check_for_bad_data_TL(dRe2_over_dCS[lines[i],elems]) or \
-            check_for_bad_data_TL(dRe3_over_dCS[lines[i],elems]) 
-        if test:
-            index[j] = i
-            j=j+1
-
-    index = index[0:j]
-
-    return index
+    return check_bad_data(lines,elems,quality,\
+                              [dRe1_over_dCS,dRe2_over_dCS,dRe3_over_dCS])
 
 def check_bad_data_no3(lines,elems,quality,\
                          dRe1_over_dCS,\
                          dRe2_over_dCS):
 
-    index = np.zeros(len(lines),dtype=np.int32)
-    
-    j=0
-    for i in range(len(lines)): 
-        test = (quality[lines[i]] > 0) or \
-            check_for_bad_data_TL(dRe1_over_dCS[lines[i],elems]) or \
-            check_for_bad_data_TL(dRe2_over_dCS[lines[i],elems]) 
-        if test:
-            index[j] = i
-            j=j+1
-
-    index = index[0:j]
-
-    return index
+    return check_bad_data(lines,elems,quality,[dRe1_over_dCS,dRe2_over_dCS])
 
 #
 # Replace bad lines with NaNs
 #
 def replace_NaN_ind(array,mask,datatype=1):
 
-    if datatype == 1:
-        for i in range(array.values.shape[0]):
-            if mask[i]:
-                array.values[i,:,:,:] = float('nan')
-    elif datatype == 2:
-        for i in range(array.values.shape[1]):
-            if mask[i]:
-                array.values[:,i,:,:] = float('nan')
-    elif datatype == 3:
-        for i in range(array.values.shape[2]):
-            if mask[i]:
-                array.values[:,:,i,:] = float('nan')
-    elif datatype == 4:
-        for i in range(array.values.shape[3]):
-            if mask[i]:
-                array.values[:,:,:,i] = float('nan')
+    index = [slice(None)]*array.values.ndim
+    index[datatype-1] = np.asarray(mask,dtype=bool)
+    array.values[tuple(index)] = float('nan')
 
     return array
-                            
+
+#
+# Axis the TINY replacement median is taken along for each datatype
+#
+tiny_axes = {1:3,2:2,3:1}
+
+#
+# Median of each row using only values where keep is set - matches
+# np.median of the kept values (NaN if any kept value is NaN)
+#
+def kept_median(rows,keep):
+
+    nkeep = np.sum(keep,axis=1)
+    nan = np.any(keep & np.isnan(rows),axis=1)
+    rows = np.sort(np.where(keep,rows,float('nan')),axis=1)
+    index = np.arange(rows.shape[0])
+    median = (rows[index,(nkeep-1)//2]+rows[index,nkeep//2])*0.5
+    median[nan] = float('nan')
+
+    return median
+
 #
 # Replace TINY for individual array and then replace bad lines with NaNs
 #
 def replace_TINY_ind(array,derivative=None,derivative_there=False,datatype=1,\
                          datatype_nan=1,mask=None,outprint=None):
 
-    if 1 == datatype:
-        for i in range(array.values.shape[0]):
-            for j in range(array.values.shape[1]):
-                for k in range(array.values.shape[2]):                    
-                    testarray = array.values[i,j,k,:]
-                    if derivative_there:
-                        derarray = derivative.values[i,j,k,:]
-                        gd = (derarray == 1e-10)
-                    else:
-                        gd = (testarray == 1e-10)
-                    if np.sum(gd) > 0:
-                        gd2 = (testarray != 1e-10)
-                        if np.sum(gd2) > 0:
-                            newarray = testarray[gd2]
-                            array.values[i,j,k,:] = np.median(newarray)
-    elif 2 == datatype:
-        for i in range(array.values.shape[0]):
-            for j in range(array.values.shape[1]):
-                for k in range(array.values.shape[3]):
-                    testarray = array.values[i,j,:,k]
-                    if derivative_there:
-                        derarray = derivative.values[i,j,:,k]
-                        gd = (derarray == 1e-10)
-                    else:
-                        gd = (testarray == 1e-10)
-                    if np.sum(gd) > 0:
-                        gd2 = (testarray != 1e-10)
-                        if np.sum(gd2) > 0:
-                            newarray = testarray[gd2]
-                            array.values[i,j,:,k] = np.median(newarray)
-    elif 3 == datatype:
-        for i in range(array.values.shape[0]):
-            for j in range(array.values.shape[2]):
-                for k in range(array.values.shape[3]):
-                    testarray = array.values[i,:,j,k]
-                    if derivative_there:
-                        #
-                        # Note that for some reason the shape of the derivative
-                        # in this case is different, so different ordering
-                        #
-                        derarray = derivative.values[j,i,:,k]
-                        gd = (derarray == 1e-10)
-                    else:
-                        gd = (testarray == 1e-10)
-                    if np.sum(gd) > 0:
-                        gd2 = (testarray != 1e-10)
-                        if np.sum(gd2) > 0:
-                            newarray = testarray[gd2]
-                            array.values[i,:,j,k] = np.median(newarray)
+    if datatype in tiny_axes:
+        #
+        # Work on a view with the median axis last
+        #
+        axis = tiny_axes[datatype]
+        values = np.moveaxis(array.values,axis,-1)
+        if derivative_there:
+            derarray = derivative.values
+            if 3 == datatype:
+                #
+                # Note that for some reason the shape of the derivative
+                # in this case is different, so different ordering
+                #
+                derarray = derarray.transpose(1,2,0,3)
+            derarray = np.moveaxis(derarray,axis,-1)
+        else:
+            derarray = values
+        #
+        # TINY in the precision of the arrays
+        #
+        tiny = (values == values.dtype.type(1e-10))
+        #
+        # Replace whole line with median of non-TINY values if there is a
+        # TINY value (in the derivative if there)
+        #
+        gd = np.any(derarray == derarray.dtype.type(1e-10),axis=-1) & \
+            ~np.all(tiny,axis=-1)
+        if np.sum(gd) > 0:
+            newvalues = kept_median(values[gd],~tiny[gd])
+            values[gd] = newvalues[:,np.newaxis]
 
     #
     # Anything < -1e20 with nans
     #
-    gd = (array.values < -1e20)
+    with np.errstate(invalid='ignore'):
+        gd = (array.values < -1e20)
     if np.sum(gd) > 0:
         array.values[gd] = float('nan')
 
@@ -1056,6 +707,115 @@ def plot_hist(datum,mask,title,subplot,datatype):
     if np.sum(gd) > 0:
         print('There are ZEROs present')
 
+#
+# Number of structured and independent effects in a CURUC run
+#
+def curuc_neffects(vis_chans,common):
+
+    #
+    # Define number of structured and common effects to deal with (common 
+    # effects for channel to channel only)
+    #
+    if vis_chans:
+        # CS only
+        neffects_s = 1
+    else:
+        if common:
+            # ICT T and Harmonisation
+            neffects_s = 2
+        else:
+            # CS, CICT, ICT T
+            neffects_s = 3
+    # Noise
+    neffects_i = 1
+
+    return neffects_s, neffects_i
+
+#
+# Rough estimate of the memory (bytes) used by a CURUC run - dominated by
+# the cross line correlation matrices (n_l x n_l for each effect, channel
+# and sampled element).  Doubled to allow for the apply_curuc workspace
+#
+def curuc_memory(nchans,nlines,nelems,vis_chans=False,common=False,\
+                     line_skip=5,elem_skip=25,dtype=np.float64):
+
+    neffects_s, neffects_i = curuc_neffects(vis_chans,common)
+    neffects = neffects_s+neffects_i
+    n_l = (nlines+line_skip-1)//line_skip
+    n_e = (nelems+elem_skip-1)//elem_skip
+    nvalues = neffects_s*nchans*n_e*n_l*n_l + \
+        neffects_s*nchans*n_l*n_e*n_e + \
+        neffects*n_l*n_e*nchans*nchans + \
+        2*neffects*nchans*n_l*n_e
+
+    return 2*np.dtype(dtype).itemsize*nvalues
+
+#
+# Cross line correlation template (n_l x n_l) - triangular within the
+# spatial correlation scale N
+#
+@functools.lru_cache(maxsize=16)
+def curuc_line_template(n_l,N,line_skip,dtype=np.float64):
+
+    Temp_array = np.zeros((n_l,n_l),dtype=dtype)
+
+    Nsize = N//line_skip
+    step_size = line_skip*1./N
+
+    for step in range(-Nsize,Nsize+1):
+        diagonal = np.diagonal(Temp_array,step)
+        diagonal.setflags(write=True)
+        diagonal[:] = 1.-np.abs(step)*step_size
+
+    Temp_array.setflags(write=False)
+
+    return Temp_array
+
+#
+# Cross channel (systematic) template (effect x chan x chan)
+#
+# Set cross channel only for effect which is cross channel
+# Other effects have Identity matrix
+# Take into account visible channels which are not correlated with
+# the first effect (Tict)
+# Diagnonal for the vis chans, full matrix for the IR chans
+#
+@functools.lru_cache(maxsize=16)
+def curuc_chan_template(neffects_s,nchans,vis_chans,dtype=np.float64):
+
+    Temp_array = np.zeros((neffects_s,nchans,nchans),dtype=dtype)
+    if vis_chans:
+        Temp_array[0,:,:] = np.identity(nchans)
+    else:
+        #
+        # Note that Harmonisation (and the other effects) are uncorrelated
+        # in channel space
+        #
+        Temp_array[0,:,:] = 1
+        Temp_array[1:,:,:] = np.identity(nchans)[np.newaxis,:,:]
+
+    Temp_array.setflags(write=False)
+
+    return Temp_array
+
+#
+# Replace a CURUC array by a read-only broadcast view of a template
+#
+def broadcast_template(array,template):
+
+    return array.copy(deep=False,\
+                          data=np.broadcast_to(template,array.shape))
+
+#
+# Replace an (unfilled) CURUC buffer by one of the requested precision
+#
+def curuc_buffer(array,dtype):
+
+    if array.dtype == dtype:
+        return array
+
+    return array.copy(deep=False,data=np.zeros(array.shape,dtype=dtype))
+
 #
 # Set 1's for bad scanline quality
 #
@@ -1073,7 +833,19 @@ def bad_scan_quality(scan_qual):
     return out_scan
 
 def run_CURUC(data,inchans,vis_chans=False,common=False,\
-                  line_skip=5,elem_skip=25,ch3a_version=False):
+                  line_skip=5,elem_skip=25,ch3a_version=False,\
+                  block_lines=None,dtype=np.float64,diag_file=None):
+
+    #
+    # Long orbits can be run in blocks of scanlines to bound memory
+    #
+    if block_lines is not None and data.ny > block_lines:
+        return run_CURUC_blocked(data,inchans,vis_chans=vis_chans,\
+                                     common=common,line_skip=line_skip,\
+                                     elem_skip=elem_skip,\
+                                     ch3a_version=ch3a_version,\
+                                     block_lines=block_lines,dtype=dtype,\
+                                     diag_file=diag_file)
 
     #
     # Check chans in right order - note chans goes from 0 to 5
@@ -1094,24 +866,13 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
     #
     # Just noise for the independent effect
     #
-    nlines = data.ch1.shape[0]
-    nelems = data.ch1.shape[1]
+    nlines = data.ny
+    nelems = data.nx
     #
     # Define number of structured and common effects to deal with (common 
     # effects for channel to channel only)
     #
-    if vis_chans:
-        # CS only
-        neffects_s = 1
-    else:
-        if common:
-            # ICT T and Harmonisation
-            neffects_s = 2
-        else:
-            # CS, CICT, ICT T
-            neffects_s = 3
-    # Noise
-    neffects_i = 1
+    neffects_s, neffects_i = curuc_neffects(vis_chans,common)
     nchans = len(chans)
     R_xelem_s, R_xline_s, R_xchan_i, R_xchan_s,\
         U_xelem_s, U_xline_s, U_xchan_s, U_xchan_i,\
@@ -1119,64 +880,53 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
         met.allocate_curuc(nchans,nlines,nelems,neffects_s,neffects_i,\
                                line_skip,elem_skip)
 
+    #
+    # Uncertainty and sensitivity buffers in the requested precision
+    # (float32 halves the memory traffic)
+    #
+    dtype = np.dtype(dtype)
+    U_xelem_s = curuc_buffer(U_xelem_s,dtype)
+    U_xline_s = curuc_buffer(U_xline_s,dtype)
+    U_xchan_s = curuc_buffer(U_xchan_s,dtype)
+    U_xchan_i = curuc_buffer(U_xchan_i,dtype)
+    C_xelem_s = curuc_buffer(C_xelem_s,dtype)
+    C_xline_s = curuc_buffer(C_xline_s,dtype)
+    C_xchan_s = curuc_buffer(C_xchan_s,dtype)
+    C_xchan_i = curuc_buffer(C_xchan_i,dtype)
+
     # Fill CURUC arrays
     #
-    # First define R (correlation) matrices
+    # First define R (correlation) matrices.  These only depend on the
+    # array sizes so are (cached) read-only templates broadcast to the
+    # CURUC array shapes rather than copies
     #
     # Cross element
-    R_xelem_s.values[...] = 1  # Fully systematic across elements
+    R_xelem_s = broadcast_template(R_xelem_s,dtype.type(1)) # Fully systematic across elements
     
     # Cross line - block diagonal
-    # Uses temp array for spatial correlation which is the copied
-    # to all channels etc.
-    Temp_array = np.zeros((len(R_xline_s.coords['n_l']),\
-                               len(R_xline_s.coords['n_l'])))
-
-    N = data.spatial_correlation_scale
-    Nsize = N//line_skip
-    step_size = line_skip*1./N
-
-    for step in range(-Nsize,Nsize+1):
-        diagonal = np.diagonal(Temp_array,step)
-        diagonal.setflags(write=True)
-        diagonal[:] = 1.-np.abs(step)*step_size
-
-    R_xline_s.values[:,:,:,:,:] = \
-        Temp_array[np.newaxis,np.newaxis,np.newaxis,:,:]
+    R_xline_s = broadcast_template(R_xline_s,\
+        curuc_line_template(len(R_xline_s.coords['n_l']),\
+                                data.spatial_correlation_scale,\
+                                line_skip,dtype)[np.newaxis,np.newaxis,np.newaxis,:,:])
 
     # Cross channel (independent)
     # effects, lines, elements, chan, chan
-    R_xchan_i.values[0,:,:,:,:] = 1
+    R_xchan_i = broadcast_template(R_xchan_i,dtype.type(1))
 
     # Cross channel (systematic)
-    # Set cross channel only for effect which is cross channel
-    # Other effects have Identity matrix
-    # Take into account visible channels which are not correlated with
-    # the first effect (Tict)
-    # Diagnonal for the vis chans, full matrix for the IR chans
-    if vis_chans:
-        for i in range(len(chans)):
-            R_xchan_s.values[0,:,:,i,i] = 1
-    else:
-        #
-        # Note that Harmonisation is uncorrelated in channel space
-        #
-        R_xchan_s.values[0,:,:,:,:] = 1
-        Temp_array = np.zeros((len(R_xline_s.coords['n_c']),\
-                                   len(R_xline_s.coords['n_c'])))
-        Temp_array[:,:] = np.identity(len(R_xline_s.coords['n_c']))
-        R_xchan_s.values[1,:,:,:,:] = Temp_array[np.newaxis,np.newaxis,:,:]
-        if not common:
-            #
-            # Add last effect if not common (systematic)
-            #
-            R_xchan_s.values[2,:,:,:,:] = Temp_array[np.newaxis,np.newaxis,:,:]
+    R_xchan_s = broadcast_template(R_xchan_s,\
+        curuc_chan_template(neffects_s,nchans,\
+                                vis_chans,dtype)[:,np.newaxis,np.newaxis,:,:])
 
     # Map uncertainties (which are constant in the T, Counts space).
     # All these are averaged over the smoothing scale (+/-)
     # Elements
     # n_c, n_s, n_l, n_e
     #
+    # Harmonisation uncertainties for the common case
+    if common:
+        harm = {3:data.ch3b_harm,4:data.ch4_harm,5:data.ch5_harm}
+
     # First one is the ICT temperature one
     if vis_chans:
         # noise term only
@@ -1188,20 +938,9 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
                         data.PRT_Uncertainty**2)
 
         if common:
-            for i in range(len(chans)):
-                if chans[i] == 3:
-                    newarray = copy_over_C(data.ch3b_harm,\
-                                               U_xelem_s.coords['n_l'],\
-                                               U_xelem_s.coords['n_e'])
-                elif chans[i] == 4:
-                    newarray = copy_over_C(data.ch4_harm,\
-                                               U_xelem_s.coords['n_l'],\
-                                               U_xelem_s.coords['n_e'])
-                elif chans[i] == 5:
-                    newarray = copy_over_C(data.ch5_harm,\
-                                               U_xelem_s.coords['n_l'],\
-                                               U_xelem_s.coords['n_e'])
-                U_xelem_s.values[i,1,:,:] = newarray[:,:]
+            gather_C(harm,chans,U_xelem_s.coords['n_l'],\
+                         U_xelem_s.coords['n_e'],layout='chan',\
+                         out=U_xelem_s.values[:,1,:,:])
         else:
             # Second is the Space view one
             for i in range(len(chans)):
@@ -1226,23 +965,9 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
                         data.PRT_Uncertainty**2)
 
         if common:
-            for i in range(len(chans)):
-                if chans[i] == 3:
-                    newarray = copy_over_C(data.ch3b_harm,\
-                                               U_xline_s.coords['n_l'],\
-                                               U_xline_s.coords['n_e'],\
-                                               inverse=True)
-                elif chans[i] == 4:
-                    newarray = copy_over_C(data.ch4_harm,\
-                                               U_xline_s.coords['n_l'],\
-                                               U_xline_s.coords['n_e'],\
-                                               inverse=True)
-                elif chans[i] == 5:
-                    newarray = copy_over_C(data.ch5_harm,\
-                                               U_xline_s.coords['n_l'],\
-                                               U_xline_s.coords['n_e'],\
-                                               inverse=True)
-                U_xline_s.values[i,1,:,:] = newarray[:,:]
+            gather_C(harm,chans,U_xline_s.coords['n_l'],\
+                         U_xline_s.coords['n_e'],layout='chan_inverse',\
+                         out=U_xline_s.values[:,1,:,:])
         else:
             # Second is the Space view one
             for i in range(len(chans)):
@@ -1271,20 +996,9 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
             np.sqrt(data.ICT_Temperature_Uncertainty**2+\
                         data.PRT_Uncertainty**2)
         if  common:
-            for i in range(len(chans)):
-                if chans[i] == 3:
-                    newarray = copy_over_C(data.ch3b_harm,\
-                                               U_xchan_s.coords['n_l'],\
-                                               U_xchan_s.coords['n_e'])
-                elif chans[i] == 4:
-                    newarray = copy_over_C(data.ch4_harm,\
-                                               U_xchan_s.coords['n_l'],\
-                                               U_xchan_s.coords['n_e'])
-                elif chans[i] == 5:
-                    newarray = copy_over_C(data.ch5_harm,\
-                                               U_xchan_s.coords['n_l'],\
-                                               U_xchan_s.coords['n_e'])
-                U_xchan_s.values[:,:,1,i] = newarray[:,:]
+            gather_C(harm,chans,U_xchan_s.coords['n_l'],\
+                         U_xchan_s.coords['n_e'],layout='xchan',\
+                         out=U_xchan_s.values[:,:,1,:])
         else:
             for i in range(len(chans)):
                 U_xchan_s.values[:,:,1,i] = data.cal_cnts_noise[chans[i]]
@@ -1300,206 +1014,43 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
     # Map sensitivities using coordinates
     # This has to use the coordinates to make correctly as the sensitivities
     # change pixel to pixel
-    # 3.7 micron channel
+    n_l = C_xelem_s.coords['n_l']
+    n_e = C_xelem_s.coords['n_e']
     if vis_chans:
         #
         # Visible channel case now - only for CS averaging no X channel
         #
-        if ch3a_version:
-            C_xelem_s.values[:,0,:,:] = \
-                copy_C3_vis(data.dRe1_over_dCS,data.dRe2_over_dCS,data.dRe3a_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans)
-
-            C_xline_s.values[:,0,:,:] = \
-                copy_C3_vis(data.dRe1_over_dCS,data.dRe2_over_dCS,data.dRe3a_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True)
-
-        else: # Don't have channel 1.6 and no X channel
-            C_xelem_s.values[:,0,:,:] = \
-                copy_C2_vis(data.dRe1_over_dCS,data.dRe2_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans)
-
-            C_xline_s.values[:,0,:,:] = \
-                copy_C2_vis(data.dRe1_over_dCS,data.dRe2_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True)
+        dX = curuc_sensitivities(data,chans,'CS')
+        gather_C(dX,chans,n_l,n_e,layout='chan',out=C_xelem_s.values[:,0,:,:])
+        gather_C(dX,chans,n_l,n_e,layout='chan_inverse',\
+                     out=C_xline_s.values[:,0,:,:])
     else:
-        # 3.7,11 and 12 micron channels present
-        if data.ch5_there and not ch3a_version:
-            C_xelem_s.values[:,0,:,:] = \
-                copy_C3(data.dBT3_over_dT,data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans)
-            if common:
-                C_xelem_s.values[:,1,:,:] = 1
-            else:
-                C_xelem_s.values[:,1,:,:] = \
-                    copy_C3(data.dBT3_over_dCS,data.dBT4_over_dCS,data.dBT5_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans)
-                C_xelem_s.values[:,2,:,:] = \
-                    copy_C3(data.dBT3_over_dCICT,data.dBT4_over_dCICT,\
-                                data.dBT5_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans)
-
-            C_xline_s.values[:,0,:,:] = \
-                copy_C3(data.dBT3_over_dT,data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,inverse=True)
-            if common:
-                C_xline_s.values[:,1,:,:] = 1
-            else:
-                C_xline_s.values[:,1,:,:] = \
-                    copy_C3(data.dBT3_over_dCS,data.dBT4_over_dCS,data.dBT5_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True)
-                C_xline_s.values[:,2,:,:] = \
-                    copy_C3(data.dBT3_over_dCICT,data.dBT4_over_dCICT,\
-                                data.dBT5_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True)
-
-            # Now X channel
-            C_xchan_s.values[0,:,:,:] = \
-                copy_C3(data.dBT3_over_dT,data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,xchan=True)
-            if common:
-                C_xchan_s.values[1,:,:,:] = 1
-            else:
-                C_xchan_s.values[1,:,:,:] = \
-                    copy_C3(data.dBT3_over_dCS,data.dBT4_over_dCS,data.dBT5_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,xchan=True)
-                C_xchan_s.values[2,:,:,:] = \
-                    copy_C3(data.dBT3_over_dCICT,data.dBT4_over_dCICT,\
-                                data.dBT5_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,xchan=True)
-
-            #
-            # Independent effects
-            #
-            C_xchan_i.values[0,:,:,:] = \
-                copy_C3(data.dBT3_over_dT,data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,xchan=True)
-
-        elif not ch3a_version: # Don't have channel 5 but have 3.7
-
-            C_xelem_s.values[:,0,:,:] = \
-                copy_C2(data.dBT3_over_dT,data.dBT4_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans)
-            if common:
-                C_xelem_s.values[:,1,:,:] = 1
-            else:
-                C_xelem_s.values[:,1,:,:] = \
-                    copy_C2(data.dBT3_over_dCS,data.dBT4_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans)
-                C_xelem_s.values[:,2,:,:] = \
-                    copy_C2(data.dBT3_over_dCICT,data.dBT4_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans)
-                
-            C_xline_s.values[:,0,:,:] = \
-                copy_C2(data.dBT3_over_dT,data.dBT4_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,inverse=True)
-            if common:
-                C_xline_s.values[:,1,:,:] = 1
-            else:
-                C_xline_s.values[:,1,:,:] = \
-                    copy_C2(data.dBT3_over_dCS,data.dBT4_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True)
-                C_xline_s.values[:,2,:,:] = \
-                    copy_C2(data.dBT3_over_dCICT,data.dBT4_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True)
-            
-            # Now X channel
-            C_xchan_s.values[0,:,:,:] = \
-                copy_C2(data.dBT3_over_dT,data.dBT4_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,xchan=True)
-            if common:
-                C_xchan_s.values[1,:,:,:] = 1
-            else:
-                C_xchan_s.values[1,:,:,:] = \
-                    copy_C2(data.dBT3_over_dCS,data.dBT4_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,xchan=True)
-                C_xchan_s.values[2,:,:,:] = \
-                    copy_C2(data.dBT3_over_dCICT,data.dBT4_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,xchan=True)
-            
-            C_xchan_i.values[0,:,:,:] = \
-                copy_C2(data.dBT3_over_dT,data.dBT4_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,xchan=True)
-
+        #
+        # IR channels (3.7,11,12 micron or any two of them).  Common case only
+        # has the ICT temperature sensitivity, harmonisation is set to 1
+        #
+        if common:
+            effects = ['T']
         else:
-            # Channel 11 and 12 only (no 3.7 micron channel)
-            C_xelem_s.values[:,0,:,:] = \
-                copy_C2(data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,ch3a=True)
-            if common:
-                C_xelem_s.values[:,1,:,:] = 1
-            else:
-                C_xelem_s.values[:,1,:,:] = \
-                    copy_C2(data.dBT4_over_dCS,data.dBT5_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,ch3a=True)
-                C_xelem_s.values[:,2,:,:] = \
-                    copy_C2(data.dBT4_over_dCICT,data.dBT5_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,ch3a=True)
-                
-            C_xline_s.values[:,0,:,:] = \
-                copy_C2(data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,inverse=True,ch3a=True)
-            if common:
-                C_xline_s.values[:,1,:,:] = 1
-            else:
-                C_xline_s.values[:,1,:,:] = \
-                    copy_C2(data.dBT4_over_dCS,data.dBT5_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True,ch3a=True)
-                C_xline_s.values[:,2,:,:] = \
-                    copy_C2(data.dBT4_over_dCICT,data.dBT5_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,inverse=True,ch3a=True)
-            
+            effects = ['T','CS','CICT']
+        for j in range(len(effects)):
+            dX = curuc_sensitivities(data,chans,effects[j])
+            gather_C(dX,chans,n_l,n_e,layout='chan',\
+                         out=C_xelem_s.values[:,j,:,:])
+            gather_C(dX,chans,n_l,n_e,layout='chan_inverse',\
+                         out=C_xline_s.values[:,j,:,:])
             # Now X channel
-            C_xchan_s.values[0,:,:,:] = \
-                copy_C2(data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,xchan=True,ch3a=True)
-            if common:
-                C_xchan_s.values[1,:,:,:] = 1
-            else:
-                C_xchan_s.values[1,:,:,:] = \
-                    copy_C2(data.dBT4_over_dCS,data.dBT5_over_dCS,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,xchan=True,ch3a=True)
-                C_xchan_s.values[2,:,:,:] = \
-                    copy_C2(data.dBT4_over_dCICT,data.dBT5_over_dCICT,\
-                                C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                                chans,xchan=True,ch3a=True)
-            
-            C_xchan_i.values[0,:,:,:] = \
-                copy_C2(data.dBT4_over_dT,data.dBT5_over_dT,\
-                            C_xelem_s.coords['n_l'],C_xelem_s.coords['n_e'],\
-                            chans,xchan=True,ch3a=True)
+            gather_C(dX,chans,n_l,n_e,layout='xchan',\
+                         out=C_xchan_s.values[j,:,:,:])
+        if common:
+            C_xelem_s.values[:,1,:,:] = 1
+            C_xline_s.values[:,1,:,:] = 1
+            C_xchan_s.values[1,:,:,:] = 1
+
+        #
+        # Independent effects
+        #
+        C_xchan_i.values[0,:,:,:] = C_xchan_s.values[0,:,:,:]
 
     # make mask data (xarray bool)
     # Keep all channels (dtype='?' means boolean)
@@ -1568,51 +1119,28 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
     # Fill masked values with nan's
     # Should be done in the CURUC code but is only done for a subset of
     # arrays (I think). Leads to nan's in outputs
+    # Done in place so keep the channel to channel values first if
+    # writing diagnostics
     #
+    if diag_file is not None:
+        U_xchan_s_old = U_xchan_s.values.copy()
+        C_xchan_s_old = C_xchan_s.values.copy()
     U_xelem_s_new,U_xline_s_new,U_xchan_i_new,U_xchan_s_new,\
                      C_xelem_s_new,C_xline_s_new,C_xchan_i_new,\
                      C_xchan_s_new = \
                      replace_TINY(U_xelem_s,U_xline_s,U_xchan_i,U_xchan_s,\
                                       C_xelem_s,C_xline_s,C_xchan_i,C_xchan_s,\
                                       mask=mask2.values)
-    # Per line
-    if not vis_chans and not common:
-        for i in range(U_xchan_s.values.shape[0]):
-            # Per element
-            for j in range(U_xchan_s.values.shape[1]):
-                # Per effect
-                for k in range(U_xchan_s.values.shape[2]):
-                    # Per channel
-                    array = np.zeros(4+U_xchan_s.values.shape[3]+\
-                                         C_xchan_s.values.shape[3]+\
-                                         U_xchan_s_new.values.shape[3]+\
-                                         C_xchan_s_new.values.shape[3],\
-                                         dtype=np.float32)
-                    array[0] = i # scanlines
-                    array[1] = j # element
-                    array[2] = k # effect
-                    if mask2.values[i]:
-                        array[3] = 1
-                    else:
-                        array[3] = 0
-                    offset=4
-                    array[offset:offset+U_xchan_s.values.shape[3]] = \
-                        U_xchan_s.values[i,j,k,:]
-                    offset=offset+U_xchan_s.values.shape[3]
-                    array[offset:offset+C_xchan_s.values.shape[3]] = \
-                        C_xchan_s.values[k,i,j,:]
-                    offset=offset+C_xchan_s.values.shape[3]
-                    array[offset:offset+U_xchan_s_new.values.shape[3]] = \
-                        U_xchan_s_new.values[i,j,k,:]
-                    offset=offset+U_xchan_s_new.values.shape[3]
-                    array[offset:offset+C_xchan_s_new.values.shape[3]] = \
-                        C_xchan_s_new.values[k,i,j,:]
+    if diag_file is not None:
+        write_curuc_diagnostics(diag_file,mask2.values,U_xchan_s_old,\
+                                    C_xchan_s_old,U_xchan_s_new.values,\
+                                    C_xchan_s_new.values)
     gd = np.isfinite(U_xelem_s.values) 
     # Now run CURUC
-    ny = int(data.ch1.shape[0]/line_skip)
+    ny = int(data.ny/line_skip)
     if 0 == ny:
         ny = 1
-    nx = int(data.ch1.shape[1]/elem_skip)
+    nx = int(data.nx/elem_skip)
     if 0 == nx:
         nx = 1
     xline_length, xelem_length, xchan_corr_i, xchan_corr_s, xl_all, xe_all = \
@@ -1625,498 +1153,1450 @@ def run_CURUC(data,inchans,vis_chans=False,common=False,\
                             interpolate_lengths=True,\
                             cutoff_l=ny,cutoff_e=nx)    
 
-    return xline_length, xelem_length, xchan_corr_i, xchan_corr_s, \
-        xl_all, xe_all
+    return xline_length, xelem_length, xchan_corr_i, xchan_corr_s, \
+        xl_all, xe_all
+
+#
+# Write CURUC channel to channel diagnostics to a .npy file.  One float32
+# row per line/element/effect of
+#
+#   line, element, effect, bad line flag, U_xchan_s, C_xchan_s (before
+#   TINY replacement), U_xchan_s, C_xchan_s (after TINY replacement)
+#
+# U arrays are (n_l,n_e,n_s,n_c) and C arrays (n_s,n_l,n_e,n_c)
+#
+def write_curuc_diagnostics(filename,mask,U_old,C_old,U_new,C_new):
+
+    n_l,n_e,n_s,n_c = U_old.shape
+    index = np.indices((n_l,n_e,n_s)).reshape(3,-1).T
+    flag = np.asarray(mask,dtype=np.float32)[index[:,0]]
+    array = np.concatenate([index.astype(np.float32),flag[:,np.newaxis],\
+                                U_old.reshape(-1,n_c),\
+                                C_old.transpose(1,2,0,3).reshape(-1,n_c),\
+                                U_new.reshape(-1,n_c),\
+                                C_new.transpose(1,2,0,3).reshape(-1,n_c)],\
+                               axis=1).astype(np.float32)
+    np.save(filename,array)
+
+#
+# Weighted mean of CURUC outputs from scanline blocks.  The length
+# vectors (xl_all/xe_all) can differ in length between blocks so are
+# NaN padded to the longest one first.  NaNs (and so the padding) are
+# ignored in the mean
+#
+def combine_curuc_blocks(results,weights):
+
+    if 1 == len(results):
+        return results[0]
+
+    combined = []
+    for k in range(len(results[0])):
+        arrays = [result[k] for result in results]
+        longest = arrays[np.argmax([array.shape[0] for array in arrays])]
+        values = np.full((len(arrays),)+longest.shape,float('nan'))
+        for i in range(len(arrays)):
+            values[i,0:arrays[i].shape[0]] = arrays[i].values
+        wts = np.asarray(weights,dtype=np.float64).reshape(\
+            (len(arrays),)+(1,)*longest.ndim)*np.ones(values.shape)
+        gd = np.isfinite(values)
+        total = np.sum(np.where(gd,wts,0.),axis=0)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = np.sum(np.where(gd,wts*values,0.),axis=0)/total
+        mean[total == 0] = float('nan')
+        combined.append(longest.copy(data=mean))
+
+    return tuple(combined)
+
+#
+# Run CURUC in blocks of scanlines and combine the results weighted by the
+# number of lines in each block.  Peak memory is set by block_lines rather
+# than the orbit length.  Blocks are a multiple of line_skip and the last
+# block takes any remainder.  Blocks should be much longer than the
+# spatial correlation scale so the cross line lengths are not truncated
+#
+def run_CURUC_blocked(data,inchans,vis_chans=False,common=False,\
+                          line_skip=5,elem_skip=25,ch3a_version=False,\
+                          block_lines=2560,dtype=np.float64,\
+                          diag_file=None):
+
+    nlines = data.ny
+    block_lines = max(line_skip,(block_lines//line_skip)*line_skip)
+    nblocks = max(1,nlines//block_lines)
+
+    results = []
+    weights = []
+    for i in range(nblocks):
+        start = i*block_lines
+        if i == nblocks-1:
+            stop = nlines
+        else:
+            stop = start+block_lines
+        gd = np.zeros(nlines,dtype=np.bool)
+        gd[start:stop] = True
+        block = copy_to_data(data,gd)
+        if diag_file is None:
+            block_diag_file = None
+        else:
+            block_diag_file = '{0}_block{1:d}.npy'.format(\
+                os.path.splitext(diag_file)[0],i)
+        results.append(run_CURUC(block,inchans,vis_chans=vis_chans,\
+                                     common=common,line_skip=line_skip,\
+                                     elem_skip=elem_skip,\
+                                     ch3a_version=ch3a_version,\
+                                     dtype=dtype,diag_file=block_diag_file))
+        weights.append(stop-start)
+        del block
+
+    return combine_curuc_blocks(results,weights)
+
+#
+# Channels used in CURUC for a given AVHRR
+#
+def get_curuc_chans(noaa_string,ch3a_version):
+
+    if noaa_string in ['NOAA06','NOAA08','NOAA10']:
+        # Setup CURUC for 2 channel IR AVHRR
+        chans = np.array([0,1,3,4],dtype=np.int8)
+    elif noaa_string in ['NOAA07','NOAA09','NOAA11','NOAA12','NOAA14']:
+        # Setup CURUC for 3 channel IR AVHRR
+        chans = np.array([0,1,3,4,5],dtype=np.int8)
+    elif noaa_string in ['NOAA15','NOAA16','NOAA17','NOAA18',\
+                             'NOAA19','METOPA','METOPB','METOPC']:
+        # Setup CURUC for 2 or 3 channel IR AVHRR dependnet on ch3a
+        if ch3a_version:
+            chans = np.array([0,1,2,4,5],dtype=np.int8)
+        else:
+            chans = np.array([0,1,3,4,5],dtype=np.int8)
+    else:
+        raise Exception('noaa_string not found')
+
+    return chans
+
+#
+# The three CURUC passes (inchans,vis_chans,common) - vis chans only, IR
+# chans only - not common and IR chans only - common effects
+#
+def curuc_passes(chans):
+
+    inchans = np.sort(chans)
+    #
+    # Make two sets of chans - one visible, one IR
+    #
+    gd = (inchans <= 2)
+    vis_chans = inchans[gd]
+    gd = (inchans >= 3)
+    ir_chans = inchans[gd]
+
+    return [(vis_chans,True,False),(ir_chans,False,False),\
+                (ir_chans,False,True)]
+
+#
+# read_netcdf the (masked/copied) data reads from (None if not a file)
+#
+def netcdf_source(data):
+
+    while 'parent' in data.__dict__:
+        data = data.parent
+    if isinstance(data,read_netcdf):
+        return data
+
+    return None
+
+#
+# Close the input file before forking / reopen it afterwards (see
+# read_netcdf.reopen)
+#
+def close_netcdf(data):
+
+    source = netcdf_source(data)
+    if source is not None:
+        source.close()
+
+def reopen_netcdf(data):
+
+    source = netcdf_source(data)
+    if source is not None:
+        source.reopen()
+
+#
+# Run a single CURUC pass in a forked process, sending the results back
+# through a pipe
+#
+def curuc_worker(conn,data,inchans,kwargs):
+
+    reopen_netcdf(data)
+    conn.send(run_CURUC(data,inchans,**kwargs))
+    conn.close()
+
+#
+# Maximum absolute difference of each CURUC output against a reference
+# (float64) run
+#
+def curuc_deviation(results,reference):
+
+    deviation = []
+    for k in range(len(results)):
+        values = np.asarray(results[k].values,dtype=np.float64)
+        refvalues = np.asarray(reference[k].values,dtype=np.float64)
+        n = min(values.shape[0],refvalues.shape[0])
+        with np.errstate(invalid='ignore'):
+            diff = np.abs(values[0:n]-refvalues[0:n])
+        gd = np.isfinite(diff)
+        if np.sum(gd) > 0:
+            deviation.append(diff[gd].max())
+        else:
+            deviation.append(0.)
+
+    return deviation
+
+#
+# Run a list of CURUC passes (inchans,vis_chans,common).  With nproc > 1
+# the passes run in forked processes, only starting a pass if the
+# estimated memory of the running passes stays within mem_budget (bytes,
+# None for no limit).  A pass is always started if nothing else is running.
+# block_lines sets blocked CURUC for long orbits (see run_CURUC_blocked).
+# dtype sets the CURUC precision - if validate is set the passes are rerun
+# in float64 and the maximum deviations of the outputs are reported.
+# line_skip/elem_skip set the CURUC sub-sampling.  If cache_dir is set
+# results are reused from/stored in a cache keyed on the CURUC inputs
+# (see curuc_cache_key), which is kept below cache_size bytes.  If
+# diag_prefix is set the channel to channel CURUC inputs of the IR (not
+# common) pass are written to <diag_prefix>_<chans>[_ch3a].npy (see
+# write_curuc_diagnostics) - the cache is not used in this case
+#
+def run_CURUC_passes(data,passes,ch3a_version=False,nproc=1,\
+                         mem_budget=None,block_lines=None,dtype=np.float64,\
+                         validate=False,line_skip=5,elem_skip=25,\
+                         cache_dir=None,cache_size=None,diag_prefix=None):
+
+    kwargs = []
+    for inchans,vis_chans,common in passes:
+        kwargs.append({'vis_chans':vis_chans,'common':common,\
+                           'line_skip':line_skip,'elem_skip':elem_skip,\
+                           'ch3a_version':ch3a_version,\
+                           'block_lines':block_lines,'dtype':dtype,\
+                           'diag_file':None})
+        if diag_prefix is not None and not vis_chans and not common:
+            diag_file = '{0}_{1}'.format(diag_prefix,\
+                                             ''.join([str(chan) for chan \
+                                                          in inchans]))
+            if ch3a_version:
+                diag_file = diag_file+'_ch3a'
+            kwargs[-1]['diag_file'] = diag_file+'.npy'
+    if diag_prefix is not None:
+        cache_dir = None
+
+    results = [None]*len(passes)
+    keys = [None]*len(passes)
+    if cache_dir is not None:
+        for i in range(len(passes)):
+            keys[i] = curuc_cache_key(data,passes[i][0],kwargs[i])
+            results[i] = read_curuc_cache(cache_dir,keys[i])
+    todo = [i for i in range(len(passes)) if results[i] is None]
+
+    if nproc <= 1 or len(todo) <= 1:
+        for i in todo:
+            results[i] = run_CURUC(data,passes[i][0],**kwargs[i])
+    else:
+        newresults = run_CURUC_parallel(data,[passes[i] for i in todo],\
+                                            [kwargs[i] for i in todo],\
+                                            nproc,mem_budget)
+        for i in range(len(todo)):
+            results[todo[i]] = newresults[i]
+
+    if cache_dir is not None:
+        for i in todo:
+            write_curuc_cache(cache_dir,keys[i],results[i],\
+                                  cache_size=cache_size)
+
+    if validate and np.dtype(dtype) != np.float64:
+        names = curuc_output_names
+        for i in range(len(passes)):
+            kwargs[i]['dtype'] = np.float64
+            kwargs[i]['diag_file'] = None
+            reference = run_CURUC(data,passes[i][0],**kwargs[i])
+            deviation = curuc_deviation(results[i],reference)
+            print('CURUC {0} validation (chans {1}, common {2}):'.\
+                      format(np.dtype(dtype).name,passes[i][0],passes[i][2]))
+            for k in range(len(names)):
+                print('    max deviation {0}: {1}'.format(names[k],\
+                                                              deviation[k]))
+
+    return results
+
+#
+# Names of the CURUC outputs (as stored in the cache)
+#
+curuc_output_names = ['xline_length','xelem_length','xchan_corr_i',\
+                          'xchan_corr_s','xl_all','xe_all']
+
+#
+# Cache key for a CURUC pass - sha256 of the CURUC settings and every
+# input array it can read (derivatives, noise, quality and harmonisation
+# uncertainties)
+#
+def curuc_cache_key(data,inchans,kwargs):
+
+    key = hashlib.sha256()
+    key.update(repr((list(np.sort(inchans)),kwargs['vis_chans'],\
+                         kwargs['common'],kwargs['ch3a_version'],\
+                         kwargs['line_skip'],kwargs['elem_skip'],\
+                         kwargs['block_lines'],np.dtype(kwargs['dtype']).str,\
+                         data.ny,data.nx,bool(data.ch5_there),\
+                         float(data.spatial_correlation_scale),\
+                         float(data.ICT_Temperature_Uncertainty),\
+                         float(data.PRT_Uncertainty))).encode('utf-8'))
+    if kwargs['vis_chans']:
+        names = ['dRe1_over_dCS','dRe2_over_dCS','dRe3a_over_dCS']
+    else:
+        names = []
+        for effect in ['T','CS','CICT']:
+            for chan in ['3','4','5']:
+                names.append('dBT{0}_over_d{1}'.format(chan,effect))
+        if kwargs['common']:
+            names = names+['ch3b_harm','ch4_harm','ch5_harm']
+    names = ['scan_qual','cal_cnts_noise','cnts_noise']+names
+    for name in names:
+        try:
+            values = getattr(data,name)
+        except AttributeError:
+            continue
+        values = np.ascontiguousarray(np.ma.getdata(values))
+        key.update(name.encode('utf-8'))
+        key.update(repr((values.shape,values.dtype.str)).encode('utf-8'))
+        key.update(values.tobytes())
+
+    return key.hexdigest()
+
+#
+# Read cached CURUC outputs (None if not in the cache, evicted by another
+# process or unreadable)
+#
+def read_curuc_cache(cache_dir,key):
+
+    filename = os.path.join(cache_dir,key+'.npz')
+    try:
+        with np.load(filename) as cache:
+            results = tuple([xarray.DataArray(cache[name],\
+                                                  dims=[str(dim) for dim in \
+                                                            cache[name+'_dims']])
+                             for name in curuc_output_names])
+    except (IOError,KeyError,ValueError,EOFError,zipfile.BadZipFile):
+        return None
+    #
+    # Mark as recently used for eviction
+    #
+    try:
+        os.utime(filename,None)
+    except FileNotFoundError:
+        pass
+
+    return results
+
+#
+# Store CURUC outputs in the cache then evict the least recently used
+# entries until the cache is smaller than cache_size bytes.  Other
+# processes may evict entries at the same time so vanished files are
+# skipped
+#
+def write_curuc_cache(cache_dir,key,results,cache_size=None):
+
+    os.makedirs(cache_dir,exist_ok=True)
+    arrays = {}
+    for k in range(len(curuc_output_names)):
+        arrays[curuc_output_names[k]] = np.asarray(results[k].values)
+        arrays[curuc_output_names[k]+'_dims'] = \
+            np.array([str(dim) for dim in results[k].dims])
+    filename = os.path.join(cache_dir,key+'.npz')
+    tmpfile = '{0}.{1}.tmp'.format(filename,os.getpid())
+    with open(tmpfile,'wb') as fp:
+        np.savez(fp,**arrays)
+    os.replace(tmpfile,filename)
+
+    if cache_size is None:
+        return
+    entries = []
+    for cachefile in glob.glob(os.path.join(cache_dir,'*.npz')):
+        try:
+            stat = os.stat(cachefile)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime,stat.st_size,cachefile))
+    entries.sort()
+    total = sum([entry[1] for entry in entries])
+    for mtime,size,cachefile in entries:
+        if total <= cache_size:
+            break
+        total = total-size
+        try:
+            os.remove(cachefile)
+        except FileNotFoundError:
+            pass
+
+#
+# Run CURUC passes in forked processes within a memory budget
+#
+def run_CURUC_parallel(data,passes,kwargs,nproc,mem_budget):
+
+    block_lines = kwargs[0]['block_lines']
+    dtype = kwargs[0]['dtype']
+    line_skip = kwargs[0]['line_skip']
+    elem_skip = kwargs[0]['elem_skip']
+    nlines = data.ny
+    if block_lines is not None:
+        nlines = min(nlines,block_lines)
+    nelems = data.nx
+    memory = [curuc_memory(len(inchans),nlines,nelems,vis_chans=vis_chans,\
+                               common=common,line_skip=line_skip,\
+                               elem_skip=elem_skip,dtype=dtype)
+              for inchans,vis_chans,common in passes]
+
+    ctx = multiprocessing.get_context('fork')
+    results = [None]*len(passes)
+    waiting = list(range(len(passes)))
+    running = {}
+    close_netcdf(data)
+    try:
+        while len(waiting) > 0 or len(running) > 0:
+            used = sum([running[conn][2] for conn in running])
+            while len(waiting) > 0 and len(running) < nproc:
+                i = waiting[0]
+                if len(running) > 0 and mem_budget is not None and \
+                        used+memory[i] > mem_budget:
+                    break
+                recv_conn,send_conn = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=curuc_worker,\
+                                       args=(send_conn,data,passes[i][0],\
+                                                 kwargs[i]))
+                proc.start()
+                send_conn.close()
+                running[recv_conn] = (i,proc,memory[i])
+                used = used+memory[i]
+                waiting.pop(0)
+            for conn in multiprocessing.connection.wait(list(running)):
+                i,proc,mem = running.pop(conn)
+                try:
+                    results[i] = conn.recv()
+                except EOFError:
+                    results[i] = None
+                conn.close()
+                proc.join()
+                if results[i] is None or 0 != proc.exitcode:
+                    raise Exception('CURUC pass {0} failed (exit code {1})'.\
+                                        format(i,proc.exitcode))
+    finally:
+        #
+        # On failure stop the passes still running (they are not daemons
+        # so would otherwise hold up the exit)
+        #
+        for conn in running:
+            i,proc,mem = running[conn]
+            proc.terminate()
+            proc.join()
+            conn.close()
+        reopen_netcdf(data)
+
+    return results
+
+#
+# CURUC sub-sampling (line_skip,elem_skip) tried by the convergence check,
+# finest first
+#
+curuc_skip_candidates = [(5,25),(10,25),(5,50),(10,50),(20,50),(20,100)]
+
+#
+# CURUC correlation vector (lag,channel) sampled every skip scanlines/
+# elements interpolated onto the lags of a reference sampling (nlags
+# lags every ref_skip).  Lags beyond the vector are NaN
+#
+def curuc_vector_on_lags(values,skip,ref_skip,nlags):
+
+    values = np.asarray(values,dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:,np.newaxis]
+    lags = np.arange(values.shape[0])*skip
+    ref_lags = np.arange(nlags)*ref_skip
+    out = np.zeros((nlags,values.shape[1]))+float('nan')
+    for c in range(values.shape[1]):
+        gd = np.isfinite(values[:,c])
+        if np.sum(gd) > 1:
+            out[:,c] = np.interp(ref_lags,lags[gd],values[gd,c],\
+                                     right=float('nan'))
+
+    return out
+
+#
+# Correlation length (scanlines/elements) per channel of a correlation
+# vector on lags - the lag the correlation falls to 1/e (linearly
+# interpolated), NaN if it does not within the vector
+#
+def curuc_vector_length(values,lags):
+
+    lengths = np.zeros(values.shape[1])+float('nan')
+    for c in range(values.shape[1]):
+        below = np.where(values[1:,c] < np.exp(-1.))[0]
+        if len(below) == 0:
+            continue
+        j = below[0]+1
+        if not (np.isfinite(values[j-1,c]) and np.isfinite(values[j,c])):
+            continue
+        frac = (values[j-1,c]-np.exp(-1.))/(values[j-1,c]-values[j,c])
+        lengths[c] = lags[j-1]+frac*(lags[j]-lags[j-1])
+
+    return lengths
+
+#
+# Maximum deviation of CURUC pass outputs from a reference set of passes
+# run with a different sub-sampling (skips/ref_skips are the (line_skip,
+# elem_skip) of each).  The cross line/element correlation vectors are
+# compared on the reference lags in scanlines/elements and the correlation
+# lengths are derived from them there.  Returns the relative deviation of
+# the correlation lengths and the absolute deviation of the correlation
+# matrices/vectors
+#
+def curuc_pass_deviation(results,reference,skips,ref_skips):
+
+    length_dev = 0.
+    corr_dev = 0.
+    for i in range(len(results)):
+        deviation = curuc_deviation(results[i][2:4],reference[i][2:4])
+        corr_dev = max(corr_dev,max(deviation))
+        for k in range(2):
+            refvalues = curuc_vector_on_lags(reference[i][4+k].values,\
+                                                 ref_skips[k],ref_skips[k],\
+                                                 len(reference[i][4+k]))
+            values = curuc_vector_on_lags(results[i][4+k].values,\
+                                              skips[k],ref_skips[k],\
+                                              refvalues.shape[0])
+            diff = np.abs(values-refvalues)
+            gd = np.isfinite(diff)
+            if np.sum(gd) > 0:
+                corr_dev = max(corr_dev,float(diff[gd].max()))
+            lags = np.arange(refvalues.shape[0])*ref_skips[k]
+            ref_length = curuc_vector_length(refvalues,lags)
+            length = curuc_vector_length(values,lags)
+            gd = np.isfinite(ref_length) & np.isfinite(length) & \
+                (ref_length > 0)
+            if np.sum(gd) > 0:
+                length_dev = max(length_dev,\
+                                     float(np.max(np.abs(length[gd]-\
+                                                             ref_length[gd])/\
+                                                      ref_length[gd])))
+
+    return length_dev, corr_dev
+
+#
+# Run the CURUC passes for each candidate sub-sampling and compare to the
+# reference (first candidate).  Returns a list of (line_skip,elem_skip,
+# run time,length deviation,correlation deviation)
+#
+def curuc_convergence(data,chans,ch3a_version=False,\
+                          candidates=curuc_skip_candidates,curuc_options=None):
+
+    if curuc_options is None:
+        curuc_options = {}
+    options = dict(curuc_options)
+    options['validate'] = False
+    options['cache_dir'] = None
+    options['diag_prefix'] = None
+
+    report = []
+    reference = None
+    ref_skips = candidates[0]
+    for line_skip,elem_skip in candidates:
+        options['line_skip'] = line_skip
+        options['elem_skip'] = elem_skip
+        start = time.time()
+        results = run_CURUC_passes(data,curuc_passes(chans),\
+                                       ch3a_version=ch3a_version,**options)
+        runtime = time.time()-start
+        if reference is None:
+            reference = results
+        length_dev, corr_dev = curuc_pass_deviation(results,reference,\
+                                                        (line_skip,elem_skip),\
+                                                        ref_skips)
+        report.append((line_skip,elem_skip,runtime,length_dev,corr_dev))
+
+    return report
+
+#
+# Pick the coarsest sub-sampling (fewest sampled pixels) whose length and
+# correlation deviations are within tolerance
+#
+def choose_curuc_skip(report,tolerance):
+
+    line_skip,elem_skip = report[0][0:2]
+    for entry in report:
+        if entry[3] <= tolerance and entry[4] <= tolerance and \
+                entry[0]*entry[1] > line_skip*elem_skip:
+            line_skip,elem_skip = entry[0:2]
+
+    return line_skip,elem_skip
+
+#
+# Read/write the sub-sampling chosen by the convergence check (a single
+# line with line_skip and elem_skip)
+#
+def read_curuc_skip(filename):
+
+    with open(filename,'r') as fp:
+        values = fp.readline().split()
+    if 2 != len(values):
+        raise Exception('Cannot read line_skip/elem_skip from {0}'.\
+                            format(filename))
+
+    return int(values[0]),int(values[1])
+
+def write_curuc_skip(filename,line_skip,elem_skip):
+
+    with open(filename,'w') as fp:
+        fp.write('{0:d} {1:d}\n'.format(line_skip,elem_skip))
+
+#
+# Directory of SRF/lookup table files (<prefix>_{wave,srf,rad,bt}.dat or
+# the .npy versions written by convert_srf_tables) - can be set with the
+# AVHRR_SRF_DIR environment variable or --srf-dir
+#
+srf_directory = os.environ.get('AVHRR_SRF_DIR',\
+    '/gws/nopw/j04/fiduceo/Users/jmittaz/FCDR/Mike/FCDR_AVHRR/SRF/data/')
+
+#
+# SRF file prefix and IR channels in the files for each AVHRR
+#
+srf_names = {'TIROSN':('tiros-n',[3,4]),\
+                 'NOAA06':('noaa06',[3,4]),\
+                 'NOAA07':('noaa07',[3,4,5]),\
+                 'NOAA08':('noaa08',[3,4]),\
+                 'NOAA09':('noaa09',[3,4,5]),\
+                 'NOAA10':('noaa10',[3,4]),\
+                 'NOAA11':('noaa11',[3,4,5]),\
+                 'NOAA12':('noaa12',[3,4,5]),\
+                 'NOAA14':('noaa14',[3,4,5]),\
+                 'NOAA15':('noaa15',[3,4,5]),\
+                 'NOAA16':('noaa16',[3,4,5]),\
+                 'NOAA17':('noaa17',[3,4,5]),\
+                 'NOAA18':('noaa18',[3,4,5]),\
+                 'NOAA19':('noaa19',[3,4,5]),\
+                 'METOPA':('metopa',[3,4,5]),\
+                 'METOPB':('metopb',[3,4,5]),\
+                 'METOPC':('metopc',[3,4,5])}
+
+#
+# SRF/lookup tables in the order they are returned by read_srf_tables
+#
+srf_tables = ['wave','srf','rad','bt']
+
+#
+# Read one SRF/lookup table - memory mapped binary version if present
+# otherwise the text file
+#
+def read_srf_table(srf_dir,prefix,table):
+
+    filename = os.path.join(srf_dir,'{0}_{1}'.format(prefix,table))
+    if os.path.isfile(filename+'.npy'):
+        return np.load(filename+'.npy',mmap_mode='r')
+    if not os.path.isfile(filename+'.dat'):
+        raise Exception('Cannot find SRF file {0}.dat'.format(filename))
+
+    return np.loadtxt(filename+'.dat')
+
+#
+# Read SRF/lookup tables for a given AVHRR.  Memoised for the life of the
+# process so arrays returned must not be modified
+#
+@functools.lru_cache(maxsize=None)
+def read_srf_tables(srf_dir,noaa):
+
+    try:
+        prefix,inchans = srf_names[noaa]
+    except KeyError:
+        raise Exception('Cannot find noaa name for SRF')
+
+    return tuple([read_srf_table(srf_dir,prefix,table) \
+                      for table in srf_tables]),inchans
+
+#
+# Convert the SRF/lookup text files to .npy files (one off) for all
+# AVHRRs found in srf_dir.  Written to out_dir (srf_dir by default)
+#
+def convert_srf_tables(srf_dir,out_dir=None):
+
+    if out_dir is None:
+        out_dir = srf_dir
+    os.makedirs(out_dir,exist_ok=True)
+    for noaa in sorted(srf_names):
+        prefix = srf_names[noaa][0]
+        for table in srf_tables:
+            filename = os.path.join(srf_dir,'{0}_{1}.dat'.format(prefix,table))
+            if not os.path.isfile(filename):
+                continue
+            outfile = os.path.join(out_dir,'{0}_{1}.npy'.format(prefix,table))
+            np.save(outfile,np.loadtxt(filename))
+            print('Written {0}'.format(outfile))
+
+#
+# Get SRF information for a given AVHRR
+#
+def get_srf(noaa,allchans,srf_dir=None):
+
+    if srf_dir is None:
+        srf_dir = srf_directory
+
+    #
+    # Remove visible channels as they are not controlled by a FIDUCEO
+    # process and therefore we can't know what was used
+    #
+    gd = (allchans >= 3)
+    chans = allchans[gd]
+
+    #
+    # Read in SRF values themselves and lookup tables
+    #
+    (wave,srf,radiance,bt),inchans = read_srf_tables(srf_dir,noaa)
+
+    #
+    # Only select channels that are being used
+    #
+    start,end = inchans.index(chans[0]),len(chans)
+
+    #
+    # Copies as the tables are shared (and may be read only)
+    #
+    out_wave = np.array(wave[start:end,:])
+    out_srf = np.array(srf[start:end,:])
+    out_radiance = np.array(radiance[start:end,:])
+    out_radiance = out_radiance.transpose()
+    out_bt = np.array(bt[start:end,:])
+    out_bt = out_bt.transpose()
+
+    # Set 0's in srf to NaN
+    gd = (out_wave == 0)
+    if np.sum(gd) > 0:
+        out_wave[gd] = float('nan')
+        out_srf[gd] = float('nan')
+
+    return out_wave,out_srf,out_radiance,out_bt
+
+#
+# Compression profiles for the netCDF outputs as createVariable keywords.
+# The zstd/blosc/bzip2 filters need netCDF4 >= 1.6 (the wheels include
+# the HDF5 filter plugins).  The netCDF blosc filter fails on chunks it
+# cannot compress so check blosc with benchmark_compression.py first
+#
+compression_profiles = {
+    'none':{'zlib':False,'complevel':0,'shuffle':False},
+    'zlib1':{'zlib':True,'complevel':1,'shuffle':True},
+    'zlib4':{'zlib':True,'complevel':4,'shuffle':True},
+    'zlib5':{'zlib':True,'complevel':5,'shuffle':True},
+    'zlib6':{'zlib':True,'complevel':6,'shuffle':True},
+    'zlib9':{'zlib':True,'complevel':9,'shuffle':True},
+    'zstd':{'compression':'zstd','complevel':4,'shuffle':True},
+    'bzip2':{'compression':'bzip2','complevel':9,'shuffle':True},
+    'blosc_lz4':{'compression':'blosc_lz4','complevel':5,'shuffle':False},
+    'blosc_zstd':{'compression':'blosc_zstd','complevel':5,'shuffle':False},
+    }
+
+#
+# netCDF4 flags saying if a filter is available
+#
+compression_filters = {'zstd':'__has_zstandard_support__',\
+                           'bzip2':'__has_bzip2_support__',\
+                           'blosc_lz4':'__has_blosc_support__',\
+                           'blosc_zstd':'__has_blosc_support__'}
+
+#
+# Default compression of the Monte Carlo ensemble
+#
+ensemble_compression = compression_profiles['zlib9']
+
+#
+# createVariable keywords for a compression profile (default if profile
+# is None)
+#
+def get_compression(profile,default=None):
+
+    if profile is None:
+        return default
+    try:
+        kwargs = compression_profiles[profile]
+    except KeyError:
+        raise Exception('Unknown compression profile: {0}'.format(profile))
+    if 'compression' in kwargs and \
+            not getattr(netCDF4,compression_filters[kwargs['compression']],\
+                            False):
+        raise Exception('netCDF4 does not support {0} compression'.\
+                            format(kwargs['compression']))
+
+    return kwargs
+
+#
+# Compression level for FCDRWriter.write - it only supports zlib so
+# other filters fall back to the writer default (None), warning once
+#
+def fcdr_compression_level(profile):
+
+    kwargs = get_compression(profile)
+    if kwargs is None:
+        return None
+    if 'compression' in kwargs:
+        warnings.warn('FCDRWriter only supports zlib: using its default '\
+                          'compression')
+        return None
+    if not kwargs['zlib']:
+        return 0
+
+    return kwargs['complevel']
+
+#
+# (shuffle,complevel) if chunks can be compressed in parallel (threads >
+# 1) and written directly with h5py for this compression (zlib with
+# optional shuffle only), otherwise None
+#
+def direct_chunk_compression(compression,threads=1):
+
+    if threads <= 1 or h5py is None:
+        return None
+    if compression.get('compression','zlib') != 'zlib' or \
+            not compression.get('zlib',False):
+        return None
+
+    return compression.get('shuffle',False),compression.get('complevel',4)
+
+#
+# Compress a single chunk (at offset in values) in the same way as the
+# HDF5 shuffle and deflate filters.  Edge chunks are padded to the full
+# chunk shape with fill_value
+#
+def compress_chunk(values,chunks,fill_value,shuffle,complevel,offset):
+
+    index = tuple([slice(offset[k],offset[k]+chunks[k]) \
+                       for k in range(len(chunks))])
+    chunk = values[index]
+    if chunk.shape != tuple(chunks):
+        padded = np.full(chunks,fill_value,dtype=values.dtype)
+        padded[tuple([slice(0,n) for n in chunk.shape])] = chunk
+        chunk = padded
+    chunk = np.ascontiguousarray(chunk)
+    if shuffle and chunk.itemsize > 1:
+        chunk = chunk.view(np.uint8).reshape(-1,chunk.itemsize).T.copy()
+
+    return zlib.compress(chunk.tobytes(),complevel)
+
+#
+# Write a block of values (starting at start along the first dimension,
+# a multiple of the chunk size) to an h5py dataset with chunks compressed
+# in a thread pool (zlib releases the GIL)
+#
+def write_direct_chunks(dataset,start,values,shuffle,complevel,pool):
+
+    chunks = dataset.chunks
+    offsets = list(itertools.product(*[range(0,values.shape[k],chunks[k]) \
+                                           for k in range(values.ndim)]))
+    compress = functools.partial(compress_chunk,values,chunks,\
+                                     dataset.fillvalue,shuffle,complevel)
+    for offset,buffer in zip(offsets,pool.imap(compress,offsets)):
+        dataset.id.write_direct_chunk((start+offset[0],)+offset[1:],buffer)
+
+#
+# Fill the (already defined) ensemble variables with parallel chunk
+# compression (threads) and direct chunk writes.  The netCDF4 library has
+# already set up the chunking, filters and metadata so the file stays
+# netCDF4
+#
+def write_ensemble_chunks(file_ensemble,data,encodings,direct,threads,\
+                              pixels=None,statistics=None):
+
+    shuffle,complevel = direct
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        with h5py.File(file_ensemble,'r+') as fp:
+            datasets = [fp[entry[0]] for entry in ensemble_variables]
+            #
+            # Member blocks have to start on a chunk boundary of every
+            # variable
+            #
+            step = int(np.lcm.reduce([dataset.chunks[0] \
+                                          for dataset in datasets]))
+
+            def write(i,members,values):
+                write_direct_chunks(datasets[i],members.start,values,\
+                                        shuffle,complevel,pool)
+
+            stream_ensemble(data,ensemble_blocks(data,step=step),encodings,\
+                                write,pixels=pixels,statistics=statistics)
+    finally:
+        pool.close()
+        pool.join()
+
+#
+# Encodings (dtype,scale_factor,_FillValue) of the Monte Carlo ensemble
+#
+ensemble_encodings = {'vis_int8':('i1',0.0006,-128),\
+                          'vis_int16':('i2',1e-05,-32768),\
+                          'ir_int8':('i1',1e-02,-128),\
+                          'ir_ocean_int16':('i2',1e-02,-32768),\
+                          'ir_int16':('i2',1e-03,-32768)}
+
+#
+# Monte Carlo ensemble variables - output name, data name, threshold
+# (larger deltas set to NaN), units, encoding (all data) and the encodings
+# that can be used for ocean only output (narrowest first)
+#
+ensemble_variables = [
+    ('Ch1_MC','ch1_MC',1.,'reflectance','vis_int16',['vis_int8','vis_int16']),
+    ('Ch2_MC','ch2_MC',1.,'reflectance','vis_int16',['vis_int8','vis_int16']),
+    ('Ch3a_MC','ch3a_MC',1.,'reflectance','vis_int16',\
+         ['vis_int8','vis_int16']),
+    ('Ch3b_MC','ch3_MC',30.,'K','ir_int16',['ir_int8','ir_ocean_int16']),
+    ('Ch4_MC','ch4_MC',30.,'K','ir_int16',['ir_int8','ir_ocean_int16']),
+    ('Ch5_MC','ch5_MC',30.,'K','ir_int16',['ir_int8','ir_ocean_int16']),
+    ]
+
+#
+# Chunk layouts of the ensemble variables - (members,lines,elements) per
+# chunk with None for the whole dimension.  Ocean pixel (nMC,npix) files
+# use lines*elements pixels per chunk.  'netcdf' keeps the library
+# default, 'balanced' (~1MB int16 chunks) suits both reading a few
+# members over the orbit and all members over a small window.  Members
+# per chunk are capped at ensemble_block_members so a block of members
+# (which starts on a chunk boundary) stays within ensemble_block_bytes
+#
+ensemble_chunk_layouts = {'netcdf':None,\
+                              'balanced':(10,128,None),\
+                              'member':(1,512,None),\
+                              'pixel':(None,32,64)}
 
 #
-# Get SRF information for a given AVHRR
+# Chunk sizes of the ensemble variables (None for the netCDF default)
+#
+def ensemble_chunk_sizes(data,pixels=None,layout='balanced'):
+
+    try:
+        chunks = ensemble_chunk_layouts[layout]
+    except KeyError:
+        raise Exception('Unknown ensemble chunk layout: {0}'.format(layout))
+    if chunks is None:
+        return None
+    shape = (min(data.nmc,ensemble_block_members(data)),data.ny,data.nx)
+    chunks = [max(1,min(shape[i],shape[i] if chunks[i] is None \
+                            else chunks[i])) for i in range(3)]
+    if pixels is None:
+        return tuple(chunks)
+
+    return (chunks[0],max(1,min(len(pixels),chunks[1]*chunks[2])))
+
+#
+# Approximate memory (bytes) used per block of members when writing the
+# ensemble (all ensemble variables of a block are held together)
+#
+ensemble_block_bytes = 256*1024**2
+
+#
+# Members per block that fit in ensemble_block_bytes
+#
+def ensemble_block_members(data):
+
+    return max(1,int(ensemble_block_bytes/\
+                         (4*(len(ensemble_variables)+8)*data.ny*data.nx)))
+
+#
+# Subset of Monte Carlo members of an ensemble variable (only reading
+# those members if the data supports it)
+#
+def get_ensemble_members(data,name,members):
+
+    if hasattr(data,'get_members'):
+        return data.get_members(name,members)
+
+    return getattr(data,name)[members]
+
+#
+# Block of ensemble members (always a copy) with deltas larger than
+# threshold set to NaN.  If pixels (flattened (y,x) index) is given only
+# those pixels are returned (nMC,npix)
 #
-def get_srf(noaa,allchans):
+def ensemble_block(data,name,members,threshold,pixels=None):
 
-    srf_dir = \
-        '/gws/nopw/j04/fiduceo/Users/jmittaz/FCDR/Mike/FCDR_AVHRR/SRF/data/'
+    values = np.ma.getdata(get_ensemble_members(data,name,members))
+    if pixels is None:
+        values = np.array(values)
+    else:
+        values = values.reshape(values.shape[0],-1)[:,pixels]
+    with np.errstate(invalid='ignore'):
+        gd = (np.abs(values) > threshold)
+    if np.sum(gd) > 0:
+        values[gd] = float('nan')
+
+    return values
+
+#
+# Member blocks to write the ensemble in
+#
+def ensemble_blocks(data,step=1):
 
+    nmembers = ensemble_block_members(data)
     #
-    # Remove visible channels as they are not controlled by a FIDUCEO
-    # process and therefore we can't know what was used
+    # Multiple of step (e.g. chunk size) members
     #
-    gd = (allchans >= 3)
-    chans = allchans[gd]
+    nmembers = max(step,(nmembers//step)*step)
+    return [slice(i,min(i+nmembers,data.nmc)) \
+                for i in range(0,data.nmc,nmembers)]
+
+#
+# Maximum absolute (finite) delta of each ensemble variable from a single
+# pass over the member blocks.  NaN if there are no finite deltas
+#
+def ensemble_maxima(data,blocks,pixels=None):
+
+    maxima = np.zeros(len(ensemble_variables))+float('nan')
+    for members in blocks:
+        for i in range(len(ensemble_variables)):
+            outname,name,threshold = ensemble_variables[i][0:3]
+            values = ensemble_block(data,name,members,threshold,pixels=pixels)
+            #
+            # fmax/fmin ignore NaNs
+            #
+            maxima[i] = np.fmax(maxima[i],\
+                                    np.fmax(np.fmax.reduce(values,axis=None,\
+                                                               initial=np.nan),\
+                                                -np.fmin.reduce(values,axis=None,\
+                                                                    initial=np.nan)))
+
+    return maxima
+
+#
+# Choose the encoding for each ensemble variable.  For ocean only output
+# this is the narrowest integer type that holds the largest delta at its
+# scale factor (only looking at pixels if given)
+#
+def plan_ensemble(data,blocks,ocean_only=False,pixels=None):
+
+    if not ocean_only:
+        return [ensemble_encodings[entry[4]] for entry in ensemble_variables]
+
+    maxima = ensemble_maxima(data,blocks,pixels=pixels)
+    encodings = []
+    for i in range(len(ensemble_variables)):
+        candidates = [ensemble_encodings[name] for name \
+                          in ensemble_variables[i][5]]
+        encoding = candidates[-1]
+        for dtype,scale_factor,fill_value in candidates:
+            if not np.isfinite(maxima[i]) or \
+                    maxima[i]/scale_factor < np.iinfo(dtype).max:
+                encoding = (dtype,scale_factor,fill_value)
+                break
+        encodings.append(encoding)
+
+    return encodings
+
+#
+# Pack ensemble deltas into an encoding in the same way as xarray (in
+# the precision of the deltas)
+#
+def quantise_ensemble(values,encoding):
+
+    dtype,scale_factor,fill_value = encoding
+    values /= scale_factor
+    gd = ~np.isfinite(values)
+    if np.sum(gd) > 0:
+        values[gd] = fill_value
+    np.around(values,out=values)
+
+    return values.astype(dtype)
+
+#
+# Stream the ensemble a block of members at a time.  All variables of a
+# block are read together so the summary statistics (if given) see every
+# channel of a member before the deltas are quantised and passed to
+# write(i,members,values)
+#
+def stream_ensemble(data,blocks,encodings,write,pixels=None,statistics=None):
+
+    for members in blocks:
+        values = [ensemble_block(data,entry[1],members,entry[2],pixels=pixels) \
+                      for entry in ensemble_variables]
+        if statistics is not None:
+            statistics.add(values)
+        for i in range(len(ensemble_variables)):
+            write(i,members,quantise_ensemble(values[i],encodings[i]))
+            values[i] = None
+
+#
+# Land mask (write_ensemble land_mask_file, set with --land-mask) used to
+# store only ocean pixels in ocean only ensembles.  The file has 1-D
+# latitude/longitude coordinates and a (lat,lon) mask (non-zero for land)
+# named as in land_mask_names
+#
+land_mask_names = ('lat','lon','mask')
+
+#
+# Read the land mask - once per process
+#
+@functools.lru_cache(maxsize=None)
+def read_land_mask(filename):
+
+    ncid = netCDF4.Dataset(filename,'r')
+    try:
+        lat = np.asarray(ncid.variables[land_mask_names[0]][:],\
+                             dtype=np.float64)
+        lon = np.asarray(ncid.variables[land_mask_names[1]][:],\
+                             dtype=np.float64)
+        land = (np.ma.filled(ncid.variables[land_mask_names[2]][:],1) != 0)
+    finally:
+        ncid.close()
+
+    return lat,lon,land
+
+#
+# Index of the nearest grid coordinate (ascending or descending) to values
+#
+def nearest_grid_index(coords,values):
+
+    descending = coords[0] > coords[-1]
+    if descending:
+        coords = coords[::-1]
+    index = np.clip(np.searchsorted(coords,values),1,len(coords)-1)
+    left = (values-coords[index-1]) < (coords[index]-values)
+    index = index-left.astype(np.int64)
+    if descending:
+        index = len(coords)-1-index
+
+    return index
 
+#
+# Flattened (y,x) index of the ocean pixels of an orbit
+#
+def ocean_pixels(data,filename):
+
+    lat_grid,lon_grid,land = read_land_mask(filename)
+    lat = np.ma.getdata(data.lat).astype(np.float64).ravel()
+    lon = np.ma.getdata(data.lon).astype(np.float64).ravel()
+    with np.errstate(invalid='ignore'):
+        good = np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90.)
+    #
+    # Match the longitude convention of the mask
     #
-    # Get filenames
-    #
-    if noaa == 'TIROSN':
-        srf_file_wave = srf_dir+'tiros-n_wave.dat'
-        srf_file_srf = srf_dir+'tiros-n_srf.dat'
-        lut_radiance = srf_dir+'tiros-n_rad.dat'
-        lut_bt = srf_dir+'tiros-n_bt.dat'
-        inchans = [3,4]
-    elif noaa == 'NOAA06':
-        srf_file_wave = srf_dir+'noaa06_wave.dat'
-        srf_file_srf = srf_dir+'noaa06_srf.dat'
-        lut_radiance = srf_dir+'noaa06_rad.dat'
-        lut_bt = srf_dir+'noaa06_bt.dat'
-        inchans = [3,4]
-    elif noaa == 'NOAA07':
-        srf_file_wave = srf_dir+'noaa07_wave.dat'
-        srf_file_srf = srf_dir+'noaa07_srf.dat'
-        lut_radiance = srf_dir+'noaa07_rad.dat'
-        lut_bt = srf_dir+'noaa07_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA08':
-        srf_file_wave = srf_dir+'noaa08_wave.dat'
-        srf_file_srf = srf_dir+'noaa08_srf.dat'
-        lut_radiance = srf_dir+'noaa08_rad.dat'
-        lut_bt = srf_dir+'noaa08_bt.dat'
-        inchans = [3,4]
-    elif noaa == 'NOAA09':
-        srf_file_wave = srf_dir+'noaa09_wave.dat'
-        srf_file_srf = srf_dir+'noaa09_srf.dat'
-        lut_radiance = srf_dir+'noaa09_rad.dat'
-        lut_bt = srf_dir+'noaa09_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA10':
-        srf_file_wave = srf_dir+'noaa10_wave.dat'
-        srf_file_srf = srf_dir+'noaa10_srf.dat'
-        lut_radiance = srf_dir+'noaa10_rad.dat'
-        lut_bt = srf_dir+'noaa10_bt.dat'
-        inchans = [3,4]
-    elif noaa == 'NOAA11':
-        srf_file_wave = srf_dir+'noaa11_wave.dat'
-        srf_file_srf = srf_dir+'noaa11_srf.dat'
-        lut_radiance = srf_dir+'noaa11_rad.dat'
-        lut_bt = srf_dir+'noaa11_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA12':
-        srf_file_wave = srf_dir+'noaa12_wave.dat'
-        srf_file_srf = srf_dir+'noaa12_srf.dat'
-        lut_radiance = srf_dir+'noaa12_rad.dat'
-        lut_bt = srf_dir+'noaa12_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA14':
-        srf_file_wave = srf_dir+'noaa14_wave.dat'
-        srf_file_srf = srf_dir+'noaa14_srf.dat'
-        lut_radiance = srf_dir+'noaa14_rad.dat'
-        lut_bt = srf_dir+'noaa14_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA15':
-        srf_file_wave = srf_dir+'noaa15_wave.dat'
-        srf_file_srf = srf_dir+'noaa15_srf.dat'
-        lut_radiance = srf_dir+'noaa15_rad.dat'
-        lut_bt = srf_dir+'noaa15_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA16':
-        srf_file_wave = srf_dir+'noaa16_wave.dat'
-        srf_file_srf = srf_dir+'noaa16_srf.dat'
-        lut_radiance = srf_dir+'noaa16_rad.dat'
-        lut_bt = srf_dir+'noaa16_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA17':
-        srf_file_wave = srf_dir+'noaa17_wave.dat'
-        srf_file_srf = srf_dir+'noaa17_srf.dat'
-        lut_radiance = srf_dir+'noaa17_rad.dat'
-        lut_bt = srf_dir+'noaa17_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA18':
-        srf_file_wave = srf_dir+'noaa18_wave.dat'
-        srf_file_srf = srf_dir+'noaa18_srf.dat'
-        lut_radiance = srf_dir+'noaa18_rad.dat'
-        lut_bt = srf_dir+'noaa18_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'NOAA19':
-        srf_file_wave = srf_dir+'noaa19_wave.dat'
-        srf_file_srf = srf_dir+'noaa19_srf.dat'
-        lut_radiance = srf_dir+'noaa19_rad.dat'
-        lut_bt = srf_dir+'noaa19_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'METOPA':
-        srf_file_wave = srf_dir+'metopa_wave.dat'
-        srf_file_srf = srf_dir+'metopa_srf.dat'
-        lut_radiance = srf_dir+'metopa_rad.dat'
-        lut_bt = srf_dir+'metopa_bt.dat'
-        inchans = [3,4,5]
-    elif noaa == 'METOPB':
-        srf_file_wave = srf_dir+'metopb_wave.dat'
-        srf_file_srf = srf_dir+'metopb_srf.dat'
-        lut_radiance = srf_dir+'metopb_rad.dat'
-        lut_bt = srf_dir+'metopb_bt.dat'
-        inchans = [3,4,5]
+    if lon_grid.max() > 180.:
+        lon = np.mod(lon,360.)
     else:
-        raise Exception('Cannot find noaa name for SRF')
+        lon = np.mod(lon+180.,360.)-180.
+    ocean = np.zeros(lat.shape,dtype=np.bool)
+    ocean[good] = ~land[nearest_grid_index(lat_grid,lat[good]),\
+                            nearest_grid_index(lon_grid,lon[good])]
+
+    return np.where(ocean)[0].astype(np.int32)
+
+#
+# Lines per scanline block of the ensemble summary covariance
+#
+summary_block_lines = 100
+
+#
+# Chan et al. merge of the co-moments of two sets of samples a and b
+# (count n, means mx and my, co-moment c = sum((x-mx)*(y-my))).  Means of
+# empty sets have to be finite.  With x == y this merges variances
+#
+def merge_comoments(n_a,mx_a,my_a,c_a,n_b,mx_b,my_b,c_b):
+
+    n = n_a+n_b
+    frac = n_b/np.maximum(n,1)
+    dx = mx_b-mx_a
+    dy = my_b-my_a
+
+    return n,mx_a+dx*frac,my_a+dy*frac,c_a+c_b+dx*dy*n_a*frac
+
+#
+# Single pass ensemble statistics updated a block of members at a time
+# (Welford/Chan) in float64.  Per pixel count, mean and sum of squared
+# deviations of each ensemble variable and, per scanline block, the
+# co-moments between variables of the deltas pooled over members and
+# pixels (only using samples where both are finite)
+#
+class ensemble_statistics(object):
 
     #
-    # Read in SRF values themselves
-    #    
-    wave = np.loadtxt(srf_file_wave)
-    srf = np.loadtxt(srf_file_srf)
+    # Add a block of members - list of (members,y,x) or (members,npix)
+    # deltas of each ensemble variable (NaN if missing)
+    #
+    def add(self,values):
+
+        values = [v.reshape(v.shape[0],-1) for v in values]
+        nvar = len(values)
+        for i in range(nvar):
+            finite = np.isfinite(values[i])
+            count = finite.sum(axis=0)
+            mean = np.where(finite,values[i],0.).sum(axis=0,dtype=np.float64)/\
+                np.maximum(count,1)
+            m2 = (np.where(finite,values[i]-mean,0.)**2).sum(axis=0)
+            count,mean,mean,m2 = merge_comoments(self.count[i],self.mean[i],\
+                                                     self.mean[i],self.m2[i],\
+                                                     count,mean,mean,m2)
+            self.count[i] = count
+            self.mean[i] = mean
+            self.m2[i] = m2
+
+        #
+        # Per scanline block the samples (shifted by the running block
+        # mean) zeroed where missing and their validity side by side, so
+        # one product over the channel axis gives the pair counts, sums
+        # and co-products of every pair of variables
+        #
+        for b in range(self.nblock):
+            start,stop = self.bounds[b],self.bounds[b+1]
+            if stop == start:
+                continue
+            shift = np.diagonal(self.pair_mean[b]).copy()
+            samples = np.zeros((values[0].shape[0]*(stop-start),2*nvar))
+            for i in range(nvar):
+                block = values[i][:,start:stop].ravel()
+                finite = np.isfinite(block)
+                samples[:,i] = np.where(finite,block-shift[i],0.)
+                samples[:,nvar+i] = finite
+            products = np.dot(samples.T,samples)
+            count = products[nvar:,nvar:]
+            sx = products[0:nvar,nvar:]
+            sy = sx.T
+            n = np.maximum(count,1)
+            c = products[0:nvar,0:nvar]-sx*sy/n
+            mx = shift[:,np.newaxis]+sx/n
+            my = shift[np.newaxis,:]+sy/n
+            count,mx,my,c = merge_comoments(self.pair_count[b],\
+                                                self.pair_mean[b],\
+                                                self.pair_mean[b].T,\
+                                                self.comoment[b],\
+                                                count,mx,my,c)
+            self.pair_count[b] = count
+            self.pair_mean[b] = mx
+            self.comoment[b] = c
 
     #
-    # Read in lookup tables
+    # Per pixel ensemble mean and standard deviation (NaN without data)
     #
-    radiance = np.loadtxt(lut_radiance)
-    bt = np.loadtxt(lut_bt)
+    def spread(self):
+
+        count = self.count.astype(np.float64)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = np.where(count > 0,self.mean,np.nan)
+            std = np.where(count > 1,np.sqrt(self.m2/(count-1)),np.nan)
+
+        return mean.astype(np.float32),std.astype(np.float32)
 
     #
-    # Only select channels that are being used
+    # Covariance between ensemble variables per scanline block
+    # (nblock,nvar,nvar)
     #
-    start,end = inchans.index(chans[0]),len(chans)
+    def covariance(self):
 
-    out_wave = wave[start:end,:]
-    out_srf = srf[start:end,:]
-    out_radiance = radiance[start:end,:]
-    out_radiance = out_radiance.transpose()
-    out_bt = bt[start:end,:]
-    out_bt = out_bt.transpose()
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return np.where(self.pair_count > 1,\
+                                self.comoment/(self.pair_count-1),np.nan)
 
-    # Set 0's in srf to NaN
-    gd = (out_wave == 0)
-    if np.sum(gd) > 0:
-        out_wave[gd] = float('nan')
-        out_srf[gd] = float('nan')
+    def __init__(self,data,pixels=None):
 
-    return out_wave,out_srf,out_radiance,out_bt
+        if pixels is None:
+            pixels = np.arange(data.ny*data.nx)
+        nvar = len(ensemble_variables)
+        self.nblock = (data.ny+summary_block_lines-1)//summary_block_lines
+        #
+        # pixels are in (y,x) order so each scanline block is a range
+        #
+        self.bounds = np.searchsorted((pixels//data.nx)//summary_block_lines,\
+                                          np.arange(self.nblock+1))
+        self.count = np.zeros((nvar,len(pixels)),\
+                                  dtype=np.min_scalar_type(data.nmc))
+        self.mean = np.zeros((nvar,len(pixels)))
+        self.m2 = np.zeros((nvar,len(pixels)))
+        self.pair_count = np.zeros((self.nblock,nvar,nvar))
+        self.pair_mean = np.zeros((self.nblock,nvar,nvar))
+        self.comoment = np.zeros((self.nblock,nvar,nvar))
 
 #
-# Write MonteCarlo ensemble output (L1)
+# Write the ensemble summary file from the accumulated statistics.  Uses
+# the same pixel layout as the ensemble
 #
-def write_ensemble(file_out,file_uuid,data,ocean_only=False):
+def write_ensemble_summary(file_summary,file_ensemble,attributes,data,\
+                               statistics,pixels=None,compression=None):
+
+    attributes = dict(attributes)
+    attributes['title'] = attributes['title']+' Summary'
+    attributes['origin_Ensemble'] = file_ensemble
+    attributes['origin_Ensemble_UUID'] = attributes['UUID']
+    attributes['UUID'] = '{0}'.format(uuid.uuid4())
+    attributes['nMC'] = data.nmc
+
+    if compression is None:
+        compression = ensemble_compression
+    mean,std = statistics.spread()
+    covariance = statistics.covariance()
+    ncid = netCDF4.Dataset(file_summary,'w')
+    try:
+        ncid.setncatts(attributes)
+        ncid.createDimension('y',size=data.ny)
+        ncid.createDimension('x',size=data.nx)
+        ncid.createDimension('channel',size=len(ensemble_variables))
+        ncid.createDimension('scanline_block',size=statistics.nblock)
+        if pixels is None:
+            dims = ('y','x')
+        else:
+            dims = ('npix',)
+            ncid.createDimension('npix',size=len(pixels))
+            var = ncid.createVariable('ocean_index','i4',dims,**compression)
+            var.long_name = 'Index of ocean pixels in the flattened (y,x) grid'
+            if len(pixels) > 0:
+                var[:] = pixels
+        shape = tuple([len(ncid.dimensions[dim]) for dim in dims])
+
+        for i in range(len(ensemble_variables)):
+            outname,name,threshold,units = ensemble_variables[i][0:4]
+            for suffix,long_name,values in \
+                    [('_mean','Ensemble mean of MonteCarlo delta from FCDR',\
+                          mean[i]),\
+                     ('_std','Ensemble standard deviation of MonteCarlo '\
+                          'delta from FCDR',std[i])]:
+                var = ncid.createVariable(outname+suffix,'f4',dims,\
+                                              fill_value=np.float32(np.nan),\
+                                              **compression)
+                var.units = units
+                var.long_name = long_name
+                if pixels is None:
+                    var.coordinates = 'longitude latitude'
+                else:
+                    var.comment = 'Ocean pixels only (see ocean_index)'
+                if len(values) > 0:
+                    var[:] = values.reshape(shape)
+
+        var = ncid.createVariable('scanline_block_start','i4',\
+                                      ('scanline_block',))
+        var.long_name = 'First scanline of the covariance block'
+        var[:] = np.arange(statistics.nblock)*summary_block_lines
+        var = ncid.createVariable('covariance','f4',\
+                                      ('scanline_block','channel','channel'),\
+                                      fill_value=np.float32(np.nan))
+        var.long_name = 'Channel to channel covariance of MonteCarlo deltas '\
+            'pooled over the members and pixels of a scanline block'
+        var.channels = ' '.join([entry[0] for entry in ensemble_variables])
+        var.comment = 'Units are the product of the channel units'
+        var[:] = covariance.astype(np.float32)
+    finally:
+        ncid.close()
 
-    ch1_mc = np.copy(data.ch1_MC)
-    gd = (np.abs(ch1_mc) > 1.0000)
-    if np.sum(gd) > 0:
-        ch1_mc[gd] = float('nan')
-    ch2_mc = np.copy(data.ch2_MC)
-    gd = (np.abs(ch2_mc) > 1.0000)
-    if np.sum(gd) > 0:
-        ch2_mc[gd] = float('nan')
-    ch3a_mc = np.copy(data.ch3a_MC)
-    gd = (np.abs(ch3a_mc) > 1.0000)
-    if np.sum(gd) > 0:
-        ch3a_mc[gd] = float('nan')
-    ch3_mc = np.copy(data.ch3_MC)
-    gd = (np.abs(ch3_mc) > 30.000)
-    if np.sum(gd) > 0:
-        ch3_mc[gd] = float('nan')
-    ch4_mc = np.copy(data.ch4_MC)
-    gd = (np.abs(ch4_mc) > 30.000)
-    if np.sum(gd) > 0:
-        ch4_mc[gd] = float('nan')
-    ch5_mc = np.copy(data.ch5_MC)
-    gd = (np.abs(ch5_mc) > 30.000)
-    if np.sum(gd) > 0:
-        ch5_mc[gd] = float('nan')
+#
+# Write MonteCarlo ensemble output (L1).  The variables are created first
+# and filled a block of members at a time so memory is bounded by
+# ensemble_block_bytes rather than set by the ensemble size.  If ocean
+# only and a land mask is set only the ocean pixels are stored (nMC,npix)
+# with their index (ocean_index) - see read_ensemble.py.  With summary
+# the ensemble mean, spread and channel covariance are accumulated as the
+# members stream through and written to <file>_Ensemble_Summary.nc.
+# compression is a compression profile (default ensemble_compression) and
+# land_mask_file the land mask for ocean only output (None for the full
+# grid).  chunk_layout is one of ensemble_chunk_layouts.  With
+# write_threads > 1 chunks are compressed in parallel (zlib profiles,
+# needs h5py)
+#
+def write_ensemble(file_out,file_uuid,data,ocean_only=False,\
+                       compression=None,land_mask_file=None,summary=False,\
+                       chunk_layout='balanced',write_threads=1):
+
+    blocks = ensemble_blocks(data)
+    if ocean_only and land_mask_file is not None:
+        pixels = ocean_pixels(data,land_mask_file)
+        dims = ('nMC','npix')
+    else:
+        pixels = None
+        dims = ('nMC','y','x')
 
     #
     # If ocean only then use reduced resolution output to save space
     #
-    if ocean_only:
+    encodings = plan_ensemble(data,blocks,ocean_only=ocean_only,\
+                                  pixels=pixels)
 
-        gd = np.isfinite(ch1_mc)
-        if np.abs(ch1_mc[gd]).max()/0.0006 < 127:
-            d1 = xarray.DataArray(ch1_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int8',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':0.0006,\
-                                                    '_FillValue':-128,\
-                                                    'valid_min':-127,\
-                                                    'valid_max':127,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'reflectance',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        else:
-            d1 = xarray.DataArray(ch1_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int16',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-05,\
-                                                    '_FillValue':-32768,\
-                                                    'valid_min':-10000,\
-                                                    'valid_max':10000,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'reflectance',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        gd = np.isfinite(ch2_mc)
-        if np.abs(ch2_mc[gd]).max()/0.0006 < 127:
-            d2 = xarray.DataArray(ch2_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int8',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':0.0006,\
-                                                    '_FillValue':-128,\
-                                                    'valid_min':-127,\
-                                                    'valid_max':127,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'reflectance',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        else:
-            d2 = xarray.DataArray(ch2_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int16',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-05,\
-                                                    '_FillValue':-32768,\
-                                                    'valid_min':-10000,\
-                                                    'valid_max':10000,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'reflectance',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        gd = np.isfinite(ch3a_mc)
-        if np.abs(ch3a_mc[gd]).max()/0.0006 < 127:
-            d3a = xarray.DataArray(ch3a_mc,dims=('nMC','y','x'),\
-                                       encoding={'dtype':'int8',\
-                                                     'add_offset':0.,\
-                                                     'scale_factor':0.0006,\
-                                                     '_FillValue':-128,\
-                                                     'valid_min':-127,\
-                                                     'valid_max':127,\
-                                                     'zlib':True,\
-                                                     'complevel':9,\
-                                                     'shuffle':True},\
-                                       attrs={'units':'reflectance',\
-                                                  'coordinates':'longitude latitude',\
-                                                  'long_name':'MonteCarlo delta from FCDR'}\
-                                       )
-        else:
-            d3a = xarray.DataArray(ch3a_mc,dims=('nMC','y','x'),\
-                                       encoding={'dtype':'int16',\
-                                                     'add_offset':0.,\
-                                                     'scale_factor':1e-05,\
-                                                     '_FillValue':-32768,\
-                                                     'valid_min':-10000,\
-                                                     'valid_max':10000,\
-                                                     'zlib':True,\
-                                                     'complevel':9,\
-                                                     'shuffle':True},\
-                                       attrs={'units':'reflectance',\
-                                                  'coordinates':'longitude latitude',\
-                                                  'long_name':'MonteCarlo delta from FCDR'}\
-                                   )
-        gd = np.isfinite(ch3_mc)
-        if np.abs(ch3_mc[gd]).max()/1e-2 < 127:
-            d3 = xarray.DataArray(ch3_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int8',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-02,\
-                                                    '_FillValue':-128,\
-                                                    'valid_min':-127,\
-                                                    'valid_max':127,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'K',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        else:
-            d3 = xarray.DataArray(ch3_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int16',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-02,\
-                                                    '_FillValue':-32768,\
-                                                    'valid_min':-30000,\
-                                                    'valid_max':30000,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'K',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        gd = np.isfinite(ch4_mc)
-        if np.abs(ch4_mc[gd]).max()/1e-2 < 127:
-            d4 = xarray.DataArray(ch4_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int8',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-02,\
-                                                    '_FillValue':-128,\
-                                                    'valid_min':-127,\
-                                                    'valid_max':127,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'K',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        else:
-            d4 = xarray.DataArray(ch4_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int16',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-02,\
-                                                    '_FillValue':-32768,\
-                                                    'valid_min':-30000,\
-                                                    'valid_max':30000,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'K',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        gd = np.isfinite(ch5_mc)
-        if np.abs(ch4_mc[gd]).max()/1e-2 < 127:
-            d5 = xarray.DataArray(ch5_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int8',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-02,\
-                                                    '_FillValue':-128,\
-                                                    'valid_min':-127,\
-                                                    'valid_max':127,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'K',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-        else:
-            d5 = xarray.DataArray(ch5_mc,dims=('nMC','y','x'),\
-                                      encoding={'dtype':'int16',\
-                                                    'add_offset':0.,\
-                                                    'scale_factor':1e-02,\
-                                                    '_FillValue':-32768,\
-                                                    'valid_min':-30000,\
-                                                    'valid_max':30000,\
-                                                    'zlib':True,\
-                                                    'complevel':9,\
-                                                    'shuffle':True},\
-                                      attrs={'units':'K',\
-                                                 'coordinates':'longitude latitude',\
-                                                 'long_name':'MonteCarlo delta from FCDR'}\
-                                      )
-    else:
-        d1 = xarray.DataArray(ch1_mc,dims=('nMC','y','x'),\
-                                  encoding={'dtype':'int16',\
-                                                'add_offset':0.,\
-                                                'scale_factor':1e-05,\
-                                                '_FillValue':-32768,\
-                                                'valid_min':-10000,\
-                                                'valid_max':10000,\
-                                                'zlib':True,\
-                                                'complevel':9,\
-                                                'shuffle':True},\
-                                  attrs={'units':'reflectance',\
-                                             'coordinates':'longitude latitude',\
-                                             'long_name':'MonteCarlo delta from FCDR'}\
-                                  )
-        d2 = xarray.DataArray(ch2_mc,dims=('nMC','y','x'),\
-                                  encoding={'dtype':'int16',\
-                                                'add_offset':0.,\
-                                                'scale_factor':1e-05,\
-                                                '_FillValue':-32768,\
-                                                'valid_min':-10000,\
-                                                'valid_max':10000,\
-                                                'zlib':True,\
-                                                'complevel':9,\
-                                                'shuffle':True},\
-                                  attrs={'units':'reflectance',\
-                                             'coordinates':'longitude latitude',\
-                                             'long_name':'MonteCarlo delta from FCDR'}\
-                                  )
-        d3a = xarray.DataArray(ch3a_mc,dims=('nMC','y','x'),\
-                                   encoding={'dtype':'int16',\
-                                                 'add_offset':0.,\
-                                                 'scale_factor':1e-05,\
-                                                 '_FillValue':-32768,\
-                                                 'valid_min':-10000,\
-                                                 'valid_max':10000,\
-                                                 'zlib':True,\
-                                                 'complevel':9,\
-                                                 'shuffle':True},\
-                                   attrs={'units':'reflectance',\
-                                              'coordinates':'longitude latitude',\
-                                              'long_name':'MonteCarlo delta from FCDR'}\
-                                   )
-        d3 = xarray.DataArray(ch3_mc,dims=('nMC','y','x'),\
-                                  encoding={'dtype':'int16',\
-                                                'add_offset':0.,\
-                                                'scale_factor':1e-03,\
-                                                '_FillValue':-32768,\
-                                                'valid_min':-30000,\
-                                                'valid_max':30000,\
-                                                'zlib':True,\
-                                                'complevel':9,\
-                                                'shuffle':True},\
-                                  attrs={'units':'K',\
-                                             'coordinates':'longitude latitude',\
-                                             'long_name':'MonteCarlo delta from FCDR'}\
-                                  )
-        d4 = xarray.DataArray(ch4_mc,dims=('nMC','y','x'),\
-                                  encoding={'dtype':'int16',\
-                                                'add_offset':0.,\
-                                                'scale_factor':1e-03,\
-                                                '_FillValue':-32768,\
-                                                'valid_min':-30000,\
-                                                'valid_max':30000,\
-                                                'zlib':True,\
-                                                'complevel':9,\
-                                                'shuffle':True},\
-                                  attrs={'units':'K',\
-                                             'coordinates':'longitude latitude',\
-                                             'long_name':'MonteCarlo delta from FCDR'}\
-                                  )
-        d5 = xarray.DataArray(ch5_mc,dims=('nMC','y','x'),\
-                                  encoding={'dtype':'int16',\
-                                                'add_offset':0.,\
-                                                'scale_factor':1e-03,\
-                                                '_FillValue':-32768,\
-                                                'valid_min':-30000,\
-                                                'valid_max':30000,\
-                                                'zlib':True,\
-                                                'complevel':9,\
-                                                'shuffle':True},\
-                                  attrs={'units':'K',\
-                                             'coordinates':'longitude latitude',\
-                                             'long_name':'MonteCarlo delta from FCDR'}\
-                                  )
-        
     if ocean_only:
-        ds = xarray.Dataset(data_vars={'Ch1_MC':d1,'Ch2_MC':d2,'Ch3a_MC':d3a,\
-                                           'Ch3b_MC':d3,'Ch4_MC':d4,'Ch5_MC':d5},\
-                                attrs={'Conventions':"CF-1.6",\
-                                           'licence':"This dataset is released for use under CC-BY licence (https://creativecommons.org/licenses/by/4.0/) and was developed in the EC FIDUCEO project \"Fidelity and Uncertainty in Climate Data Records from Earth Observations\". Grant Agreement: 638822.",\
-                                           'institution':"University of Reading",\
-                                           'title':data.version+" version of AVHRR Fundamental Climate Data Record Ensemble",\
-                                           'sensor':"AVHRR",\
-                                           'platform':data.noaa_string,\
-                                           'software_version':data.version,\
-                                           'origin_FCDR':file_out,\
-                                           'origin_FCDR_UUID':file_uuid,\
-                                           'MC_Seed':data.montecarlo_seed,\
-                                           'UUID':'{0}'.format(uuid.uuid4()),\
-                                           'Ensemble_Type':'Ocean_Only'})
+        ensemble_type = 'Ocean_Only'
     else:
-        ds = xarray.Dataset(data_vars={'Ch1_MC':d1,'Ch2_MC':d2,'Ch3a_MC':d3a,\
-                                           'Ch3b_MC':d3,'Ch4_MC':d4,'Ch5_MC':d5},\
-                                attrs={'Conventions':"CF-1.6",\
-                                           'licence':"This dataset is released for use under CC-BY licence (https://creativecommons.org/licenses/by/4.0/) and was developed in the EC FIDUCEO project \"Fidelity and Uncertainty in Climate Data Records from Earth Observations\". Grant Agreement: 638822.",\
-                                           'institution':"University of Reading",\
-                                           'title':data.version+" version of AVHRR Fundamental Climate Data Record Ensemble",\
-                                           'sensor':"AVHRR",\
-                                           'platform':data.noaa_string,\
-                                           'software_version':data.version,\
-                                           'origin_FCDR':file_out,\
-                                           'origin_FCDR_UUID':file_uuid,\
-                                           'MC_Seed':data.montecarlo_seed,\
-                                           'UUID':'{0}'.format(uuid.uuid4()),\
-                                           'Ensemble_Type':'All_Data'})
+        ensemble_type = 'All_Data'
 
     file_ensemble = os.path.splitext(file_out)[0]+'_Ensemble.nc'
-    ds.to_netcdf(file_ensemble)
+    attributes = {'Conventions':"CF-1.6",\
+                  'licence':"This dataset is released for use under CC-BY licence (https://creativecommons.org/licenses/by/4.0/) and was developed in the EC FIDUCEO project \"Fidelity and Uncertainty in Climate Data Records from Earth Observations\". Grant Agreement: 638822.",\
+                  'institution':"University of Reading",\
+                  'title':data.version+" version of AVHRR Fundamental Climate Data Record Ensemble",\
+                  'sensor':"AVHRR",\
+                  'platform':data.noaa_string,\
+                  'software_version':data.version,\
+                  'origin_FCDR':file_out,\
+                  'origin_FCDR_UUID':file_uuid,\
+                  'MC_Seed':data.montecarlo_seed,\
+                  'Spatial_Correlation_Scale':data.spatial_correlation_scale,\
+                  'UUID':'{0}'.format(uuid.uuid4()),\
+                  'Ensemble_Type':ensemble_type}
+    ncid = netCDF4.Dataset(file_ensemble,'w')
+    ncid.setncatts(attributes)
+    ncid.createDimension('nMC',size=data.nmc)
+    ncid.createDimension('y',size=data.ny)
+    ncid.createDimension('x',size=data.nx)
+
+    compression = get_compression(compression,ensemble_compression)
+    direct = direct_chunk_compression(compression,threads=write_threads)
+    if summary:
+        statistics = ensemble_statistics(data,pixels=pixels)
+    else:
+        statistics = None
+    variables = []
+    if pixels is None or len(pixels) > 0:
+        chunks = ensemble_chunk_sizes(data,pixels=pixels,layout=chunk_layout)
+    else:
+        chunks = None
+    try:
+        if pixels is not None:
+            ncid.Ensemble_Layout = 'Ocean_Pixels'
+            ncid.Land_Mask = os.path.basename(land_mask_file)
+            ncid.createDimension('npix',size=len(pixels))
+            var = ncid.createVariable('ocean_index','i4',('npix',),\
+                                          **compression)
+            var.long_name = 'Index of ocean pixels in the flattened (y,x) grid'
+            var[:] = pixels
+            if 0 == len(pixels):
+                direct = None
+        for i in range(len(ensemble_variables)):
+            outname,name,threshold,units = ensemble_variables[i][0:4]
+            dtype,scale_factor,fill_value = encodings[i]
+            var = ncid.createVariable(outname,dtype,dims,\
+                                          fill_value=fill_value,\
+                                          chunksizes=chunks,\
+                                          **compression)
+            var.units = units
+            if pixels is None:
+                var.coordinates = 'longitude latitude'
+            else:
+                var.comment = 'Ocean pixels only (see ocean_index)'
+            var.long_name = 'MonteCarlo delta from FCDR'
+            var.add_offset = 0.
+            var.scale_factor = scale_factor
+            var.quantisation_bits = 8*np.dtype(dtype).itemsize
+            var.set_auto_maskandscale(False)
+            variables.append(var)
+
+        def write(i,members,values):
+            variables[i][members,...] = values
+
+        if direct is None and (pixels is None or len(pixels) > 0):
+            stream_ensemble(data,blocks,encodings,write,pixels=pixels,\
+                                statistics=statistics)
+    finally:
+        ncid.close()
+
+    if direct is not None:
+        write_ensemble_chunks(file_ensemble,data,encodings,direct,\
+                                  write_threads,\
+                                  pixels=pixels,statistics=statistics)
+
+    if statistics is not None:
+        write_ensemble_summary(os.path.splitext(file_out)[0]+\
+                                   '_Ensemble_Summary.nc',file_ensemble,\
+                                   attributes,data,statistics,pixels=pixels,\
+                                   compression=compression)
 
 def ensemble_orig_netcdf(fileout,file_uuid,data):
 
@@ -2214,54 +2694,46 @@ def ensemble_orig_netcdf(fileout,file_uuid,data):
 # dependent on channel set
 #
 def main_outfile(data,ch3a_version,fileout='None',split=False,gbcs_l1c=False,\
-                     ocean_only=False):
+                     ocean_only=False,curuc_options=None,output_options=None):
+
+    #
+    # output_options: srf_dir (SRF/lookup tables, default srf_directory),
+    # compression (profile for all outputs, None keeps each writer's own
+    # default), land_mask_file (ocean only ensembles), ensemble_summary
+    # (write the ensemble summary file), ensemble_chunk_layout (chunk
+    # layout of the ensemble variables), write_threads (threads
+    # compressing the ensemble)
+    #
+    if output_options is None:
+        output_options = {}
+    compression = output_options.get('compression')
+    land_mask_file = output_options.get('land_mask_file')
+    ensemble_summary = output_options.get('ensemble_summary',False)
+    chunk_layout = output_options.get('ensemble_chunk_layout','balanced')
+    write_threads = output_options.get('write_threads',1)
 
     # Run CURUC to get CURUC values (lenths, vectors and chan cross 
     # correlations)
-    if data.noaa_string in ['NOAA06','NOAA08','NOAA10']:
-        # Setup CURUC for 2 channel IR AVHRR
-        chans = np.array([0,1,3,4],dtype=np.int8)
-    elif data.noaa_string in ['NOAA07','NOAA09','NOAA11','NOAA12','NOAA14']:
-        # Setup CURUC for 3 channel IR AVHRR
-        chans = np.array([0,1,3,4,5],dtype=np.int8)
-    elif data.noaa_string in ['NOAA15','NOAA16','NOAA17','NOAA18',\
-                                  'NOAA19','METOPA','METOPB','METOPC']:
-        # Setup CURUC for 2 or 3 channel IR AVHRR dependnet on ch3a
-        if ch3a_version:
-            chans = np.array([0,1,2,4,5],dtype=np.int8)
-        else:
-            chans = np.array([0,1,3,4,5],dtype=np.int8)
-    else:
-        raise Exception('noaa_string not found')
-    inchans = np.sort(chans)
-    #
-    # Make two sets of chans - one visible, one IR
+    chans = get_curuc_chans(data.noaa_string,ch3a_version)
     #
-    gd = (inchans <= 2)
-    vis_chans = inchans[gd]
-    gd = (inchans >= 3)
-    ir_chans = inchans[gd]
+    # Run CURUC for vis chans only, IR chans only - not common and IR chans
+    # only - common effects
     #
-    # Run CURUC for vis chans only
+    # curuc_options are passed to run_CURUC_passes (nproc, mem_budget,
+    # block_lines, dtype, validate, line_skip, elem_skip, cache_dir,
+    # cache_size, diag_prefix)
     #
+    if curuc_options is None:
+        curuc_options = {}
+    results = run_CURUC_passes(data,curuc_passes(chans),\
+                                   ch3a_version=ch3a_version,\
+                                   **curuc_options)
     vis_xline_length, vis_xelem_length, vis_xchan_corr_i, \
-        vis_xchan_corr_s, vis_xl_all, vis_xe_all = \
-        run_CURUC(data,vis_chans,vis_chans=True,common=False,\
-                      line_skip=5,elem_skip=25,ch3a_version=ch3a_version)
-    #
-    # Run CURUC for IR chans only - not common
-    #
+        vis_xchan_corr_s, vis_xl_all, vis_xe_all = results[0]
     ir_xline_length, ir_xelem_length, ir_xchan_corr_i, \
-        ir_xchan_corr_s, ir_xl_all, ir_xe_all = \
-        run_CURUC(data,ir_chans,vis_chans=False,common=False,\
-                      line_skip=5,elem_skip=25,ch3a_version=ch3a_version)
-    #
-    # Run CURUC for IR chans only - common effects
-    #
+        ir_xchan_corr_s, ir_xl_all, ir_xe_all = results[1]
     com_xline_length, com_xelem_length, com_xchan_corr_i, \
-        com_xchan_corr_s, com_xl_all, com_xe_all = \
-        run_CURUC(data,ir_chans,vis_chans=False,common=True,\
-                      line_skip=5,elem_skip=25,ch3a_version=ch3a_version)
+        com_xchan_corr_s, com_xl_all, com_xe_all = results[2]
 
     xline_length = np.copy(vis_xline_length.values)
     xline_length = np.append(xline_length,ir_xline_length.values,axis=0)
@@ -2285,7 +2757,8 @@ def main_outfile(data,ch3a_version,fileout='None',split=False,gbcs_l1c=False,\
     corr_l = xl_all[0:max_len+2,:]
 
     # Get SRF and lookup tables
-    srf_x,srf_y,lut_rad,lut_bt = get_srf(data.noaa_string,chans)
+    srf_x,srf_y,lut_rad,lut_bt = get_srf(data.noaa_string,chans,\
+                                             srf_dir=output_options.get('srf_dir'))
 
 # MT: 09-11-2017: define sensor specific channel_correlation_matrix (ccm)
 # JM: Now merge separate CURUC runs (vis, IR structured, IR common)
@@ -2383,7 +2856,8 @@ def main_outfile(data,ch3a_version,fileout='None',split=False,gbcs_l1c=False,\
 
     # Either write L1C with chan covariance or FIDUCEO easy FCDR
     if gbcs_l1c:
-        l1c.write_gbcs_l1c(fileout,data,S_s)
+        l1c_compression = get_compression(compression,l1c.netcdf_compression)
+        l1c.write_gbcs_l1c(fileout,data,S_s,compression=l1c_compression)
     else:
         writer = FCDRWriter()
 
@@ -2555,14 +3029,19 @@ def main_outfile(data,ch3a_version,fileout='None',split=False,gbcs_l1c=False,\
                 print(data.noaa_string)
                 raise Exception('Cannot match data.noaa_string')
             file_out = writer.create_file_name_FCDR_easy('AVHRR',noaa_string,\
-                                                             data.date_time[0],\
-                                                             data.date_time[-1],\
+                                                             data.date_time[0].astype(datetime.datetime),\
+                                                             data.date_time[-1].astype(datetime.datetime),\
                                                              data.version)
             #
             # If montecarlo then output this file as well
             #
             if data.montecarlo:
-                write_ensemble(file_out,file_uuid,data,ocean_only=ocean_only)
+                write_ensemble(file_out,file_uuid,data,ocean_only=ocean_only,\
+                                   compression=compression,\
+                                   land_mask_file=land_mask_file,\
+                                   summary=ensemble_summary,\
+                                   chunk_layout=chunk_layout,\
+                                   write_threads=write_threads)
 
         else:
             if split:
@@ -2572,91 +3051,57 @@ def main_outfile(data,ch3a_version,fileout='None',split=False,gbcs_l1c=False,\
                     file_out = 'ch3b_'+fileout
             else:
                 file_out = fileout
-        writer.write(dataset, file_out)
+        compression_level = fcdr_compression_level(compression)
+        if compression_level is None:
+            writer.write(dataset, file_out)
+        else:
+            writer.write(dataset, file_out, \
+                             compression_level=compression_level)
+
+#
+# Select scanlines along the line axis - a view (no copy) if lines is a
+# slice
+#
+def take_lines(values,axis,lines):
+
+    index = [slice(None)]*values.ndim
+    index[axis] = lines
+
+    return values[tuple(index)]
+
+#
+# Convert a line filter to a slice if the selected lines are contiguous
+#
+def lines_from_filter(gd):
+
+    index = np.where(gd)[0]
+    if 0 == len(index):
+        return slice(0,0)
+    if index[-1]-index[0]+1 == len(index):
+        return slice(index[0],index[-1]+1)
+
+    return index
 
 #
-# Copy data into data class based on filter
+# Copy data into data class based on filter.  This is now a lightweight
+# view - arrays are taken from the parent data on first access (a numpy
+# view when the lines are contiguous) rather than copied up front
 #
 class copy_to_data(object):
 
     def copy(self,data,gd):
+        self.parent = data
+        self.lines = lines_from_filter(gd)
         self.nx = data.nx
-        self.ny = np.sum(gd)
+        self.ny = len(data.time[self.lines])
         self.ch3a_there = data.ch3a_there
         self.ch5_there = data.ch5_there
-        self.lat = data.lat[gd,:]
-        self.lon = data.lon[gd,:]
-        self.time = data.time[gd]
-        self.date_time=[]
-        for i in range(len(gd)):
-            if gd[i]:
-                self.date_time.append(data.date_time[i])
-        self.satza = data.satza[gd,:]
-        self.solza = data.solza[gd,:]
-        self.relaz = data.relaz[gd,:]
-        self.ch1 = data.ch1[gd,:]
-        self.ch2 = data.ch2[gd,:]
-        if self.ch3a_there:
-            self.ch3a = data.ch3a[gd,:]
-        self.ch3b = data.ch3b[gd,:]
-        self.ch4 = data.ch4[gd,:]
-        if self.ch5_there:
-            self.ch5 = data.ch5[gd,:]
-        self.u_random_ch1 = data.u_random_ch1[gd,:]
-        self.u_random_ch2 = data.u_random_ch2[gd,:]
-        if self.ch3a_there:
-            self.u_random_ch3a = data.u_random_ch3a[gd,:]
-        self.u_random_ch3b = data.u_random_ch3b[gd,:]
-        self.u_random_ch4 = data.u_random_ch4[gd,:]
-        if self.ch5_there:
-            self.u_random_ch5 = data.u_random_ch5[gd,:]
-        self.u_non_random_ch1 = data.u_non_random_ch1[gd,:]
-        self.u_non_random_ch2 = data.u_non_random_ch2[gd,:]
-        if self.ch3a_there:
-            self.u_non_random_ch3a = data.u_non_random_ch3a[gd,:]
-        self.u_non_random_ch3b = data.u_non_random_ch3b[gd,:]
-        self.u_non_random_ch4 = data.u_non_random_ch4[gd,:]
-        if self.ch5_there:
-            self.u_non_random_ch5 = data.u_non_random_ch5[gd,:]
-        self.u_common_ch1 = data.u_common_ch1[gd,:]
-        self.u_common_ch2 = data.u_common_ch2[gd,:]
-        if self.ch3a_there:
-            self.u_common_ch3a = data.u_common_ch3a[gd,:]
-        self.u_common_ch3b = data.u_common_ch3b[gd,:]
-        self.u_common_ch4 = data.u_common_ch4[gd,:]
-        if self.ch5_there:
-            self.u_common_ch5 = data.u_common_ch5[gd,:]
-        self.scan_qual = data.scan_qual[gd]
-        self.chan_qual = data.chan_qual[gd,:]
-        self.dRe1_over_dCS = data.dRe1_over_dCS[gd,:]
-        self.dRe2_over_dCS = data.dRe2_over_dCS[gd,:]
-        self.dRe3a_over_dCS = data.dRe3a_over_dCS[gd,:]
-        self.dBT3_over_dT = data.dBT3_over_dT[gd,:]
-        self.dBT4_over_dT = data.dBT4_over_dT[gd,:]
-        self.dBT5_over_dT = data.dBT5_over_dT[gd,:]
-        self.dBT3_over_dCS = data.dBT3_over_dCS[gd,:]
-        self.dBT4_over_dCS = data.dBT4_over_dCS[gd,:]
-        self.dBT5_over_dCS = data.dBT5_over_dCS[gd,:]
-        self.dBT3_over_dCICT = data.dBT3_over_dCICT[gd,:]
-        self.dBT4_over_dCICT = data.dBT4_over_dCICT[gd,:]
-        self.dBT5_over_dCICT = data.dBT5_over_dCICT[gd,:]
-        self.scanline = data.scanline[gd]
-        self.orig_scanline = data.orig_scanline[gd]
-        self.badNav = data.badNav[gd]
-        self.badCal = data.badCal[gd]
-        self.badTime = data.badTime[gd]
-        self.missingLines = data.missingLines[gd]
-        self.solar3 = data.solar3[gd]
-        self.solar4 = data.solar4[gd]
-        self.solar5 = data.solar5[gd]
-
-        self.ch3b_harm = data.ch3b_harm[gd,:]
-        self.ch4_harm = data.ch4_harm[gd,:]
-        self.ch5_harm = data.ch5_harm[gd,:]
+        self.time = data.time[self.lines]
+        self.date_time = data.date_time[self.lines]
+        if hasattr(data,'ch3a_there_int'):
+            self.ch3a_there_int = data.ch3a_there_int[self.lines]
 
         self.orbital_temperature = data.orbital_temperature
-        self.cal_cnts_noise = data.cal_cnts_noise[:]
-        self.cnts_noise = data.cnts_noise[:]
         self.spatial_correlation_scale = data.spatial_correlation_scale
         self.ICT_Temperature_Uncertainty = data.ICT_Temperature_Uncertainty
         self.PRT_Uncertainty = data.PRT_Uncertainty
@@ -2667,159 +3112,63 @@ class copy_to_data(object):
         self.montecarlo = data.montecarlo
         if data.montecarlo:
             self.montecarlo_seed = data.montecarlo_seed
-            self.ch1_MC = data.ch1_MC[:,gd,:]
-            self.ch2_MC = data.ch2_MC[:,gd,:]
-            self.ch3a_MC = data.ch3a_MC[:,gd,:]
-            self.ch3_MC = data.ch3_MC[:,gd,:]
-            self.ch4_MC = data.ch4_MC[:,gd,:]
-            self.ch5_MC = data.ch5_MC[:,gd,:]
-            self.nmc = self.ch1_MC.shape[0]
+            self.nmc = data.nmc
+
+    def __getattr__(self,name):
+
+        #
+        # Only called if name is not already set on the instance
+        #
+        if name.startswith('__') or 'parent' not in self.__dict__ or \
+                name not in netcdf_variables:
+            raise AttributeError(name)
+        dims = netcdf_variables[name][1]
+        if 'y' in dims and hasattr(self.parent,'get_lines'):
+            #
+            # Masked parent so only mask the lines needed
+            #
+            values = self.parent.get_lines(name,self.lines)
+        else:
+            values = getattr(self.parent,name)
+            if 'y' in dims:
+                values = take_lines(values,dims.index('y'),self.lines)
+        setattr(self,name,values)
+
+        return values
 
     def __init__(self,data,gd):
 
         self.copy(data,gd)
 
 #
-# Mask data into data class based on filter
+# Values given to masked scanlines when an orbit is split (NaN if not
+# listed).  Variables in split_unmasked are passed through untouched
+#
+split_fill_values = {'scan_qual':1,'chan_qual':1,'scanline':255,\
+                         'orig_scanline':-32767,'badNav':0,'badCal':0,\
+                         'badTime':0,'missingLines':1,'solar3':0,\
+                         'solar4':0,'solar5':0}
+split_unmasked = ['lat','lon','cal_cnts_noise','cnts_noise']
+
+#
+# Mask data into data class based on filter.  The masked data shares the
+# unmasked arrays of the parent data and only carries a row mask - the
+# mask is applied when a variable is first accessed (i.e. when it is
+# written or read by CURUC) and the masked copy kept, so the two halves of
+# a split orbit only hold copies of the variables they use
 #
 class mask_data(object):
 
     def mask(self,data,gd):
-        self.nx = np.copy(data.nx)
-        self.ny = np.copy(data.ny)
-        self.ch3a_there = np.copy(data.ch3a_there)
-        self.ch5_there = np.copy(data.ch5_there)
-        self.lat = np.copy(data.lat[:,:])
-        self.lon = np.copy(data.lon[:,:])
-        self.time = np.copy(data.time[:])
-        self.date_time=[]
-        for i in range(len(gd)):
-            self.date_time.append(data.date_time[i])
-        self.satza = np.copy(data.satza[:,:])
-        self.satza[gd,:] = float('nan')
-        self.solza = np.copy(data.solza[:,:])
-        self.solza[gd,:] = float('nan')
-        self.relaz = np.copy(data.relaz[:,:])
-        self.relaz[gd,:] = float('nan')
-        self.ch1 = np.copy(data.ch1[:,:])
-        self.ch1[gd,:] = float('nan')
-        self.ch2 = np.copy(data.ch2[:,:])
-        self.ch2[gd,:] = float('nan')
-        if self.ch3a_there:
-            self.ch3a = np.copy(data.ch3a[:,:])
-            self.ch3a[gd,:] = float('nan')
-        self.ch3b = np.copy(data.ch3b[:,:])
-        self.ch3b[gd,:] = float('nan')
-        self.ch4 = np.copy(data.ch4[:,:])
-        self.ch4[gd,:] = float('nan')
-        if self.ch5_there:
-            self.ch5 = np.copy(data.ch5[:,:])
-            self.ch5[gd,:] = float('nan')
-        self.u_random_ch1 = np.copy(data.u_random_ch1[:,:])
-        self.u_random_ch1[gd,:] = float('nan')
-        self.u_random_ch2 = np.copy(data.u_random_ch2[:,:])
-        self.u_random_ch2[gd,:] = float('nan')
-        if self.ch3a_there:
-            self.u_random_ch3a = np.copy(data.u_random_ch3a[:,:])
-            self.u_random_ch3a[gd,:] = float('nan')
-        self.u_random_ch3b = np.copy(data.u_random_ch3b[:,:])
-        self.u_random_ch3b[gd,:] = float('nan')
-        self.u_random_ch4 = np.copy(data.u_random_ch4[:,:])
-        self.u_random_ch4[gd,:] = float('nan')
-        if self.ch5_there:
-            self.u_random_ch5 = np.copy(data.u_random_ch5[:,:])
-            self.u_random_ch5[gd,:] = float('nan')
-        self.u_non_random_ch1 = np.copy(data.u_non_random_ch1[:,:])
-        self.u_non_random_ch1[gd,:] = float('nan')
-        self.u_non_random_ch2 = np.copy(data.u_non_random_ch2[:,:])
-        self.u_non_random_ch2[gd,:] = float('nan')
-        if self.ch3a_there:
-            self.u_non_random_ch3a = np.copy(data.u_non_random_ch3a[:,:])
-            self.u_non_random_ch3a[gd,:] = float('nan')
-        self.u_non_random_ch3b = np.copy(data.u_non_random_ch3b[:,:])
-        self.u_non_random_ch3b[gd,:] = float('nan')
-        self.u_non_random_ch4 = np.copy(data.u_non_random_ch4[:,:])
-        self.u_non_random_ch4[gd,:] = float('nan')
-        if self.ch5_there:
-            self.u_non_random_ch5 = np.copy(data.u_non_random_ch5[:,:])
-            self.u_non_random_ch5[gd,:] = float('nan')
-        self.u_common_ch1 = np.copy(data.u_common_ch1[:,:])
-        self.u_common_ch1[gd,:] = float('nan')
-        self.u_common_ch2 = np.copy(data.u_common_ch2[:,:])
-        self.u_common_ch2[gd,:] = float('nan')
-        if self.ch3a_there:
-            self.u_common_ch3a = np.copy(data.u_common_ch3a[:,:])
-            self.u_common_ch3a[gd,:] = float('nan')
-        self.u_common_ch3b = np.copy(data.u_common_ch3b[:,:])
-        self.u_common_ch3b[gd,:] = float('nan')
-        self.u_common_ch4 = np.copy(data.u_common_ch4[:,:])
-        self.u_common_ch4[gd,:] = float('nan')
-        if self.ch5_there:
-            self.u_common_ch5 = np.copy(data.u_common_ch5[:,:])
-            self.u_common_ch5[gd,:] = float('nan')
-        #
-        # set quality to bad
-        #
-        self.scan_qual = np.copy(data.scan_qual[:])
-        self.scan_qual[gd] = 1
-        self.chan_qual = np.copy(data.chan_qual[:,:])
-        self.chan_qual[gd,:] = 1
-        self.dRe1_over_dCS = np.copy(data.dRe1_over_dCS[:,:])
-        self.dRe1_over_dCS[gd,:] = float('nan')
-        self.dRe2_over_dCS = np.copy(data.dRe2_over_dCS[:,:])
-        self.dRe2_over_dCS[gd,:] = float('nan')
-        self.dRe3a_over_dCS = np.copy(data.dRe3a_over_dCS[:,:])
-        self.dRe3a_over_dCS[gd,:] = float('nan')
-        self.dBT3_over_dT = np.copy(data.dBT3_over_dT[:,:])
-        self.dBT3_over_dT[gd,:] = float('nan')
-        self.dBT4_over_dT = np.copy(data.dBT4_over_dT[:,:])
-        self.dBT4_over_dT[gd,:] = float('nan')
-        self.dBT5_over_dT = np.copy(data.dBT5_over_dT[:,:])
-        self.dBT5_over_dT[gd,:] = float('nan')
-        self.dBT3_over_dCS = np.copy(data.dBT3_over_dCS[:,:])
-        self.dBT3_over_dCS[gd,:] = float('nan')
-        self.dBT4_over_dCS = np.copy(data.dBT4_over_dCS[:,:])
-        self.dBT4_over_dCS[gd,:] = float('nan')
-        self.dBT5_over_dCS = np.copy(data.dBT5_over_dCS[:,:])
-        self.dBT5_over_dCS[gd,:] = float('nan')
-        self.dBT3_over_dCICT = np.copy(data.dBT3_over_dCICT[:,:])
-        self.dBT3_over_dCICT[gd,:] = float('nan')
-        self.dBT4_over_dCICT = np.copy(data.dBT4_over_dCICT[:,:])
-        self.dBT4_over_dCICT[gd,:] = float('nan')
-        self.dBT5_over_dCICT = np.copy(data.dBT5_over_dCICT[:,:])
-        self.dBT5_over_dCICT[gd,:] = float('nan')
-        self.scanline = np.copy(data.scanline[:])
-        self.scanline[gd] = 255
-        self.orig_scanline = np.copy(data.orig_scanline[:])
-        self.orig_scanline[gd] = -32767
-        self.badNav = np.copy(data.badNav[:])
-        self.badNav[gd] = 0
-        self.badCal = np.copy(data.badCal[:])
-        self.badCal[gd] = 0
-        self.badTime = np.copy(data.badTime[:])
-        self.badTime[gd] = 0
-        self.missingLines = np.copy(data.missingLines[:])
-        self.missingLines[gd] = 1
-        self.solar3 = np.copy(data.solar3[:])
-        self.solar3[gd] = 0
-        self.solar4 = np.copy(data.solar4[:])
-        self.solar4[gd] = 0
-        self.solar5 = np.copy(data.solar5[:])
-        self.solar5[gd] = 0
-
-        self.ch3b_harm = np.copy(data.ch3b_harm[:,:])
-        self.ch3b_harm[gd,:] = float('nan')
-        self.ch4_harm = np.copy(data.ch4_harm[:,:])
-        self.ch4_harm[gd,:] = float('nan')
-        self.ch5_harm = np.copy(data.ch5_harm[:,:])
-        self.ch5_harm[gd,:] = float('nan')
-
-        self.orbital_temperature = np.copy(data.orbital_temperature)
-        self.cal_cnts_noise = np.copy(data.cal_cnts_noise[:])
-        self.cnts_noise = np.copy(data.cnts_noise[:])
-        self.spatial_correlation_scale = np.copy(data.spatial_correlation_scale)
-        self.ICT_Temperature_Uncertainty = np.copy(data.ICT_Temperature_Uncertainty)
-        self.PRT_Uncertainty = np.copy(data.PRT_Uncertainty)
+        self.parent = data
+        self.nx = data.nx
+        self.ch3a_there = data.ch3a_there
+        self.ch5_there = data.ch5_there
+
+        self.orbital_temperature = data.orbital_temperature
+        self.spatial_correlation_scale = data.spatial_correlation_scale
+        self.ICT_Temperature_Uncertainty = data.ICT_Temperature_Uncertainty
+        self.PRT_Uncertainty = data.PRT_Uncertainty
         self.noaa_string = data.noaa_string
         self.sources = data.sources
         self.version = data.version
@@ -2827,123 +3176,81 @@ class mask_data(object):
         self.montecarlo = data.montecarlo
         if data.montecarlo:
             self.montecarlo_seed = data.montecarlo_seed
-            self.ch1_MC = np.copy(data.ch1_MC)
-            self.ch1_MC[:,gd,:] = float('nan')
-            self.ch2_MC = np.copy(data.ch2_MC)
-            self.ch2_MC[:,gd,:] = float('nan')
-            self.ch3a_MC = np.copy(data.ch3a_MC)
-            self.ch3a_MC[:,gd,:] = float('nan')
-            self.ch3_MC = np.copy(data.ch3_MC)
-            self.ch3_MC[:,gd,:] = float('nan')
-            self.ch4_MC = np.copy(data.ch4_MC)
-            self.ch4_MC[:,gd,:] = float('nan')
-            self.ch5_MC = np.copy(data.ch5_MC)
-            self.ch5_MC[:,gd,:] = float('nan')
-            self.nmc = self.ch1_MC.shape[0]
+            self.nmc = data.nmc
         #
-        # Top and Tail data if needed - using scan_qual flag
+        # Top and Tail data if needed - using scan_qual flag (masked lines
+        # have scan_qual set to bad)
         # Original start/end time already filtered to have good data only
         #
-        ok=False
-        ggd = np.zeros(len(gd),dtype=np.bool)
-        ggd[:] = True
-        for i in range(len(self.scan_qual)):
-            if 1 == self.scan_qual[i] or self.time[i] < 0 or \
-                    ~np.isfinite(self.time[i]):
-                ggd[i] = False
-                ok=True
-            else:
-                break
-        for i in range(len(self.scan_qual)-1,0,-1):
-            if 1 == self.scan_qual[i] or self.time[i] < 0 or \
-                    ~np.isfinite(self.time[i]):
-                ggd[i] = False
-                ok=True
-            else:
-                break
+        with np.errstate(invalid='ignore'):
+            bad = gd | (1 == data.scan_qual) | (data.time < 0) | \
+                ~np.isfinite(data.time)
+        good = np.where(~bad)[0]
+        if len(good) > 0:
+            self.lines = slice(good[0],good[-1]+1)
+        else:
+            self.lines = slice(0,0)
+        self.masked = np.asarray(gd)[self.lines]
+        self.time = data.time[self.lines]
+        self.date_time = data.date_time[self.lines]
+        self.ny = len(self.time)
+
+    #
+    # Masked copy of a subset of lines (relative to the trimmed data) of
+    # a variable - only the selected lines are copied
+    #
+    def get_lines(self,name,lines=slice(None)):
+
+        return self.mask_lines(name,getattr(self.parent,name),lines)
 
-        if ok:
-            self.nx = data.nx
-            self.ny = np.sum(ggd)
-            self.lat = self.lat[ggd,:]
-            self.lon = self.lon[ggd,:]
-            self.time = self.time[ggd]
-            date_time=[]
-            for i in range(len(ggd)):
-                if ggd[i]:
-                    date_time.append(self.date_time[i])
-            self.date_time = date_time[:]
-            self.satza = self.satza[ggd,:]
-            self.solza = self.solza[ggd,:]
-            self.relaz = self.relaz[ggd,:]
-            self.ch1 = self.ch1[ggd,:]
-            self.ch2 = self.ch2[ggd,:]
-            if self.ch3a_there:
-                self.ch3a = self.ch3a[ggd,:]
-            self.ch3b = self.ch3b[ggd,:]
-            self.ch4 = self.ch4[ggd,:]
-            if self.ch5_there:
-                self.ch5 = self.ch5[ggd,:]
-            self.u_random_ch1 = self.u_random_ch1[ggd,:]
-            self.u_random_ch2 = self.u_random_ch2[ggd,:]
-            if self.ch3a_there:
-                self.u_random_ch3a = self.u_random_ch3a[ggd,:]
-            self.u_random_ch3b = self.u_random_ch3b[ggd,:]
-            self.u_random_ch4 = self.u_random_ch4[ggd,:]
-            if self.ch5_there:
-                self.u_random_ch5 = self.u_random_ch5[ggd,:]
-            self.u_non_random_ch1 = self.u_non_random_ch1[ggd,:]
-            self.u_non_random_ch2 = self.u_non_random_ch2[ggd,:]
-            if self.ch3a_there:
-                self.u_non_random_ch3a = self.u_non_random_ch3a[ggd,:]
-            self.u_non_random_ch3b = self.u_non_random_ch3b[ggd,:]
-            self.u_non_random_ch4 = self.u_non_random_ch4[ggd,:]
-            if self.ch5_there:
-                self.u_non_random_ch5 = self.u_non_random_ch5[ggd,:]
-            self.u_common_ch1 = self.u_common_ch1[ggd,:]
-            self.u_common_ch2 = self.u_common_ch2[ggd,:]
-            if self.ch3a_there:
-                self.u_common_ch3a = self.u_common_ch3a[ggd,:]
-            self.u_common_ch3b = self.u_common_ch3b[ggd,:]
-            self.u_common_ch4 = self.u_common_ch4[ggd,:]
-            if self.ch5_there:
-                self.u_common_ch5 = self.u_common_ch5[ggd,:]
-            self.scan_qual = self.scan_qual[ggd]
-            self.chan_qual = self.chan_qual[ggd,:]
-            self.dRe1_over_dCS = self.dRe1_over_dCS[ggd,:]
-            self.dRe2_over_dCS = self.dRe2_over_dCS[ggd,:]
-            self.dRe3a_over_dCS = self.dRe3a_over_dCS[ggd,:]
-            self.dBT3_over_dT = self.dBT3_over_dT[ggd,:]
-            self.dBT4_over_dT = self.dBT4_over_dT[ggd,:]
-            self.dBT5_over_dT = self.dBT5_over_dT[ggd,:]
-            self.dBT3_over_dCS = self.dBT3_over_dCS[ggd,:]
-            self.dBT4_over_dCS = self.dBT4_over_dCS[ggd,:]
-            self.dBT5_over_dCS = self.dBT5_over_dCS[ggd,:]
-            self.dBT3_over_dCICT = self.dBT3_over_dCICT[ggd,:]
-            self.dBT4_over_dCICT = self.dBT4_over_dCICT[ggd,:]
-            self.dBT5_over_dCICT = self.dBT5_over_dCICT[ggd,:]
-            self.scanline = self.scanline[ggd]
-            self.orig_scanline = self.orig_scanline[ggd]
-            self.badNav = self.badNav[ggd]
-            self.badCal = self.badCal[ggd]
-            self.badTime = self.badTime[ggd]
-            self.missingLines = self.missingLines[ggd]
-            self.solar3 = self.solar3[ggd]
-            self.solar4 = self.solar4[ggd]
-            self.solar5 = self.solar5[ggd]
-
-            self.ch3b_harm = self.ch3b_harm[ggd,:]
-            self.ch4_harm = self.ch4_harm[ggd,:]
-            self.ch5_harm = self.ch5_harm[ggd,:]
-
-            if self.montecarlo:
-                self.ch1_MC = self.ch1_MC[:,ggd,:]
-                self.ch2_MC = self.ch2_MC[:,ggd,:]
-                self.ch3a_MC = self.ch3a_MC[:,ggd,:]
-                self.ch3_MC = self.ch3_MC[:,ggd,:]
-                self.ch4_MC = self.ch4_MC[:,ggd,:]
-                self.ch5_MC = self.ch5_MC[:,ggd,:]
-                self.nmc = self.ch1_MC.shape[0]
+    #
+    # Masked copy of a subset of Monte Carlo members of an ensemble
+    # variable
+    #
+    def get_members(self,name,members):
+
+        return self.mask_lines(name,\
+                                   get_ensemble_members(self.parent,name,\
+                                                            members))
+
+    def mask_lines(self,name,values,lines=slice(None)):
+
+        #
+        # Like the old np.copy based mask this drops any netCDF mask
+        #
+        values = np.ma.getdata(values)
+        dims = netcdf_variables[name][1]
+        if 'y' not in dims:
+            return values
+        trimmed = range(self.lines.start,self.lines.stop)
+        if isinstance(lines,slice):
+            trimmed = trimmed[lines]
+            parent_lines = slice(trimmed.start,trimmed.stop,trimmed.step)
+        else:
+            parent_lines = np.asarray(trimmed)[lines]
+        masked = self.masked[lines]
+        values = take_lines(values,dims.index('y'),parent_lines)
+        if name in split_unmasked or not np.any(masked):
+            return values
+        values = np.copy(values)
+        index = [slice(None)]*values.ndim
+        index[dims.index('y')] = masked
+        values[tuple(index)] = split_fill_values.get(name,float('nan'))
+
+        return values
+
+    def __getattr__(self,name):
+
+        #
+        # Only called if name is not already set on the instance
+        #
+        if name.startswith('__') or 'parent' not in self.__dict__ or \
+                name not in netcdf_variables:
+            raise AttributeError(name)
+        values = self.get_lines(name)
+        setattr(self,name,values)
+
+        return values
 
     def __init__(self,data,gd):
 
@@ -2999,11 +3306,77 @@ def get_split_data(data,ch3a=False):
     
     return newdata
 
+#
+# Write the ch3a or ch3b half of a split orbit
+#
+def split_outfile(data,ch3a_version,fileout='None',ocean_only=False,\
+                      curuc_options=None,output_options=None):
+
+    newdata = get_split_data(data,ch3a=ch3a_version)
+    if newdata.ny >= 1280:
+        main_outfile(newdata,ch3a_version=ch3a_version,fileout=fileout,\
+                         split=True,ocean_only=ocean_only,\
+                         curuc_options=curuc_options,\
+                         output_options=output_options)
+
+#
+# Write one half of a split orbit in a forked process (reopening the
+# input file)
+#
+def split_worker(data,ch3a_version,fileout,ocean_only,curuc_options,\
+                     output_options):
+
+    reopen_netcdf(data)
+    split_outfile(data,ch3a_version,fileout=fileout,ocean_only=ocean_only,\
+                      curuc_options=curuc_options,\
+                      output_options=output_options)
+
+#
+# Write both halves of a split orbit.  With nproc > 1 the halves are run
+# in forked processes which share the input data already read
+# copy-on-write and read anything else from their own file handle
+#
+def split_outfiles(data,fileout='None',ocean_only=False,nproc=1,\
+                       curuc_options=None,output_options=None):
+
+    versions = [True,False]
+    if nproc <= 1:
+        for ch3a_version in versions:
+            split_outfile(data,ch3a_version,fileout=fileout,\
+                              ocean_only=ocean_only,\
+                              curuc_options=curuc_options,\
+                              output_options=output_options)
+        return
+
+    ctx = multiprocessing.get_context('fork')
+    close_netcdf(data)
+    for i in range(0,len(versions),nproc):
+        procs = []
+        for ch3a_version in versions[i:i+nproc]:
+            proc = ctx.Process(target=split_worker,\
+                                   args=(data,ch3a_version,fileout,\
+                                             ocean_only,curuc_options,\
+                                             output_options))
+            proc.start()
+            procs.append((ch3a_version,proc))
+        for ch3a_version,proc in procs:
+            proc.join()
+        for ch3a_version,proc in procs:
+            if 0 != proc.exitcode:
+                raise Exception('Split orbit output failed (ch3a_version={0}'\
+                                    ', exit code {1})'.format(ch3a_version,\
+                                                                proc.exitcode))
+
 #
 # Top level routine to output FCDR
 #
-def main(file_in,fileout='None',ocean_only=False):
+def main(file_in,fileout='None',ocean_only=False,nproc=1,curuc_options=None,\
+             output_options=None):
 
+    if curuc_options is None:
+        curuc_options = {}
+    if output_options is None:
+        output_options = {}
     data = read_netcdf(file_in)
 
     #
@@ -3014,17 +3387,15 @@ def main(file_in,fileout='None',ocean_only=False):
         #
         # Have to split orbit into two to ensure CURUC works
         #        
-        data1 = get_split_data(data,ch3a=True)
-        if data1.ny >= 1280:
-            main_outfile(data1,ch3a_version=True,fileout=fileout,split=True,\
-                             ocean_only=ocean_only)
-        data2 = get_split_data(data,ch3a=False)
-        if data2.ny >= 1280:
-            main_outfile(data2,ch3a_version=False,fileout=fileout,split=True,\
-                             ocean_only=ocean_only)
+        split_outfiles(data,fileout=fileout,ocean_only=ocean_only,\
+                           nproc=nproc,curuc_options=curuc_options,\
+                           output_options=output_options)
     else:
         main_outfile(data,ch3a_version=False,fileout=fileout,\
-                         ocean_only=ocean_only)
+                         ocean_only=ocean_only,curuc_options=curuc_options,\
+                         output_options=output_options)
+
+    data.close()
 
 if __name__ == "__main__":
 
@@ -3040,7 +3411,109 @@ if __name__ == "__main__":
     parser.add_argument('--ocean',action='store_true',\
                             help='Output ocean_only data for ensemble')
 
+    parser.add_argument('--nproc',type=int,default=1,\
+                            help='Number of processes used to write the '\
+                            'ch3a/ch3b halves of a split orbit')
+
+    parser.add_argument('--curuc-nproc',type=int,default=1,\
+                            help='Number of processes used to run the vis, '\
+                            'IR and IR common CURUC passes')
+
+    parser.add_argument('--curuc-memory',type=float,default=None,\
+                            help='Memory budget (GB) for CURUC passes '\
+                            'running at the same time')
+
+    parser.add_argument('--curuc-block-lines',type=int,default=None,\
+                            help='Run CURUC in blocks of this many scanlines '\
+                            'to bound memory on long orbits')
+
+    parser.add_argument('--curuc-float32',action='store_true',\
+                            help='Run CURUC in single precision')
+
+    parser.add_argument('--curuc-validate',action='store_true',\
+                            help='Report deviations of single precision '\
+                            'CURUC from double precision')
+
+    parser.add_argument('--line-skip',type=int,default=5,\
+                            help='CURUC sub-sampling in the line direction')
+
+    parser.add_argument('--elem-skip',type=int,default=25,\
+                            help='CURUC sub-sampling in the element direction')
+
+    parser.add_argument('--curuc-skip-file',nargs=1,\
+                            help='Use the CURUC sub-sampling chosen by '\
+                            'curuc_convergence.py (overrides --line-skip '\
+                            'and --elem-skip)')
+
+    parser.add_argument('--curuc-cache',nargs=1,\
+                            help='Directory to cache CURUC results in')
+
+    parser.add_argument('--curuc-cache-size',type=float,default=10.,\
+                            help='Maximum size (GB) of the CURUC cache')
+
+    parser.add_argument('--no-curuc-cache',action='store_true',\
+                            help='Bypass the CURUC cache')
+
+    parser.add_argument('--curuc-diagnostics',nargs=1,\
+                            help='Write CURUC channel to channel inputs '\
+                            'to <prefix>_<chans>.npy for debugging')
+
+    parser.add_argument('--srf-dir',nargs=1,\
+                            help='Directory of SRF/lookup table files')
+
+    parser.add_argument('--compression',nargs=1,\
+                            choices=sorted(compression_profiles),\
+                            help='Compression profile for the outputs')
+
+    parser.add_argument('--write-threads',type=int,default=1,\
+                            help='Threads compressing the ensemble (zlib '\
+                            'profiles, needs h5py)')
+
+    parser.add_argument('--land-mask',nargs=1,\
+                            help='Land mask (netCDF with lat, lon and mask) '\
+                            'used to store only ocean pixels with --ocean')
+
+    parser.add_argument('--ensemble-summary',action='store_true',\
+                            help='Also write the ensemble mean, spread '\
+                            'and channel covariance summary file')
+
+    parser.add_argument('--ensemble-chunks',nargs=1,\
+                            choices=sorted(ensemble_chunk_layouts),\
+                            help='Chunk layout of the ensemble variables')
+
     args = parser.parse_args()
+
+    output_options = {}
+    if args.srf_dir is not None:
+        output_options['srf_dir'] = args.srf_dir[0]
+    if args.compression is not None:
+        output_options['compression'] = args.compression[0]
+        get_compression(output_options['compression'])
+    output_options['write_threads'] = args.write_threads
+    if args.land_mask is not None:
+        output_options['land_mask_file'] = args.land_mask[0]
+    if args.ensemble_summary:
+        output_options['ensemble_summary'] = True
+    if args.ensemble_chunks is not None:
+        output_options['ensemble_chunk_layout'] = args.ensemble_chunks[0]
+
+    curuc_options = {'nproc':args.curuc_nproc,\
+                         'block_lines':args.curuc_block_lines,\
+                         'validate':args.curuc_validate,\
+                         'line_skip':args.line_skip,\
+                         'elem_skip':args.elem_skip}
+    if args.curuc_skip_file is not None:
+        curuc_options['line_skip'],curuc_options['elem_skip'] = \
+            read_curuc_skip(args.curuc_skip_file[0])
+    if args.curuc_cache is not None and not args.no_curuc_cache:
+        curuc_options['cache_dir'] = args.curuc_cache[0]
+        curuc_options['cache_size'] = int(args.curuc_cache_size*1024**3)
+    if args.curuc_diagnostics is not None:
+        curuc_options['diag_prefix'] = args.curuc_diagnostics[0]
+    if args.curuc_float32:
+        curuc_options['dtype'] = np.float32
+    if args.curuc_memory is not None:
+        curuc_options['mem_budget'] = int(args.curuc_memory*1024**3)
     
     try:
         outfile = args.output[0]
@@ -3055,14 +3528,22 @@ if __name__ == "__main__":
 
     if outfile_there:
         if ocean:
-            main(args.input_file[0],fileout=outfile,ocean_only=True)
+            main(args.input_file[0],fileout=outfile,ocean_only=True,\
+                     nproc=args.nproc,curuc_options=curuc_options,\
+                     output_options=output_options)
         else:
-            main(args.input_file[0],fileout=outfile,ocean_only=False)
+            main(args.input_file[0],fileout=outfile,ocean_only=False,\
+                     nproc=args.nproc,curuc_options=curuc_options,\
+                     output_options=output_options)
     else:
         if ocean:
-            main(args.input_file[0],ocean_only=True)
+            main(args.input_file[0],ocean_only=True,\
+                     nproc=args.nproc,curuc_options=curuc_options,\
+                     output_options=output_options)
         else:
-            main(args.input_file[0],ocean_only=False)
+            main(args.input_file[0],ocean_only=False,\
+                     nproc=args.nproc,curuc_options=curuc_options,\
+                     output_options=output_options)
 
 #    usage = "usage: %prog [options] arg1 arg2"
 #    parser = OptionParser(usage=usage)
@@ -18,6 +18,14 @@
 #
 # Write GBCS Level 1C format data
 #
+
+#
+# Default createVariable compression keywords for all variables
+# (write_gbcs_l1c compression, e.g. from a compression profile in
+# write_easy_fcdr_from_netcdf.py, overrides it)
+#
+netcdf_compression = {'zlib':False,'complevel':5,'shuffle':True}
+
 #
 # Write l1c float values
 #
@@ -25,16 +33,19 @@
 #
 def Write_GBCS_Float(ncid,name,dim_nx,dim_ny,indata,fill_value,\
                          long_name,standard_name,units,\
-                         valid_min,valid_max,reference_datum=None):
+                         valid_min,valid_max,reference_datum=None,\
+                         compression=None):
+
+    if compression is None:
+        compression = netcdf_compression
 
     newdata = data
     gd = (newdata < valid_min) | (newdata > valid_max)
     if np.sum(gd) > 0:
         newdata[gd] = fill_value
 
-    var = ncid.createVariable(name,'f4',(dim_ny,dim_nx),zlib=False,\
-                                  complevel=5,shuffle=True,\
-                                  fill_value=fill_value)
+    var = ncid.createVariable(name,'f4',(dim_ny,dim_nx),fill_value=fill_value,\
+                                  **compression)
     var.long_name = long_name
     var.standard_name = standard_name
     var.units = units
@@ -46,16 +57,19 @@ def Write_GBCS_Float(ncid,name,dim_nx,dim_ny,indata,fill_value,\
     var[:,:] = newdata
 
 def Write_GBCS_Float_1d(ncid,name,dim_ny,indata,fill_value,\
-                            long_name,standard_name,units,valid_min,valid_max):
+                            long_name,standard_name,units,valid_min,valid_max,\
+                            compression=None):
+
+    if compression is None:
+        compression = netcdf_compression
 
     newdata = data
     gd = (newdata < valid_min) | (newdata > valid_max)
     if np.sum(gd) > 0:
         newdata[gd] = fill_value
 
-    var = ncid.createVariable(name,'f4',(dim_ny),zlib=False,\
-                                  complevel=5,shuffle=True,\
-                                  fill_value=fill_value)
+    var = ncid.createVariable(name,'f4',(dim_ny),fill_value=fill_value,\
+                                  **compression)
     var.long_name = long_name
     var.standard_name = standard_name
     var.units = units
@@ -64,11 +78,15 @@ def Write_GBCS_Float_1d(ncid,name,dim_ny,indata,fill_value,\
 
     var[:] = newdata
 
-def Write_GBCS_time(ncid,dim_time,data,units):
+def Write_GBCS_time(ncid,dim_time,data,units,\
+                        compression=None):
+
+    if compression is None:
+        compression = netcdf_compression
 
     newdata = nc.date2num(data,units)
-    var = ncid.createVariable(name,'i4',(dim_time),zlib=False,\
-                                  complevel=5,shuffle=True)
+    var = ncid.createVariable(name,'i4',(dim_time),\
+                                  **compression)
 
     var.long_name = 'reference time of sst file'
     var.standard_name = 'time'
@@ -78,14 +96,17 @@ def Write_GBCS_time(ncid,dim_time,data,units):
     var[:] = newdata
 
 def Write_GBCS_dtime(ncid,dim_nx,dim_ny,nx,ny,dim_time,time_step,\
-                         long_name,units,coordinates,fill_value):
+                         long_name,units,coordinates,fill_value,\
+                         compression=None):
+
+    if compression is None:
+        compression = netcdf_compression
 
     data = np.zeros((1,ny,nx),dtype=np.float32)
     for i in range(ny):
         data[0,i,:] = i*time_step
-    var = ncid.createVariable(name,'f4',(dim_time,dim_ny,dim_nx),zlib=False,\
-                                  complevel=5,shuffle=True,\
-                                  fill_value=fill_value)
+    var = ncid.createVariable(name,'f4',(dim_time,dim_ny,dim_nx),fill_value=fill_value,\
+                                  **compression)
     var.long_name = long_name
     var.units = units
     var.coordinates = coordinates
@@ -94,7 +115,11 @@ def Write_GBCS_dtime(ncid,dim_nx,dim_ny,nx,ny,dim_time,time_step,\
 
 def Write_GBCS_Float_Time(ncid,name,dim_ny,dim_time,ny,\
                               indata,fill_value,long_name,units,\
-                              valid_min,valid_max,scale,offset):
+                              valid_min,valid_max,scale,offset,\
+                              compression=None):
+
+    if compression is None:
+        compression = netcdf_compression
 
     data = np.zeros((1,ny),dtype=np.int16)
     gd = (indata >= valid_min_f) & (indata <= valid_max_f)
@@ -104,9 +129,8 @@ def Write_GBCS_Float_Time(ncid,name,dim_ny,dim_time,ny,\
     if np.sum(gd) > 0:
         data[0,gd] = fill_value
 
-    var = ncid.createVariable(name,'i2',(time_time,dim_ny),zlib=False,\
-                                  complevel=5,shuffle=True,\
-                                  fill_value=fill_value)
+    var = ncid.createVariable(name,'i2',(time_time,dim_ny),fill_value=fill_value,\
+                                  **compression)
     var.long_name = long_name
     var.standard_name = standard_name
     var.units = units
@@ -121,7 +145,11 @@ def Write_GBCS_Float_to_Int(ncid,name,dim_nx,dim_ny,nx,ny,\
                                 indata,fill_value,long_name,\
                                 standard_name,units,valid_min,valid_max,\
                                 scale,offset,coordinates=None,\
-                                comment=None):
+                                comment=None,\
+                                compression=None):
+
+    if compression is None:
+        compression = netcdf_compression
 
     data = np.zeros((ny,nx),dtype=np.int16)
     gd = (indata >= valid_min_f) & (indata <= valid_max_f)
@@ -131,9 +159,8 @@ def Write_GBCS_Float_to_Int(ncid,name,dim_nx,dim_ny,nx,ny,\
     if np.sum(gd) > 0:
         data[gd] = fill_value
 
-    var = ncid.createVariable(name,'i2',(dim_ny,dim_nx),zlib=False,\
-                                  complevel=5,shuffle=True,\
-                                  fill_value=fill_value)
+    var = ncid.createVariable(name,'i2',(dim_ny,dim_nx),fill_value=fill_value,\
+                                  **compression)
     var.long_name = long_name
     var.standard_name = standard_name
     var.units = units
@@ -153,7 +180,11 @@ def Write_GBCS_Float_to_Int_3D(ncid,name,dim_nx,dim_ny,dim_time,nx,ny,\
                                    units,valid_min,valid_max,\
                                    scale,offset,standard_name=None,\
                                    coordinates=None,\
-                                   comment=None):
+                                   comment=None,\
+                                   compression=None):
+
+    if compression is None:
+        compression = netcdf_compression
 
     data = np.zeros((ny,nx),dtype=np.int16)
     gd = (indata >= valid_min_f) & (indata <= valid_max_f)
@@ -163,9 +194,8 @@ def Write_GBCS_Float_to_Int_3D(ncid,name,dim_nx,dim_ny,dim_time,nx,ny,\
     if np.sum(gd) > 0:
         data[gd] = fill_value
 
-    var = ncid.createVariable(name,'i2',(dim_time,dim_ny,dim_nx),zlib=False,\
-                                  complevel=5,shuffle=True,\
-                                  fill_value=fill_value)
+    var = ncid.createVariable(name,'i2',(dim_time,dim_ny,dim_nx),fill_value=fill_value,\
+                                  **compression)
     var.long_name = long_name
     if standard_name:
         var.standard_name = standard_name
@@ -243,15 +273,21 @@ def make_flags(data):
 #
 # Write GBCS L1C output including the channel to channel covariances
 #
-def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
+def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False,\
+                       compression=None):
+
+    # Scanline times are numpy datetime64 so only convert the ones needed
+    start_time = data.date_time[0].astype(datetime.datetime)
+    second_time = data.date_time[1].astype(datetime.datetime)
+    end_time = data.date_time[-1].astype(datetime.datetime)
 
     name = '{0:04d}{1:02d}{2:02d}{3:02d}{4:02d}{5:02d}-ESACCI-L1C-{6}-fv01.0.nc'.\
-        format(data.date_time[0].year,\
-                   data.date_time[0].month,\
-                   data.date_time[0].day,\
-                   data.date_time[0].hour,\
-                   data.date_time[0].minute,\
-                   data.date_time[0].second,\
+        format(start_time.year,\
+                   start_time.month,\
+                   start_time.day,\
+                   start_time.hour,\
+                   start_time.minute,\
+                   start_time.second,\
                    data.noaa_string)
 
     ncid = nc.Dataset(name,'w',format='NETCDF4')
@@ -266,7 +302,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     Write_GBCS_Float(ncid,'lat','ni','nj',data.lat,\
                          -32768.,'Latitude coordinates','latitude',\
                          'degrees_north',-90.,90.,\
-                         'geographical coordinates, WGS84 projection')
+                         'geographical coordinates, WGS84 projection',\
+                         compression=compression)
     lon = data.lon
     gd = (lon > 180.)
     if np.sum(gd) > 0:
@@ -274,49 +311,58 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     Write_GBCS_Float(ncid,'lon','ni','nj',lon,\
                          -32768.,'Longitude coordinates','longitude',\
                          'degrees_east',-180.,180.,\
-                         'geographical coordinates, WGS84 projection')
+                         'geographical coordinates, WGS84 projection',\
+                         compression=compression)
 
-    Write_GBCS_time(ncid,'time',data.date_time[0],\
-                        'seconds since 1981-01-01 00:00:00')
-    Write_GBCS_dtime(ncid,'ni','nj','time',data.date_time[0],\
+    Write_GBCS_time(ncid,'time',start_time,\
+                        'seconds since 1981-01-01 00:00:00',\
+                        compression=compression)
+    Write_GBCS_dtime(ncid,'ni','nj','time',start_time,\
                          0.5,'scanline time difference from start time',\
-                         'seconds','lon lat',-32768.)
+                         'seconds','lon lat',-32768.,\
+                         compression=compression)
 
     Write_GBCS_Float_to_Int_3D(ncid,'ch1','ni','nj','time',\
                                    data.ch1,-32768,'Channel 1 Reflectance',\
                                    'reflectance',0,15000,\
-                                   0.0001,0.,coordinates='lon lat')
+                                   0.0001,0.,coordinates='lon lat',\
+                                   compression=compression)
     
     Write_GBCS_Float_to_Int_3D(ncid,'ch2','ni','nj','time',\
                                    data.ch2,-32768,'Channel 2 Reflectance',\
                                    'reflectance',0,15000,\
-                                   0.0001,0.,coordinates='lon lat')
+                                   0.0001,0.,coordinates='lon lat',\
+                                   compression=compression)
     
     if data.ch3a_there:
         Write_GBCS_Float_to_Int_3D(ncid,'ch3a','ni','nj','time',\
                                        data.ch3a,-32768,\
                                        'Channel 3A Reflectance',\
                                        'reflectance',0,15000,\
-                                       0.0001,0.,coordinates='lon lat')
+                                       0.0001,0.,coordinates='lon lat',\
+                                       compression=compression)
     
     Write_GBCS_Float_to_Int_3D(ncid,'ch3b','ni','nj','time',\
                                    data.ch3b,-32768,\
                                    'Channel 3B Brightness Temperature',\
                                    'kelvin',-20000,10000,\
-                                   0.01,273.15,coordinates='lon lat')
+                                   0.01,273.15,coordinates='lon lat',\
+                                   compression=compression)
 
     Write_GBCS_Float_to_Int_3D(ncid,'ch4','ni','nj','time',\
                                    data.ch4,-32768,\
                                    'Channel 4 Brightness Temperature',\
                                    'kelvin',-20000,10000,\
-                                   0.01,273.15,coordinates='lon lat')
+                                   0.01,273.15,coordinates='lon lat',\
+                                   compression=compression)
     
     if data.ch5_there:
         Write_GBCS_Float_to_Int_3D(ncid,'ch5','ni','nj','time',\
                                        data.ch5,-32768,\
                                        'Channel 5 Brightness Temperature',\
                                        'kelvin',-20000,10000,\
-                                       0.01,273.15,coordinates='lon lat')
+                                       0.01,273.15,coordinates='lon lat',\
+                                       compression=compression)
     
     
     #
@@ -335,7 +381,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     Write_GBCS_Float_to_Int_3D(ncid,'ch1_noise','ni','nj','time',noise,\
                                    -32768,'Channel 1 noise estimate',\
                                    'reflectance',0,10000,1.e-5,0.,\
-                                   coordinates='lon lat')
+                                   coordinates='lon lat',\
+                                   compression=compression)
     
     noise[:,:] = -1e30
     gd = (data.ch2 > 0)&(data.u_random_Ch2 > 0)&(data.u_non_random_Ch2 > 0)
@@ -346,7 +393,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     Write_GBCS_Float_to_Int_3D(ncid,'ch2_noise','ni','nj','time',noise,\
                                    -32768,'Channel 2 noise estimate',\
                                    'reflectance',0,10000,1.e-5,0.,\
-                                   coordinates='lon lat')
+                                   coordinates='lon lat',\
+                                   compression=compression)
     if data.ch3a_there:
         noise[:,:] = -1e30
         gd = (data.ch3a > 0)&(data.u_random_Ch3a > 0)&\
@@ -360,7 +408,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
                                            noise,-32768,\
                                            'Channel 3A noise estimate',\
                                            'reflectance',0,10000,1.e-5,0.,\
-                                           coordinates='lon lat')
+                                           coordinates='lon lat',\
+                                           compression=compression)
     
     noise = np.zeros(data.ch3b.shape,dtype=np.float32)
     noise[:,:] = -1e30
@@ -372,7 +421,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     Write_GBCS_Float_to_Int_3D(ncid,'ch3b_nedt','ni','nj','time',noise,\
                                    -32768,'Channel 3B noise estimate',\
                                    'kelvin',0,10000,0.001,0.,\
-                                   coordinates='lon lat')
+                                   coordinates='lon lat',\
+                                   compression=compression)
     
     noise = np.zeros(data.ch4.shape,dtype=np.float32)
     noise[:,:] = -1e30
@@ -384,7 +434,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     Write_GBCS_Float_to_Int_3D(ncid,'ch4_nedt','ni','nj','time',noise,\
                                    -32768,'Channel 4 noise estimate',\
                                    'kelvin',0,10000,0.001,0.,\
-                                   coordinates='lon lat')
+                                   coordinates='lon lat',\
+                                   compression=compression)
     
     if data.ch5_there:
         noise = np.zeros(data.ch4.shape,dtype=np.float32)
@@ -397,7 +448,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch5_nedt','ni','nj','time',noise,\
                                        -32768,'Channel 5 noise estimate',\
                                        'kelvin',0,10000,0.001,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
 
     if fiduceo:
@@ -413,7 +465,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch1_u_random','ni','nj','time',noise,\
                                        -32768,'Channel 1 random uncertainty estimate',\
                                        'reflectance',0,10000,1.e-5,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
         noise[:,:] = -1e30
         gd = (data.ch2 > 0)&(data.u_random_Ch2 > 0)
@@ -422,7 +475,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch2_u_random','ni','nj','time',noise,\
                                        -32768,'Channel 2 random uncertainty estimate',\
                                        'reflectance',0,10000,1.e-5,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
         if data.ch3a_there:
             noise[:,:] = -1e30
             gd = (data.ch3a > 0)&(data.u_random_Ch3a > 0)
@@ -432,7 +486,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
                                                noise,-32768,\
                                                'Channel 3A random uncertainty estimate',\
                                                'reflectance',0,10000,1.e-5,0.,\
-                                               coordinates='lon lat')
+                                               coordinates='lon lat',\
+                                               compression=compression)
     
         noise = np.zeros(data.ch3b.shape,dtype=np.float32)
         noise[:,:] = -1e30
@@ -442,7 +497,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch3b_u_random','ni','nj','time',noise,\
                                        -32768,'Channel 3B random uncertainty estimate',\
                                        'kelvin',0,10000,0.001,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
         noise = np.zeros(data.ch4.shape,dtype=np.float32)
         noise[:,:] = -1e30
@@ -452,7 +508,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch4_u_random','ni','nj','time',noise,\
                                        -32768,'Channel 4 random uncertainty estimate',\
                                        'kelvin',0,10000,0.001,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
         if data.ch5_there:
             noise = np.zeros(data.ch4.shape,dtype=np.float32)
@@ -463,7 +520,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
             Write_GBCS_Float_to_Int_3D(ncid,'ch5_u_random','ni','nj','time',noise,\
                                            -32768,'Channel 5 random uncertainty estimate',\
                                            'kelvin',0,10000,0.001,0.,\
-                                           coordinates='lon lat')
+                                           coordinates='lon lat',\
+                                           compression=compression)
     
         noise = np.zeros(data.ch1.shape,dtype=np.float32)
         noise[:,:] = -1e30
@@ -473,7 +531,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch1_u_non_random','ni','nj','time',noise,\
                                            -32768,'Channel 1 non random uncertainty estimate',\
                                            'reflectance',0,10000,1.e-5,0.,\
-                                           coordinates='lon lat')
+                                           coordinates='lon lat',\
+                                           compression=compression)
     
         noise[:,:] = -1e30
         gd = (data.ch2 > 0)&(data.u_non_random_Ch2 > 0)
@@ -482,7 +541,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch2_u_non_random','ni','nj','time',noise,\
                                        -32768,'Channel 2 non random uncertainty estimate',\
                                        'reflectance',0,10000,1.e-5,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
         if data.ch3a_there:
             noise[:,:] = -1e30
             gd = (data.ch3a > 0)&(data.u_non_random_Ch3a > 0)
@@ -492,7 +552,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
                                            noise,-32768,\
                                            'Channel 3A non random uncertainty estimate',\
                                            'reflectance',0,10000,1.e-5,0.,\
-                                           coordinates='lon lat')
+                                           coordinates='lon lat',\
+                                           compression=compression)
     
         noise = np.zeros(data.ch3b.shape,dtype=np.float32)
         noise[:,:] = -1e30
@@ -502,7 +563,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch3b_u_non_random','ni','nj','time',noise,\
                                        -32768,'Channel 3B non random uncertainty estimate',\
                                        'kelvin',0,10000,0.001,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
         noise = np.zeros(data.ch4.shape,dtype=np.float32)
         noise[:,:] = -1e30
@@ -512,7 +574,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch4_u_non_random','ni','nj','time',noise,\
                                        -32768,'Channel 4 non random uncertainty estimate',\
                                        'kelvin',0,10000,0.001,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
         
         if data.ch5_there:
             noise = np.zeros(data.ch4.shape,dtype=np.float32)
@@ -523,7 +586,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
             Write_GBCS_Float_to_Int_3D(ncid,'ch5_u_non_random','ni','nj','time',noise,\
                                            -32768,'Channel 5 non random uncertainty estimate',\
                                            'kelvin',0,10000,0.001,0.,\
-                                           coordinates='lon lat')
+                                           coordinates='lon lat',\
+                                           compression=compression)
     
 
         noise = np.zeros(data.ch1.shape,dtype=np.float32)
@@ -534,7 +598,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch1_u_common','ni','nj','time',noise,\
                                        -32768,'Channel 1 common uncertainty estimate',\
                                        'reflectance',0,10000,1.e-5,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
         noise[:,:] = -1e30
         gd = (data.ch2 > 0)&(data.u_common_Ch2 > 0)
@@ -543,7 +608,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch2_u_common','ni','nj','time',noise,\
                                        -32768,'Channel 2 common uncertainty estimate',\
                                        'reflectance',0,10000,1.e-5,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
         if data.ch3a_there:
             noise[:,:] = -1e30
             gd = (data.ch3a > 0)&(data.u_common_Ch3a > 0)
@@ -553,7 +619,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
                                            noise,-32768,\
                                            'Channel 3A common uncertainty estimate',\
                                            'reflectance',0,10000,1.e-5,0.,\
-                                           coordinates='lon lat')
+                                           coordinates='lon lat',\
+                                           compression=compression)
     
         noise = np.zeros(data.ch3b.shape,dtype=np.float32)
         noise[:,:] = -1e30
@@ -563,7 +630,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch3b_u_common','ni','nj','time',noise,\
                                        -32768,'Channel 3B common uncertainty estimate',\
                                        'kelvin',0,10000,0.001,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
         noise = np.zeros(data.ch4.shape,dtype=np.float32)
         noise[:,:] = -1e30
@@ -573,7 +641,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
         Write_GBCS_Float_to_Int_3D(ncid,'ch4_u_common','ni','nj','time',noise,\
                                        -32768,'Channel 4 non common uncertainty estimate',\
                                        'kelvin',0,10000,0.001,0.,\
-                                       coordinates='lon lat')
+                                       coordinates='lon lat',\
+                                       compression=compression)
     
         if data.ch5_there:
             noise = np.zeros(data.ch4.shape,dtype=np.float32)
@@ -584,7 +653,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
             Write_GBCS_Float_to_Int_3D(ncid,'ch5_common_random','ni','nj','time',noise,\
                                            -32768,'Channel 5 non common uncertainty estimate',\
                                            'kelvin',0,10000,0.001,0.,\
-                                           coordinates='lon lat')
+                                           coordinates='lon lat',\
+                                           compression=compression)
     
 
     #
@@ -595,21 +665,24 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
                                    'angular degree',0,10000,0.01,0.,\
                                    standard_name='zenith angle',\
                                    coordinates='lon lat',\
-                                   comment='The satellite zenith angle at time of the observations')
+                                   comment='The satellite zenith angle at time of the observations',\
+                                   compression=compression)
 
     Write_GBCS_Float_to_Int_3D(ncid,'solar_zenith_angle','ni','nj','time',\
                                    data.solza,-32768,'solar zenith angle',\
                                    'angular degree',0,18000,0.01,0.,\
                                    standard_name='zenith angle',\
                                    coordinates='lon lat',\
-                                   comment='The solar zenith angle at time of the observations')
+                                   comment='The solar zenith angle at time of the observations',\
+                                   compression=compression)
 
     Write_GBCS_Float_to_Int_3D(ncid,'relative_azimuth_angle','ni','nj','time',\
                                    data.solaz,-32768,'relative azimuth angle',\
                                    'angular degree',0,18000,0.01,0.,\
                                    standard_name='zenith angle',\
                                    coordinates='lon lat',\
-                                   comment='The relative azimuth angle at time of the observations')
+                                   comment='The relative azimuth angle at time of the observations',\
+                                   compression=compression)
 
     #
     # ICT temperature
@@ -617,7 +690,8 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     Write_GBCS_Float_Time(ncid,'ict_temp','nj','time',\
                               data.smoothPRT,-32768,\
                               'Temperature of internal calibration target',\
-                              'kelvin',-20000,10000,0.01,273.15)
+                              'kelvin',-20000,10000,0.01,273.15,\
+                              compression=compression)
 
 #
 # Quality flags
@@ -680,14 +754,14 @@ def write_gbcs_l1c(data,S_s,himawari=False,fiduceo=False):
     ncid.date_created = datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S')
     ncid.file_quality_level = 3
     ncid.spatial_resolution = '4.0 km at nadir'
-    ncid.start_time = data.date_time[0].strftime('%Y/%m/%d %H:%M:%S')
-    ncid.time_coverage_start = data.date_time[0].strftime('%Y/%m/%d %H:%M:%S')
-    ncid.stop_time = data.date_time[-1].strftime('%Y/%m/%d %H:%M:%S')
-    ncid.time_coverage_end = data.date_time[-1].strftime('%Y/%m/%d %H:%M:%S')
+    ncid.start_time = start_time.strftime('%Y/%m/%d %H:%M:%S')
+    ncid.time_coverage_start = start_time.strftime('%Y/%m/%d %H:%M:%S')
+    ncid.stop_time = end_time.strftime('%Y/%m/%d %H:%M:%S')
+    ncid.time_coverage_end = end_time.strftime('%Y/%m/%d %H:%M:%S')
     ncid.time_coverage_duration = \
-        (data.date_time[-1]-data.date_time[0]).strftime('%Y/%m/%d %H:%M:%S')
+        (end_time-start_time).strftime('%Y/%m/%d %H:%M:%S')
     ncid.time_coverage_resolution = \
-        (data.date_time[1]-data.date_time[0]).strftime('%Y/%m/%d %H:%M:%-S')
+        (second_time-start_time).strftime('%Y/%m/%d %H:%M:%-S')
 #    ncid.source = data.source_string
     if himawari:
         ncid.platform = 'Himawari'